@@ -0,0 +1,222 @@
+# archive.py
+
+import argparse
+import os
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import date
+from pathlib import Path
+
+from storage import DELIVERED_STATUS
+
+ARCHIVE_DIR = 'archive'
+ARCHIVE_FILE_PATTERN = 'receipts_{year}.db'
+
+# تُؤرشف فقط الفواتير المسلمة (DELIVERED_STATUS) والمدفوعة بالكامل
+DEFAULT_MONTHS_TO_KEEP = 12
+
+# الأرشفة تعمل باتصال خاص بها بجانب البرنامج، فتنتظر انتهاء عمليات البيع القصيرة بدلا من أن تفشل
+BUSY_TIMEOUT_MS = 30000
+
+# الجداول التي تنتقل مع الفاتورة إلى ملف الأرشيف، وعمود الربط برقم الفاتورة في كل منها
+ARCHIVED_TABLES = {
+    'receipts': 'id',
+    'receipt_items': 'receipt_id',
+    'job_materials': 'receipt_id',
+}
+
+
+# ==============================================================================
+# دوال مساعدة
+# ==============================================================================
+def archive_dir_for(db_file):
+    """The archive folder that sits next to the given database file."""
+    return os.path.join(os.path.dirname(os.path.abspath(db_file)), ARCHIVE_DIR)
+
+def archive_path(archive_dir, year):
+    return os.path.join(archive_dir, ARCHIVE_FILE_PATTERN.format(year=int(year)))
+
+def archived_years(archive_dir, first_year, last_year):
+    """Years in [first_year, last_year] that have an archive file on disk."""
+    return [year for year in range(int(first_year), int(last_year) + 1)
+            if os.path.exists(archive_path(archive_dir, year))]
+
+def cutoff_day_key(months_to_keep, today=None):
+    """Day key of the first day of the month that is months_to_keep months before today."""
+    today = today or date.today()
+    months = today.year * 12 + (today.month - 1) - int(months_to_keep)
+    return (months // 12) * 10000 + (months % 12 + 1) * 100 + 1
+
+def _table_columns(conn, schema, table):
+    return [info[1] for info in conn.execute(f"PRAGMA {schema}.table_info({table})").fetchall()]
+
+def _sync_archive_schema(conn, schema):
+    """
+    Creates the archived tables in an attached archive file with the live schema,
+    and adds any columns that later migrations added to the live tables.
+    """
+    for table in ARCHIVED_TABLES:
+        create_sql = conn.execute("SELECT sql FROM main.sqlite_master WHERE type = 'table' AND name = ?",
+                                  (table,)).fetchone()[0]
+        conn.execute(re.sub(r'^CREATE TABLE\s+"?\w+"?', f'CREATE TABLE IF NOT EXISTS {schema}.{table}', create_sql))
+        archive_columns = _table_columns(conn, schema, table)
+        for info in conn.execute(f"PRAGMA main.table_info({table})").fetchall():
+            if info[1] not in archive_columns:
+                conn.execute(f"ALTER TABLE {schema}.{table} ADD COLUMN {info[1]} {info[2]}")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS {schema}.idx_receipts_local_day ON receipts (local_day)")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS {schema}.idx_receipt_items_receipt ON receipt_items (receipt_id)")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS {schema}.idx_job_materials_receipt ON job_materials (receipt_id)")
+
+
+# ==============================================================================
+# نقل الفواتير القديمة إلى ملفات الأرشيف
+# ==============================================================================
+def archive_closed_receipts(conn, archive_dir, months_to_keep=DEFAULT_MONTHS_TO_KEEP, progress=print):
+    """
+    Moves delivered, fully paid receipts older than months_to_keep months, together
+    with their line items and consumed materials, into one archive file per year.
+    Returns the number of receipts moved.
+
+    The rollup tables and customer_stats are left untouched (they have no delete
+    triggers), so dashboard totals and customer balances do not change. Each year
+    is copied and deleted in one transaction; the copy uses INSERT OR IGNORE so a
+    run interrupted between the two files can simply be repeated.
+    """
+    cutoff = cutoff_day_key(months_to_keep)
+    years = [row[0] for row in conn.execute("""
+        SELECT DISTINCT local_day / 10000 FROM receipts
+        WHERE local_day < ? AND status = ? AND remaining_amount = 0
+    """, (cutoff, DELIVERED_STATUS)).fetchall()]
+    if not years:
+        progress("Archive: nothing to archive")
+        return 0
+
+    os.makedirs(archive_dir, exist_ok=True)
+    moved = 0
+    for year in years:
+        schema = f"archive_{year}"
+        conn.execute("ATTACH DATABASE ? AS " + schema, (archive_path(archive_dir, year),))
+        try:
+            # IMMEDIATE يحجز الكتابة من البداية حتى لا يتعارض مع بيع يتم على اتصال البرنامج
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                _sync_archive_schema(conn, schema)
+                conn.execute("""
+                    CREATE TEMP TABLE archive_ids AS
+                    SELECT id FROM main.receipts
+                    WHERE local_day >= ? AND local_day < ? AND local_day < ? AND status = ? AND remaining_amount = 0
+                """, (year * 10000, (year + 1) * 10000, cutoff, DELIVERED_STATUS))
+                for table, key_column in ARCHIVED_TABLES.items():
+                    columns = ", ".join(_table_columns(conn, 'main', table))
+                    conn.execute(f"""
+                        INSERT OR IGNORE INTO {schema}.{table} ({columns})
+                        SELECT {columns} FROM main.{table} WHERE {key_column} IN (SELECT id FROM temp.archive_ids)
+                    """)
+                # الحذف يبدأ بالجداول التابعة ثم الفواتير نفسها
+                for table, key_column in reversed(list(ARCHIVED_TABLES.items())):
+                    conn.execute(f"DELETE FROM main.{table} WHERE {key_column} IN (SELECT id FROM temp.archive_ids)")
+                count = conn.execute("SELECT COUNT(*) FROM temp.archive_ids").fetchone()[0]
+                conn.execute("DROP TABLE temp.archive_ids")
+                conn.commit()
+            except sqlite3.Error:
+                conn.rollback()
+                raise
+        finally:
+            conn.execute(f"DETACH DATABASE {schema}")
+        moved += count
+        progress(f"Archive: moved {count} receipts to {archive_path(archive_dir, year)}")
+    return moved
+
+def archive_database(db_file, archive_dir, months_to_keep=DEFAULT_MONTHS_TO_KEEP, progress=print):
+    """archive_closed_receipts on a connection of its own, so it can run off the Tk thread."""
+    conn = sqlite3.connect(db_file)
+    try:
+        conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+        return archive_closed_receipts(conn, archive_dir, months_to_keep, progress=progress)
+    finally:
+        conn.close()
+
+
+# ==============================================================================
+# الأرشفة في الخلفية
+# ==============================================================================
+class ArchiveJob:
+    """
+    Runs archive_database on a daemon thread, like backup.BackupJob. The Tk side
+    polls `done` with after() and then reads `result` (receipts moved) or `error`.
+    """
+
+    def __init__(self, db_file, archive_dir, **kwargs):
+        self.result = None
+        self.error = None
+        self._thread = threading.Thread(target=self._run, args=(db_file, archive_dir), kwargs=kwargs, daemon=True)
+
+    def _run(self, db_file, archive_dir, **kwargs):
+        try:
+            self.result = archive_database(db_file, archive_dir, **kwargs)
+        except Exception as e:
+            self.error = e
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    @property
+    def done(self):
+        return not self._thread.is_alive()
+
+
+# ==============================================================================
+# قراءة الأرشيف في التقارير
+# ==============================================================================
+@contextmanager
+def report_sources(conn, archive_dir, range_start, range_end):
+    """
+    Yields the FROM-clause sources report queries should read for receipts,
+    receipt_items and job_materials over the half-open day-key range
+    [range_start, range_end).
+
+    When no archive file covers the range these are just the live tables. Otherwise
+    the archive files are ATTACHed read-only and each source is a UNION ALL
+    subquery over the live table and the archives (columns an older archive lacks
+    read as NULL). Nothing is written, so this works on a query_only connection.
+    The archives are detached again on exit.
+    """
+    years = archived_years(archive_dir, range_start // 10000, (range_end - 1) // 10000)
+    if not years:
+        yield {table: table for table in ARCHIVED_TABLES}
+        return
+
+    schemas = []
+    try:
+        for year in years:
+            schema = f"archive_{year}"
+            conn.execute("ATTACH DATABASE ? AS " + schema, (Path(archive_path(archive_dir, year)).as_uri() + "?mode=ro",))
+            schemas.append(schema)
+        sources = {}
+        for table in ARCHIVED_TABLES:
+            columns = _table_columns(conn, 'main', table)
+            selects = [f"SELECT {', '.join(columns)} FROM main.{table}"]
+            for schema in schemas:
+                archive_columns = _table_columns(conn, schema, table)
+                selects.append("SELECT " + ", ".join(c if c in archive_columns else f"NULL AS {c}" for c in columns)
+                               + f" FROM {schema}.{table}")
+            sources[table] = "(" + " UNION ALL ".join(selects) + ")"
+        yield sources
+    finally:
+        for schema in schemas:
+            conn.execute(f"DETACH DATABASE {schema}")
+
+
+if __name__ == '__main__':
+    from data_store import DB_FILE
+
+    parser = argparse.ArgumentParser(description="Move old delivered and fully paid receipts into yearly archive files.")
+    parser.add_argument('--db', default=DB_FILE)
+    parser.add_argument('--months', type=int, default=DEFAULT_MONTHS_TO_KEEP,
+                        help="keep receipts newer than this many months in the main database")
+    args = parser.parse_args()
+
+    archive_database(args.db, archive_dir_for(args.db), args.months)
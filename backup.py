@@ -0,0 +1,172 @@
+# backup.py
+
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+import config_manager
+
+BACKUP_DIR = 'backups'
+BACKUP_NAME_FORMAT = 'backup_%Y%m%d_%H%M%S'
+KEEP_BACKUPS = 7
+MANIFEST_FILE = 'manifest.json'
+
+# النسخ يتم على دفعات صغيرة مع توقف قصير بعد كل دفعة (من progress، لأن sleep في backup() لا يُطبق إلا عند انشغال القاعدة)
+# حتى لا يتعطل البيع أثناء النسخ
+PAGES_PER_STEP = 256
+SLEEP_BETWEEN_STEPS = 0.05
+
+
+class BackupError(Exception):
+    """Raised when a backup copy cannot be made or fails verification."""
+
+
+# ==============================================================================
+# النسخ والتحقق
+# ==============================================================================
+def backup_dir_for(db_file):
+    """The backups folder that sits next to the given database file."""
+    return os.path.join(os.path.dirname(os.path.abspath(db_file)), BACKUP_DIR)
+
+def copy_database(source_file, target_file, pages=PAGES_PER_STEP, sleep=SLEEP_BETWEEN_STEPS):
+    """
+    Copies a live SQLite database with the online backup API, pages at a time,
+    through its own connection so it can run off the Tk thread. The pause of
+    `sleep` seconds between steps is taken in the progress callback, which runs
+    after every step (backup()'s own sleep only applies when a step finds the
+    database busy or locked). The result is a consistent snapshot even if sales
+    are saved meanwhile.
+    """
+    source = sqlite3.connect(source_file)
+    target = sqlite3.connect(target_file)
+    try:
+        source.backup(target, pages=pages, progress=lambda *_: time.sleep(sleep))
+        # النسخة ترث وضع WAL من الأصل؛ تحويلها لملف واحد مستقل بدون ملفات -wal و -shm
+        target.execute("PRAGMA journal_mode=DELETE")
+    finally:
+        target.close()
+        source.close()
+
+def verify_database(db_file):
+    """Opens a copy read-only and runs PRAGMA integrity_check. Raises BackupError if it is not 'ok'."""
+    conn = sqlite3.connect(f"file:{os.path.abspath(db_file)}?mode=ro", uri=True)
+    try:
+        result = [row[0] for row in conn.execute("PRAGMA integrity_check").fetchall()]
+        user_version = conn.execute("PRAGMA user_version").fetchone()[0]
+    except sqlite3.Error as e:
+        raise BackupError(f"{db_file}: {e}") from e
+    finally:
+        conn.close()
+    if result != ['ok']:
+        raise BackupError(f"{db_file}: integrity check failed: {'; '.join(result[:5])}")
+    return user_version
+
+def _copy_config(target_dir):
+    """Copies prices_config.json after checking it parses, so the bundle never holds a half-written file."""
+    if not os.path.exists(config_manager.CONFIG_FILE):
+        return None
+    with open(config_manager.CONFIG_FILE, 'rb') as f:
+        content = f.read()
+    json.loads(content.decode('utf-8'))
+    target = os.path.join(target_dir, os.path.basename(config_manager.CONFIG_FILE))
+    with open(target, 'wb') as f:
+        f.write(content)
+    return os.path.basename(target)
+
+def rotate_backups(backup_dir, keep=KEEP_BACKUPS):
+    """Deletes the oldest completed backups so that at most `keep` remain."""
+    backups = sorted(name for name in os.listdir(backup_dir)
+                     if os.path.isfile(os.path.join(backup_dir, name, MANIFEST_FILE)))
+    for name in backups[:-keep] if keep > 0 else []:
+        shutil.rmtree(os.path.join(backup_dir, name), ignore_errors=True)
+
+def create_backup(db_file, backup_dir=None, archive_dir=None, keep=KEEP_BACKUPS, progress=print):
+    """
+    Writes a verified backup bundle (the database, any archive databases and
+    prices_config.json, plus a manifest) into a new timestamped folder under
+    backup_dir, rotates old bundles and returns the folder path.
+
+    The bundle is assembled in a '.partial' folder and only renamed into place after
+    every database copy passes integrity_check, so a failed or interrupted backup
+    never counts as one of the kept bundles.
+    """
+    backup_dir = backup_dir or backup_dir_for(db_file)
+    started = datetime.now()
+    final_dir = os.path.join(backup_dir, started.strftime(BACKUP_NAME_FORMAT))
+    work_dir = final_dir + '.partial'
+    os.makedirs(work_dir, exist_ok=True)
+
+    try:
+        databases = [(db_file, os.path.basename(db_file))]
+        if archive_dir and os.path.isdir(archive_dir):
+            databases += [(os.path.join(archive_dir, name), os.path.join('archive', name))
+                          for name in sorted(os.listdir(archive_dir)) if name.endswith('.db')]
+
+        manifest = {'created': started.isoformat(timespec='seconds'), 'databases': {}, 'config': None}
+        for source_file, relative_name in databases:
+            target_file = os.path.join(work_dir, relative_name)
+            os.makedirs(os.path.dirname(target_file), exist_ok=True)
+            progress(f"Backup: copying {relative_name}...")
+            copy_database(source_file, target_file)
+            manifest['databases'][relative_name] = {
+                'schema_version': verify_database(target_file),
+                'size': os.path.getsize(target_file),
+            }
+        manifest['config'] = _copy_config(work_dir)
+
+        with open(os.path.join(work_dir, MANIFEST_FILE), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        os.replace(work_dir, final_dir)
+    except Exception:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        raise
+
+    rotate_backups(backup_dir, keep)
+    progress(f"Backup: done in {(datetime.now() - started).total_seconds():.1f}s -> {final_dir}")
+    return final_dir
+
+
+# ==============================================================================
+# النسخ في الخلفية
+# ==============================================================================
+class BackupJob:
+    """
+    Runs create_backup on a daemon thread. The Tk side polls `done` with after()
+    and then reads `result` (the bundle folder) or `error`; the worker never
+    touches any widget.
+    """
+
+    def __init__(self, db_file, **kwargs):
+        self.result = None
+        self.error = None
+        self._thread = threading.Thread(target=self._run, args=(db_file,), kwargs=kwargs, daemon=True)
+
+    def _run(self, db_file, **kwargs):
+        try:
+            self.result = create_backup(db_file, **kwargs)
+        except Exception as e:
+            self.error = e
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    @property
+    def done(self):
+        return not self._thread.is_alive()
+
+
+if __name__ == '__main__':
+    from archive import archive_dir_for
+    from data_store import DB_FILE
+
+    parser = argparse.ArgumentParser(description="Write a verified backup bundle of the receipts database.")
+    parser.add_argument('--db', default=DB_FILE)
+    parser.add_argument('--keep', type=int, default=KEEP_BACKUPS, help="number of backups to keep")
+    args = parser.parse_args()
+    create_backup(args.db, archive_dir=archive_dir_for(args.db), keep=args.keep)
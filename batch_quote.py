@@ -0,0 +1,223 @@
+# batch_quote.py
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+import pricing
+
+# أعمدة ملف الطلبات، وأسماؤها العربية المقبولة في ملفات العملاء (ونموذج الملف الفارغ)
+JOB_COLUMNS = {
+    'paper_type': 'نوع الورق',
+    'quantity': 'الكمية',
+    'size': 'المقاس',
+    'sides': 'الأوجه',
+    'print_method': 'نوع الطباعة',
+    'papers_per_book': 'ورق الكتاب',
+    'lakta_price': 'سعر اللقطة',
+    'lamination': 'السلوفان',
+    'trimming': 'التشريح',
+    'binding': 'التجليد',
+    'stapling_size': 'مقاس البشر',
+    'menu_quantity': 'عدد المنيو',
+    'menu_size': 'مقاس المنيو',
+    'cutting_price': 'سعر القص',
+}
+NUMERIC_COLUMNS = ['quantity', 'papers_per_book', 'lakta_price', 'menu_quantity', 'cutting_price']
+DEFAULTS = {'size': 'A4', 'sides': pricing.SINGLE_SIDED, 'print_method': pricing.INK_METHOD,
+            'lamination': pricing.NO_OPTION, 'trimming': pricing.NO_OPTION, 'binding': pricing.NO_OPTION,
+            'stapling_size': '', 'menu_size': 'A4'}
+
+# أعمدة التكلفة التي يضيفها quote_jobs (بالجنيه)
+COST_COLUMNS = {
+    'printing_cost': 'تكلفة الطباعة',
+    'lamination_cost': 'تكلفة السلوفان',
+    'trimming_cost': 'تكلفة التشريح',
+    'cutting_cost': 'تكلفة القص',
+    'binding_cost': 'تكلفة التجليد',
+    'stapling_cost': 'تكلفة البشر',
+    'menu_cost': 'تكلفة تغليف المنيو',
+    'total': 'الإجمالي',
+    'error': 'ملاحظات',
+}
+
+
+# ==============================================================================
+# قراءة ملف الطلبات
+# ==============================================================================
+def read_jobs(path):
+    """
+    Reads a job list from a CSV or Excel file into a DataFrame with the JOB_COLUMNS
+    keys as columns (English or Arabic headers), filling blanks with the wizard's
+    defaults. Raises ValueError if the paper type or quantity column is missing.
+    """
+    if os.path.splitext(path)[1].lower() in ('.xlsx', '.xls'):
+        raw = pd.read_excel(path, dtype=str)
+    else:
+        raw = pd.read_csv(path, dtype=str, encoding='utf-8-sig')
+    return normalize_jobs(raw)
+
+def normalize_jobs(raw):
+    headers = {arabic: key for key, arabic in JOB_COLUMNS.items()}
+    jobs = raw.rename(columns=lambda column: headers.get(str(column).strip(), str(column).strip()))
+    missing = [JOB_COLUMNS[key] for key in ('paper_type', 'quantity') if key not in jobs.columns]
+    if missing:
+        raise ValueError(f"الأعمدة غير موجودة في الملف: {', '.join(missing)}")
+    jobs = jobs.dropna(subset=['paper_type']).reset_index(drop=True)
+    for column in JOB_COLUMNS:
+        if column in NUMERIC_COLUMNS:
+            jobs[column] = pd.to_numeric(jobs.get(column), errors='coerce')
+        else:
+            values = jobs[column].fillna('').astype(str) if column in jobs.columns else pd.Series('', index=jobs.index)
+            # القيم كما في المعالج: بدون مسافات حول أنواع الورق، ومفاتيح التجليد كما هي في الإعدادات
+            values = values if column == 'binding' else values.str.strip()
+            jobs[column] = values.mask(values.str.strip() == '', DEFAULTS.get(column, ''))
+    return jobs[list(JOB_COLUMNS)]
+
+def write_template(path):
+    """Writes an empty job list with the Arabic headers for customers to fill in."""
+    pd.DataFrame(columns=list(JOB_COLUMNS.values())).to_excel(path, index=False)
+
+
+# ==============================================================================
+# التسعير المجمع
+# ==============================================================================
+def lookup(table, *key_columns):
+    """Looks up every row's key tuple in a flat price dict at once; missing keys are NaN."""
+    index = pd.MultiIndex.from_arrays(key_columns) if len(key_columns) > 1 else pd.Index(key_columns[0])
+    return pd.Series(dict(table), dtype=float).reindex(index).to_numpy()
+
+def tier_values(tiers, quantities, default=0.0):
+    """The vector form of pricing.tier_value: one searchsorted over the tier limits for all rows."""
+    limits, values = tiers
+    values = np.append(np.asarray(values, dtype=float), default)
+    return values[np.searchsorted(np.asarray(limits, dtype=float), quantities, side='left')]
+
+def quote_jobs(prices, jobs):
+    """
+    Prices every row of a normalized job list (see read_jobs) with the same rules
+    as pricing.quote, in whole-column operations: tiers through np.searchsorted and
+    fixed prices through one reindex per table. Returns a copy of jobs with the
+    COST_COLUMNS added; rows that cannot be priced get a NaN total and the reason
+    in 'error'.
+    """
+    n = len(jobs)
+    paper_type = jobs['paper_type'].to_numpy(dtype=object)
+    quantity = jobs['quantity'].to_numpy(dtype=float)
+    papers_per_book = jobs['papers_per_book'].fillna(0).to_numpy(dtype=float)
+    lakta_price = jobs['lakta_price'].to_numpy(dtype=float)
+    size = jobs['size'].to_numpy(dtype=object)
+
+    is_id_card = paper_type == pricing.ID_CARD_PRODUCT
+    is_plain = np.isin(paper_type, prices.plain_paper_types)
+    is_kocheh = ~is_id_card & ~is_plain
+    # الاستيكر وجه واحد دائماً
+    is_sticker = jobs['paper_type'].str.contains('استيكر', regex=False).to_numpy()
+    sides = np.where(is_sticker & is_kocheh, pricing.SINGLE_SIDED, jobs['sides'].to_numpy(dtype=object))
+    is_book = is_kocheh | (is_plain & (papers_per_book > 0))
+
+    errors = np.full(n, '', dtype=object)
+    errors[~(quantity > 0)] = "الكمية يجب أن تكون أكبر من صفر"
+    errors[papers_per_book < 0] = "عدد ورق الكتاب يجب أن يكون أكبر من صفر"
+    errors[jobs['menu_quantity'].fillna(0).to_numpy() < 0] = "عدد المنيو يجب أن يكون أكبر من صفر"
+    counts = jobs[['quantity', 'papers_per_book', 'menu_quantity']].fillna(0).to_numpy(dtype=float)
+    errors[(errors == '') & (counts % 1 != 0).any(axis=1)] = "الأعداد يجب أن تكون أعداداً صحيحة"
+    quantity = np.where(quantity > 0, quantity, 0)
+
+    # --- الطباعة ---
+    total_papers = quantity * np.where(is_plain & (papers_per_book > 0), papers_per_book, 1)
+    bracket = np.where(total_papers > prices.quantity_threshold, 'large', 'small')
+    sheet_price = np.where(jobs['print_method'].to_numpy() == pricing.LASER_METHOD,
+                           lookup(prices.laser_paper, paper_type, size, sides),
+                           lookup(prices.plain_paper, paper_type, size, bracket, sides))
+    copy_price = lookup(prices.printing, paper_type, sides)
+    copy_price = np.where(np.isnan(copy_price),
+                          lookup(prices.printing, paper_type, np.full(n, pricing.SINGLE_SIDED, dtype=object)), copy_price)
+    by_lakta = is_kocheh & ~np.isnan(lakta_price)
+    printing_cost = np.select(
+        [is_id_card, is_plain, by_lakta, is_kocheh],
+        [tier_values(prices.id_cards, quantity) * quantity,
+         sheet_price * total_papers,
+         quantity * np.nan_to_num(lakta_price) * np.where(sides == pricing.DOUBLE_SIDED, 2, 1),
+         copy_price * quantity])
+    errors[(errors == '') & np.isnan(printing_cost)] = "لا يوجد سعر لهذا النوع أو المقاس أو الأوجه"
+
+    # --- التشطيب (لا ينطبق على كروت ID) ---
+    finishes = ~is_id_card
+    finishing_quantity = np.where(is_book, np.maximum(quantity, 1), 1)
+    costs = {'printing_cost': printing_cost}
+    for column, table in [('lamination', prices.lamination), ('trimming', prices.trimming)]:
+        choice = jobs[column].to_numpy(dtype=object)
+        chosen = finishes & (choice != pricing.NO_OPTION)
+        unit = np.where(chosen, lookup(table, choice), 0)
+        errors[(errors == '') & np.isnan(unit)] = f"خيار غير موجود: {JOB_COLUMNS[column]}"
+        costs[f'{column}_cost'] = unit * finishing_quantity
+    cutting_price = jobs['cutting_price'].fillna(0).to_numpy(dtype=float)
+    costs['cutting_cost'] = np.where(finishes & (cutting_price > 0), cutting_price, 0)
+    binding = jobs['binding'].map(prices.binding).fillna(0).to_numpy(dtype=float)
+    costs['binding_cost'] = np.where(finishes, binding, 0) * finishing_quantity
+
+    stapled = is_plain & is_book & (jobs['stapling_size'].to_numpy() != '')
+    stapling_a5 = jobs['stapling_size'].to_numpy() == 'A5'
+    per_book = np.where(stapling_a5, tier_values(prices.stapling['A5'], papers_per_book),
+                        tier_values(prices.stapling['A4'], papers_per_book))
+    costs['stapling_cost'] = np.where(stapled, per_book * np.maximum(quantity, 1), 0)
+
+    menu_quantity = jobs['menu_quantity'].fillna(0).to_numpy(dtype=float)
+    menu_size = jobs['menu_size'].to_numpy(dtype=object)
+    menu_price = np.zeros(n)
+    for tier_size, tiers in prices.menu_lamination.items():
+        menu_price = np.where(menu_size == tier_size, tier_values(tiers, menu_quantity), menu_price)
+    costs['menu_cost'] = np.where(finishes & (menu_quantity > 0), menu_price * menu_quantity, 0)
+
+    priced = jobs.copy()
+    for column, values in costs.items():
+        priced[column] = np.where(errors == '', values, np.nan)
+    priced['total'] = priced[list(costs)].sum(axis=1, min_count=1)
+    priced['error'] = errors
+    return priced
+
+
+# ==============================================================================
+# التصدير والتحويل إلى طلب
+# ==============================================================================
+def export_quote(priced, path):
+    """Writes a priced job list with Arabic headers and a total row, ready to send to the customer."""
+    sheet = priced.rename(columns={**JOB_COLUMNS, **COST_COLUMNS})
+    total_row = {COST_COLUMNS['total']: priced['total'].sum(), JOB_COLUMNS['paper_type']: 'الإجمالي'}
+    sheet = pd.concat([sheet, pd.DataFrame([total_row])], ignore_index=True)
+    with pd.ExcelWriter(path, engine='xlsxwriter') as writer:
+        sheet.to_excel(writer, sheet_name='عرض السعر', index=False)
+
+def to_line_items(prices, priced):
+    """
+    Order line items (as the wizard adds them to the cart) for the rows of a
+    priced job list that have no error, built with pricing.quote.
+    """
+    items = []
+    for job in priced[priced['error'] == ''].itertuples(index=False):
+        items.extend(pricing.quote(
+            prices, job.paper_type, int(job.quantity), size=job.size, side=job.sides, print_method=job.print_method,
+            papers_per_book=int(job.papers_per_book) if job.papers_per_book > 0 else None,
+            lakta_price=None if pd.isna(job.lakta_price) else job.lakta_price,
+            lamination=job.lamination, trimming=job.trimming,
+            cutting_price=0 if pd.isna(job.cutting_price) else job.cutting_price,
+            binding=job.binding, stapling_size=job.stapling_size or None,
+            menu_quantity=0 if pd.isna(job.menu_quantity) else int(job.menu_quantity), menu_size=job.menu_size,
+        ))
+    return items
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Price a CSV/Excel list of print jobs with the current price config.")
+    parser.add_argument('jobs', help="CSV or Excel job list")
+    parser.add_argument('--out', help="write the priced quote to this Excel file")
+    args = parser.parse_args()
+
+    priced_jobs = quote_jobs(pricing.current_prices(), read_jobs(args.jobs))
+    print(priced_jobs[['paper_type', 'quantity', 'total', 'error']].to_string())
+    print(f"Total: {priced_jobs['total'].sum():.2f} ({(priced_jobs['error'] != '').sum()} rows not priced)")
+    if args.out:
+        export_quote(priced_jobs, args.out)
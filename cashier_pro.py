@@ -1,89 +1,34 @@
 import customtkinter as ctk
-from tkinter import messagebox, simpledialog, ttk
+from tkinter import filedialog, messagebox, simpledialog, ttk
 from datetime import datetime, date, timedelta
-import sqlite3
 import os
+import copy
 import pandas as pd
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-import re
 import calendar
 from PIL import Image, ImageDraw, ImageFont
 import sys
 import config_manager
+import archive
+import backup
+from maintenance import MaintenanceScheduler
+from storage import (DELIVERED_STATUS, PAYMENT_CHECKOUT, PAYMENT_PARTIAL, PAYMENT_SETTLEMENT, STOCK_ADJUSTMENT,
+                     STOCK_PURCHASE, DuplicateRecordError, open_store)
+from money import format_money, to_piastres, to_pounds
+import pricing
+from pricing import convert_numbers_to_hindi
+import batch_quote
+import repricing
+import receipt_codec
 import arabic_reshaper
 from bidi.algorithm import get_display
 from fpdf import FPDF
 
 
 # ==============================================================================
-# 1. إعداد قاعدة البيانات <<<--- تم التعديل هنا --- >>>
+# 1. إعداد قاعدة البيانات (انظر storage.py و data_store.py و pg_store.py)
 # ==============================================================================
-def init_database():
-    conn = sqlite3.connect('receipts.db')
-    cursor = conn.cursor()
-    
-    # جدول العملاء
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS customers (
-            id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, phone TEXT UNIQUE NOT NULL, notes TEXT
-        )
-    ''')
-    
-    # جدول الفواتير
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS receipts (
-            id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp DATETIME NOT NULL, receipt_data TEXT NOT NULL,
-            total_amount REAL NOT NULL, customer_id INTEGER, status TEXT, due_date TEXT, notes TEXT,
-            discount REAL, amount_paid REAL, remaining_amount REAL,
-            FOREIGN KEY (customer_id) REFERENCES customers (id)
-        )
-    ''')
-
-    # جدول المصروفات
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS expenses (
-            id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp DATETIME NOT NULL,
-            description TEXT NOT NULL, amount REAL NOT NULL
-        )
-    ''')
-    
-    # جدول المخزون
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS inventory (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL UNIQUE,
-            unit TEXT NOT NULL,
-            stock_level REAL NOT NULL DEFAULT 0,
-            low_stock_threshold REAL DEFAULT 10,
-            purchase_price REAL NOT NULL DEFAULT 0  -- <<<--- تعديل: إضافة سعر الشراء
-        )
-    ''')
-
-    # <<<--- تعديل: إضافة جدول لربط المواد بالفواتير --- >>>
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS job_materials (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            receipt_id INTEGER NOT NULL,
-            inventory_id INTEGER NOT NULL,
-            quantity_used REAL NOT NULL,
-            FOREIGN KEY (receipt_id) REFERENCES receipts (id),
-            FOREIGN KEY (inventory_id) REFERENCES inventory (id)
-        )
-    ''')
-
-    # التأكد من وجود الأعمدة الجديدة في الجداول القديمة
-    try:
-        cursor.execute("PRAGMA table_info(inventory)")
-        cols = [col[1] for col in cursor.fetchall()]
-        if 'purchase_price' not in cols:
-            cursor.execute("ALTER TABLE inventory ADD COLUMN purchase_price REAL NOT NULL DEFAULT 0")
-    except sqlite3.OperationalError as e:
-        print(f"Could not update inventory table: {e}")
-    
-    conn.commit()
-    conn.close()
-
 
 # ==============================================================================
 # 2. البيانات والأسعار (بدون تغيير)
@@ -91,20 +36,10 @@ def init_database():
 CONFIG = config_manager.load_prices()
 USERS = CONFIG['USERS']
 ORDER_STATUSES = CONFIG['ORDER_STATUSES']
-PRINTING_PRICES = CONFIG['PRINTING_PRICES']
-LAMINATION_PRICES = CONFIG['LAMINATION_PRICES']
-TRIMMING_PRICES = CONFIG['TRIMMING_PRICES']
-BINDING_OPTIONS = CONFIG['BINDING_OPTIONS']
-ID_CARD_PRICING = [[limit if limit < 999999 else float('inf'), price] for limit, price in CONFIG['ID_CARD_PRICING']]
-MIN_CUTTING_PRICE = CONFIG['MIN_CUTTING_PRICE']
-PLAIN_PAPER_TYPES = CONFIG['PLAIN_PAPER_TYPES']
-QUANTITY_THRESHOLD = CONFIG['QUANTITY_THRESHOLD']
-PLAIN_PAPER_PRICES = CONFIG['PLAIN_PAPER_PRICES']
-LASER_PLAIN_PAPER_PRICES = CONFIG['LASER_PLAIN_PAPER_PRICES']
-STAPLING_PRICING_A5 = [[limit if limit < 999999 else float('inf'), price] for limit, price in CONFIG['STAPLING_PRICING_A5']]
-STAPLING_PRICING_A4 = [[limit if limit < 999999 else float('inf'), price] for limit, price in CONFIG['STAPLING_PRICING_A4']]
-MENU_LAMINATION_PRICING = [[limit if limit < 999999 else float('inf'), prices] for limit, prices in CONFIG['MENU_LAMINATION_PRICING']]
-LAKTA_PRICES = CONFIG['LAKTA_PRICES']
+# الأسعار تُقرأ من نسخة pricing.current_prices()، وتُستبدل عند الحفظ في صفحة إدارة الأسعار بدون إعادة تشغيل
+pricing.publish_prices(CONFIG)
+# عرض السعر المباشر في صفحات الطلب يُحسب بعد توقف الكتابة بهذه المدة (مللي ثانية)
+QUOTE_PREVIEW_DELAY_MS = 300
 
 # ==============================================================================
 # 3. دوال مساعدة (بدون تغيير)
@@ -114,20 +49,6 @@ def reshape_arabic(text):
     bidi_text = get_display(reshaped_text)
     return bidi_text
 
-def clean_description(text):
-    text = convert_numbers_to_hindi(text)
-    text = re.sub(r'[a-zA-Z]', '', text)
-    text = re.sub(r'\s+', ' ', text).strip()
-    return text
-
-def convert_numbers_to_hindi(text):
-    mapping = {
-        '0': '٠', '1': '١', '2': '٢', '3': '٣', '4': '٤',
-        '5': '٥', '6': '٦', '7': '٧', '8': '٨', '9': '٩',
-        '.': '٫' 
-    }
-    return "".join([mapping.get(char, char) for char in str(text)])
-
 # ==============================================================================
 # 4. دوال الفواتير (بدون تغيير جوهري)
 # ==============================================================================
@@ -202,14 +123,16 @@ def format_receipt_for_display(receipt_id, customer_name, timestamp, items, subt
     receipt_lines.extend(build_row('الصنف', '     الكمية   ', 'السعر', 'الإجمالي'))
     receipt_lines.append("--" * RECEIPT_WIDTH)
 
-    total_from_items = sum(item.get('subtotal', 0) for item in items)
+    # المبالغ تُجمع بالقرش حتى لا تظهر فروق تقريب في الإجماليات
+    total_from_items = sum(to_piastres(item.get('subtotal', 0)) for item in items)
+    discount, paid, remaining = to_piastres(discount), to_piastres(paid), to_piastres(remaining)
     # إضافة الأصناف إلى الجدول
     for item in items:
         receipt_lines.extend(build_row(
             item.get('description', ''),
             item.get('quantity', 1),
-            f"{item.get('unit_price', 0):.2f}",
-            f"{item.get('subtotal', 0):.2f}"
+            format_money(to_piastres(item.get('unit_price', 0))),
+            format_money(to_piastres(item.get('subtotal', 0)))
         ))
     
     receipt_lines.append("=" * RECEIPT_WIDTH)
@@ -222,12 +145,12 @@ def format_receipt_for_display(receipt_id, customer_name, timestamp, items, subt
         # وضع القيمة على اليسار والعنوان على اليمين
         return f"{hindi_value}{' ' * padding}{label}"
 
-    receipt_lines.append(format_summary_line("الإجمالي قبل الخصم:", f"{total_from_items:.2f} ج.م"))
-    receipt_lines.append(format_summary_line("الخصم:", f"{discount:.2f} ج.م"))
-    receipt_lines.append(format_summary_line("الإجمالي بعد الخصم:", f"{(total_from_items - discount):.2f} ج.م"))
-    receipt_lines.append(format_summary_line("المدفوع:", f"{paid:.2f} ج.م"))
+    receipt_lines.append(format_summary_line("الإجمالي قبل الخصم:", f"{format_money(total_from_items)} ج.م"))
+    receipt_lines.append(format_summary_line("الخصم:", f"{format_money(discount)} ج.م"))
+    receipt_lines.append(format_summary_line("الإجمالي بعد الخصم:", f"{format_money(total_from_items - discount)} ج.م"))
+    receipt_lines.append(format_summary_line("المدفوع:", f"{format_money(paid)} ج.م"))
     receipt_lines.append("--" * RECEIPT_WIDTH)
-    receipt_lines.append(format_summary_line("المتبقي:", f"{remaining:.2f} ج.م"))
+    receipt_lines.append(format_summary_line("المتبقي:", f"{format_money(remaining)} ج.م"))
     receipt_lines.append("=" * RECEIPT_WIDTH)
     
     if notes and notes.strip():
@@ -240,6 +163,16 @@ def format_receipt_for_display(receipt_id, customer_name, timestamp, items, subt
     receipt_lines.append("شكراً لتعاملكم معنا!".center(RECEIPT_WIDTH))
     
     return "\n".join(receipt_lines)
+
+def render_stored_receipt(row):
+    """
+    تعيد (نص الفاتورة، بيانات الفاتورة) لفاتورة محفوظة (صف من DataStore.RECEIPT_COLUMNS).
+    النص يُبنى عند الطلب من البيانات المضغوطة؛ الفواتير القديمة تُعرض بنصها المحفوظ.
+    """
+    data, legacy_text = receipt_codec.receipt_render_data(*row)
+    if legacy_text is not None:
+        return legacy_text, data
+    return format_receipt_for_display(**data), data
 # ... The rest of the helper functions for printing and PDF generation remain the same
 def convert_numbers(text):
     """
@@ -527,14 +460,25 @@ def print_escpos_receipt(printer, data):
 # 5. الكلاس الرئيسي للتطبيق (بدون تغيير)
 # ==============================================================================
 class CashierApp(ctk.CTk):
-    def __init__(self):
+    def __init__(self, store):
         super().__init__()
+        self.store = store
+        # قائمة الأسعار الحالية تُسجل كإصدار (إذا تغيرت منذ آخر إصدار) حتى تعرف كل فاتورة الأسعار التي سُعرت بها
+        self.price_history = pricing.PriceHistory(store)
+        self.price_history.publish(CONFIG)
+        # الأسعار الخاصة بكل عميل تُجمع مع قائمة الأسعار مرة واحدة عند اختياره
+        self.customer_prices = pricing.CustomerPrices(store)
         self.current_customer_id = None
         self.current_customer_name = None
         self.current_order_items = []
         self.current_user = None
         self.intermediate_item = {}
         self.selected_print_type = None
+        # صيانة قاعدة البيانات (optimize و checkpoint و vacuum) أثناء فترات عدم الاستخدام، لملف SQLite فقط
+        self.maintenance = None
+        if store.supports_maintenance:
+            self.maintenance = MaintenanceScheduler(self, store.conn)
+            self.maintenance.start()
         self.withdraw()
         self.create_login_window()
         
@@ -652,8 +596,12 @@ class CashierApp(ctk.CTk):
         if page_name == 'Page_CustomerManagement': frame.load_all_customers()
         if page_name == 'Page_JobTracking': frame.load_open_jobs()
         if page_name == 'Page_DebtsTracking': frame.load_debts()
+        if page_name in ['Page1_PrintType', 'Page2_Details']: frame.refresh_prices()
         if page_name in ['Page_Addons', 'Page_Preparation'] and data:
             frame.update_view(data)
+        # الأسعار أو العميل ربما تغيروا منذ آخر عرض للصفحة
+        if page_name in ['Page_PlainPaper', 'Page2_Details', 'Page_IDCards', 'Page_Addons', 'Page_Preparation']:
+            frame.quote_preview.schedule()
 
         frame.tkraise()
     
@@ -661,6 +609,15 @@ class CashierApp(ctk.CTk):
     def get_frame(self, page_name):
         return self.frames[page_name]
 
+    def select_customer(self, customer_id, customer_name):
+        self.current_customer_id = customer_id
+        self.current_customer_name = customer_name
+        self.prices()
+
+    def prices(self):
+        """The price snapshot to quote the current order with: the price list plus the customer's special prices."""
+        return self.customer_prices.prices_for(self.current_customer_id)
+
     def add_item_to_order(self, item_details):
         self.current_order_items.append(item_details)
         if "Page1_PrintType" in self.frames:
@@ -674,17 +631,15 @@ class CashierApp(ctk.CTk):
         if "Page1_PrintType" in self.frames:
             self.frames["Page1_PrintType"].update_cart_button()
 
-    def save_receipt(self, receipt_text, total_amount, customer_id, due_date, notes, discount, amount_paid, remaining):
-        conn = sqlite3.connect('receipts.db')
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO receipts (timestamp, receipt_data, total_amount, customer_id, status, due_date, notes, discount, amount_paid, remaining_amount) 
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (datetime.now(), receipt_text, total_amount, customer_id, "تحت التنفيذ", due_date, notes, discount, amount_paid, remaining))
-        last_id = cursor.lastrowid
-        conn.commit()
-        # لا تغلق الاتصال هنا، سنحتاجه لحفظ المواد
-        return last_id, conn # <<<--- تعديل: إرجاع كائن الاتصال
+    def save_receipt(self, receipt_payload, total_amount, customer_id, due_date, notes, discount, amount_paid, remaining,
+                     items=(), consumed_materials=()):
+        # الفاتورة وبنودها والمواد المستخدمة تُحفظ في معاملة واحدة، مع إصدار الأسعار وإصدار أسعار العميل الخاصة
+        # اللذين سُعرت بهما البنود فعلاً (وليس الساريين وقت الحفظ)؛ ValueError إذا اختلفت إصدارات البنود
+        price_version_id, customer_price_version_id = pricing.order_versions(items)
+        return self.store.save_receipt(receipt_payload, total_amount, customer_id, due_date, notes, discount,
+                                       amount_paid, remaining, items, consumed_materials,
+                                       price_version_id=price_version_id,
+                                       customer_price_version_id=customer_price_version_id)
 
 # ==============================================================================
 # 6. كلاسات صفحات الواجهة
@@ -692,6 +647,62 @@ class CashierApp(ctk.CTk):
 
 # ... (كل كلاسات الصفحات من Page_CustomerSelection إلى Page_Preparation تبقى كما هي) ...
 
+class QuotePreview(ctk.CTkFrame):
+    """
+    Live quote panel of an order wizard page. quote(prices) returns the job's
+    line items priced with the given snapshot (see pricing.quote), raising
+    ValueError, TypeError or KeyError while the inputs are incomplete. Every
+    change reschedules the quote with after(), so it runs once typing pauses
+    for QUOTE_PREVIEW_DELAY_MS, against the compiled prices of the current
+    customer (controller.prices()).
+    """
+
+    def __init__(self, parent, controller, quote):
+        super().__init__(parent)
+        self.controller = controller
+        self.quote = quote
+        self.pending = None
+        self.total_label = ctk.CTkLabel(self, text="", font=("Arial", 18, "bold"), text_color="#2ECC71")
+        self.total_label.pack(pady=(10, 0), padx=20)
+        self.lines_label = ctk.CTkLabel(self, text="", font=("Arial", 13), justify="right")
+        self.lines_label.pack(pady=(0, 10), padx=20)
+        self.clear()
+
+    def watch(self, *inputs):
+        """Re-quotes when any of inputs (entries, or the Tk variables of radio buttons, checkboxes and menus) changes."""
+        for widget in inputs:
+            if hasattr(widget, 'trace_add'):
+                widget.trace_add('write', self.schedule)
+            else:
+                widget.bind("<KeyRelease>", self.schedule)
+
+    def schedule(self, *args):
+        if self.pending is not None:
+            self.after_cancel(self.pending)
+        self.pending = self.after(QUOTE_PREVIEW_DELAY_MS, self.refresh)
+
+    def clear(self):
+        self.total_label.configure(text="سعر الطلب: -- ج.م")
+        self.lines_label.configure(text="")
+
+    def refresh(self):
+        self.pending = None
+        prices = self.controller.prices()
+        try:
+            items = self.quote(prices)
+        except (ValueError, TypeError, KeyError):
+            self.clear()
+            return
+        total = sum(to_piastres(item['subtotal']) for item in items)
+        special = " (أسعار خاصة)" if prices.customer_id is not None else ""
+        self.total_label.configure(text=f"سعر الطلب: {format_money(total)} ج.م{special}")
+        lines = [f"{item['description']}: {item['quantity']} × {item['unit_price']:.2f} = {format_money(to_piastres(item['subtotal']))}"
+                 for item in items]
+        if self.controller.current_order_items:
+            order_total = sum(to_piastres(item['subtotal']) for item in self.controller.current_order_items)
+            lines.append(f"إجمالي الطلب الحالي مع هذا البند: {format_money(order_total + total)} ج.م")
+        self.lines_label.configure(text="\n".join(lines))
+
 class Page_CustomerSelection(ctk.CTkFrame):
     def __init__(self, parent, controller):
         super().__init__(parent)
@@ -718,15 +729,10 @@ class Page_CustomerSelection(ctk.CTkFrame):
         if not phone:
             messagebox.showwarning("خطأ", "الرجاء إدخال رقم تليفون للبحث.")
             return
-        conn = sqlite3.connect('receipts.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, name FROM customers WHERE phone = ?", (phone,))
-        customer = cursor.fetchone()
-        conn.close()
+        customer = self.controller.store.find_customer_by_phone(phone)
         if customer:
             customer_id, customer_name = customer
-            self.controller.current_customer_id = customer_id
-            self.controller.current_customer_name = customer_name
+            self.controller.select_customer(customer_id, customer_name)
             self.start_order()
         else:
             self.result_label.configure(text="العميل غير موجود. يمكنك إضافته كعميل جديد.", text_color="orange")
@@ -754,19 +760,13 @@ class Page_CustomerSelection(ctk.CTkFrame):
                 messagebox.showerror("خطأ", "الاسم ورقم التليفون حقول إجبارية.", parent=popup)
                 return
             try:
-                conn = sqlite3.connect('receipts.db')
-                cursor = conn.cursor()
-                cursor.execute("INSERT INTO customers (name, phone, notes) VALUES (?, ?, ?)", (name, phone, notes))
-                new_id = cursor.lastrowid
-                conn.commit()
-                conn.close()
-                self.controller.current_customer_id = new_id
-                self.controller.current_customer_name = name
+                new_id = self.controller.store.add_customer(name, phone, notes)
+                self.controller.select_customer(new_id, name)
                 self.result_label.configure(text=f"تم إضافة وبدء الطلب للعميل: {name}", text_color="#2ECC71")
                 self.phone_search_entry.delete(0, 'end')
                 popup.destroy()
                 self.start_order()
-            except sqlite3.IntegrityError:
+            except DuplicateRecordError:
                 messagebox.showerror("خطأ", "رقم التليفون هذا مسجل لعميل آخر.", parent=popup)
         ctk.CTkButton(popup, text="حفظ وبدء الطلب", command=save_and_start).pack(pady=20)
 
@@ -781,27 +781,10 @@ class Page1_PrintType(ctk.CTkFrame):
         super().__init__(parent)
         self.controller = controller
         ctk.CTkLabel(self, text="الخطوة 1: اختر نوع الطباعة", font=ctk.CTkFont(size=24, weight="bold")).pack(pady=20)
-        scrollable_frame = ctk.CTkScrollableFrame(self)
-        scrollable_frame.pack(fill="both", expand=True, padx=100, pady=20)
-        
-        ctk.CTkLabel(scrollable_frame, text="--- ورق طبع ---", font=("Arial", 16, "bold")).pack(pady=(10, 5))
-        for p_type in PLAIN_PAPER_TYPES:
-            btn = ctk.CTkButton(scrollable_frame, text=p_type, font=("Arial", 16), height=40, fg_color="#3498db", hover_color="#2980b9",
-                              command=lambda pt=p_type: self.select_and_next(pt))
-            btn.pack(fill="x", pady=5, padx=10)
-
-        ctk.CTkLabel(scrollable_frame, text="--- منتجات أخرى ---", font=("Arial", 16, "bold")).pack(pady=(20, 5))
-        
-        btn_id = ctk.CTkButton(scrollable_frame, text="كروت ID", font=("Arial", 16), height=40,
-                               fg_color="#9b59b6", hover_color="#8e44ad",
-                               command=lambda: self.select_and_next("كروت ID"))
-        btn_id.pack(fill="x", pady=5, padx=10)
-
-        ctk.CTkLabel(scrollable_frame, text="--- كوشيه واستيكر ---", font=("Arial", 16, "bold")).pack(pady=(20, 5))
-        for p_type in PRINTING_PRICES.keys():
-            btn = ctk.CTkButton(scrollable_frame, text=p_type, font=("Arial", 16), height=40,
-                              command=lambda pt=p_type: self.select_and_next(pt))
-            btn.pack(fill="x", pady=5, padx=10)
+        self.products_frame = ctk.CTkScrollableFrame(self)
+        self.products_frame.pack(fill="both", expand=True, padx=100, pady=20)
+        self.prices_version = None
+        self.refresh_prices()
         
         bottom_frame = ctk.CTkFrame(self, fg_color="transparent")
         bottom_frame.pack(pady=20, fill="x", padx=100)
@@ -811,7 +794,35 @@ class Page1_PrintType(ctk.CTkFrame):
                                          font=("Arial", 14, "bold"), state="disabled",
                                          command=lambda: controller.show_frame("Page_CartAndCheckout"))
         self.cart_button.pack(side="left", padx=10)
+        ctk.CTkButton(bottom_frame, text="تسعير ملف طلبات (Excel/CSV)", command=self.quote_job_file).pack(side="left", padx=10)
+        
+    def refresh_prices(self):
+        # الأزرار تُبنى من أنواع الورق في نسخة الأسعار الحالية، وتُعاد فقط إذا تغيرت النسخة
+        prices = self.controller.prices()
+        if prices.version == self.prices_version:
+            return
+        self.prices_version = prices.version
+        for widget in self.products_frame.winfo_children(): widget.destroy()
+
+        ctk.CTkLabel(self.products_frame, text="--- ورق طبع ---", font=("Arial", 16, "bold")).pack(pady=(10, 5))
+        for p_type in prices.plain_paper_types:
+            btn = ctk.CTkButton(self.products_frame, text=p_type, font=("Arial", 16), height=40, fg_color="#3498db", hover_color="#2980b9",
+                              command=lambda pt=p_type: self.select_and_next(pt))
+            btn.pack(fill="x", pady=5, padx=10)
+
+        ctk.CTkLabel(self.products_frame, text="--- منتجات أخرى ---", font=("Arial", 16, "bold")).pack(pady=(20, 5))
         
+        btn_id = ctk.CTkButton(self.products_frame, text=pricing.ID_CARD_PRODUCT, font=("Arial", 16), height=40,
+                               fg_color="#9b59b6", hover_color="#8e44ad",
+                               command=lambda: self.select_and_next(pricing.ID_CARD_PRODUCT))
+        btn_id.pack(fill="x", pady=5, padx=10)
+
+        ctk.CTkLabel(self.products_frame, text="--- كوشيه واستيكر ---", font=("Arial", 16, "bold")).pack(pady=(20, 5))
+        for p_type in prices.printing_types:
+            btn = ctk.CTkButton(self.products_frame, text=p_type, font=("Arial", 16), height=40,
+                              command=lambda pt=p_type: self.select_and_next(pt))
+            btn.pack(fill="x", pady=5, padx=10)
+
     def update_cart_button(self):
         item_count = len(self.controller.current_order_items)
         self.cart_button.configure(text=f"عرض الطلب الحالي ({item_count})")
@@ -819,13 +830,65 @@ class Page1_PrintType(ctk.CTkFrame):
         
     def select_and_next(self, print_type):
         self.controller.selected_print_type = print_type
-        if print_type in PLAIN_PAPER_TYPES:
+        if print_type in self.controller.prices().plain_paper_types:
             self.controller.show_frame("Page_PlainPaper")
-        elif print_type == "كروت ID":
+        elif print_type == pricing.ID_CARD_PRODUCT:
             self.controller.show_frame("Page_IDCards")
         else:
             self.controller.show_frame("Page2_Details")
             
+    def quote_job_file(self):
+        path = filedialog.askopenfilename(title="اختر ملف الطلبات", filetypes=[("Excel / CSV", "*.xlsx *.xls *.csv")])
+        if not path:
+            return
+        # كل صفوف الملف تُسعر مرة واحدة بنفس نسخة الأسعار (انظر batch_quote.py)
+        prices = self.controller.prices()
+        try:
+            priced = batch_quote.quote_jobs(prices, batch_quote.read_jobs(path))
+        except ValueError as e:
+            if messagebox.askyesno("خطأ", f"{e}\nهل تريد حفظ نموذج فارغ لملف الطلبات؟"):
+                batch_quote.write_template("Jobs_Template.xlsx")
+                os.startfile("Jobs_Template.xlsx")
+            return
+        except Exception as e:
+            messagebox.showerror("خطأ", f"تعذر قراءة ملف الطلبات: {e}")
+            return
+
+        failed = int((priced['error'] != '').sum())
+        popup = ctk.CTkToplevel(self)
+        popup.title("تسعير ملف طلبات")
+        popup.geometry("450x300")
+        popup.transient(self)
+        popup.grab_set()
+        ctk.CTkLabel(popup, text=os.path.basename(path), font=("Arial", 14, "bold")).pack(pady=(15, 5))
+        ctk.CTkLabel(popup, text=f"عدد الطلبات: {len(priced)} | تم تسعير: {len(priced) - failed} | غير مسعر: {failed}",
+                     font=("Arial", 14)).pack(pady=5)
+        ctk.CTkLabel(popup, text=f"الإجمالي: {format_money(to_piastres(priced['total'].sum()))} ج.م",
+                     font=("Arial", 18, "bold"), text_color="#2ECC71").pack(pady=10)
+        if failed:
+            ctk.CTkLabel(popup, text="سبب عدم التسعير موجود في عمود الملاحظات بملف عرض السعر.", text_color="tomato").pack()
+
+        def export():
+            filename = f"Quote_{os.path.splitext(os.path.basename(path))[0]}_{date.today().strftime('%Y-%m-%d')}.xlsx"
+            try:
+                batch_quote.export_quote(priced, filename)
+                messagebox.showinfo("نجاح", f"تم حفظ عرض السعر باسم: {filename}", parent=popup)
+                os.startfile(filename)
+            except Exception as e:
+                messagebox.showerror("خطأ", f"حدث خطأ أثناء حفظ عرض السعر: {e}", parent=popup)
+
+        def add_to_order():
+            for item in batch_quote.to_line_items(prices, priced):
+                self.controller.add_item_to_order(item)
+            popup.destroy()
+            messagebox.showinfo("تم بنجاح", f"تمت إضافة {len(priced) - failed} طلب إلى الطلب الحالي.")
+
+        button_frame = ctk.CTkFrame(popup, fg_color="transparent")
+        button_frame.pack(pady=20)
+        ctk.CTkButton(button_frame, text="تصدير عرض السعر (Excel)", command=export).pack(side="right", padx=10)
+        ctk.CTkButton(button_frame, text="إضافة للطلب الحالي", fg_color="#27ae60", hover_color="#2ecc71",
+                      state="normal" if failed < len(priced) else "disabled", command=add_to_order).pack(side="left", padx=10)
+
     def cancel_order(self):
         if self.controller.current_order_items:
             if messagebox.askyesno("تأكيد", "يوجد طلب مفتوح. هل تريد إلغاءه والعودة؟"):
@@ -870,6 +933,10 @@ class Page_PlainPaper(ctk.CTkFrame):
         ctk.CTkLabel(main_frame, text="أوجه الطباعة:", font=("Arial", 16)).pack(pady=10)
         ctk.CTkRadioButton(main_frame, text="وجه واحد", variable=self.side_var, value="وجه").pack()
         ctk.CTkRadioButton(main_frame, text="وجهين", variable=self.side_var, value="وجهين").pack()
+        self.quote_preview = QuotePreview(self, controller, lambda prices: pricing.quote_finishing(prices, self.quote_job(prices)))
+        self.quote_preview.pack(pady=(10, 0))
+        self.quote_preview.watch(self.print_method_var, self.size_var, self.side_var, self.is_book_mode,
+                                 self.total_papers_entry, self.papers_per_book_entry, self.book_count_entry)
         button_frame = ctk.CTkFrame(self, fg_color="transparent")
         button_frame.pack(pady=20)
         ctk.CTkButton(button_frame, text="رجوع", command=lambda: controller.show_frame("Page1_PrintType")).pack(side="right", padx=10)
@@ -884,51 +951,23 @@ class Page_PlainPaper(ctk.CTkFrame):
             self.book_frame.pack_forget()
             self.loose_paper_frame.pack(pady=10, fill="x")
 
+    def quote_job(self, prices):
+        if self.is_book_mode.get():
+            # الكمية هي عدد الكتب، وسعر الورقة حسب إجمالي الورق
+            quantity = int(self.book_count_entry.get())
+            papers_per_book = int(self.papers_per_book_entry.get())
+        else:
+            quantity = int(self.total_papers_entry.get())
+            papers_per_book = None
+        return pricing.quote_plain_paper(prices, self.controller.selected_print_type, self.size_var.get(),
+                                         self.side_var.get(), self.print_method_var.get(), quantity, papers_per_book)
+
     def calculate_and_proceed(self):
-        total_papers = 0
-        book_count = 1
-        papers_per_book = 0  # تعريف المتغير مبكراً
-        is_book_order = self.is_book_mode.get()
-        
         try:
-            if is_book_order:
-                papers_per_book = int(self.papers_per_book_entry.get())
-                book_count = int(self.book_count_entry.get())
-                if papers_per_book <= 0 or book_count <= 0:
-                    raise ValueError
-                total_papers = papers_per_book * book_count
-            else:
-                total_papers = int(self.total_papers_entry.get())
-                if total_papers <= 0:
-                    raise ValueError
+            self.controller.intermediate_item = self.quote_job(self.controller.prices())
         except (ValueError, TypeError):
             messagebox.showerror("خطأ", "الرجاء إدخال أرقام صحيحة وموجبة.")
             return
-        
-        p_type = self.controller.selected_print_type
-        size = self.size_var.get()
-        side = self.side_var.get()
-        print_method = self.print_method_var.get()
-        
-        price_per_sheet = 0
-        if print_method == "ليزر":
-            price_per_sheet = LASER_PLAIN_PAPER_PRICES[p_type][size][side]
-        else:
-            quantity_bracket = 'large' if total_papers > QUANTITY_THRESHOLD else 'small'
-            price_per_sheet = PLAIN_PAPER_PRICES[p_type][size][quantity_bracket][side]
-            
-        printing_total = price_per_sheet * total_papers
-        
-        # هنا تم تجميع البيانات لإرسالها للخطوة التالية
-        self.controller.intermediate_item = {
-            "type": "plain_paper",
-            "paper_size": size,
-            "is_book_order": is_book_order,
-            "papers_per_book": papers_per_book,  # تم تمرير عدد الورق هنا
-            "description": f"{p_type} ({size})",
-            "printing_cost": printing_total,
-            "items_to_finish": book_count if is_book_order else total_papers
-        }
         self.controller.show_frame("Page_Addons", data=self.controller.intermediate_item)
 class Page2_Details(ctk.CTkFrame):
     def __init__(self, parent, controller):
@@ -938,7 +977,8 @@ class Page2_Details(ctk.CTkFrame):
         # --- المتغيرات ---
         self.printing_side_var = ctk.StringVar(value="وجه")
         self.calculation_method_var = ctk.StringVar(value="نسخ")
-        self.lakta_price_var = ctk.DoubleVar(value=LAKTA_PRICES[0])
+        self.lakta_price_var = ctk.DoubleVar()
+        self.prices_version = None
 
         # --- الواجهة الرئيسية ---
         ctk.CTkLabel(self, text="تفاصيل طباعة الكوشيه والاستيكر", font=ctk.CTkFont(size=24, weight="bold")).pack(pady=20)
@@ -966,11 +1006,8 @@ class Page2_Details(ctk.CTkFrame):
         self.lakta_entry.pack(pady=5)
         
         ctk.CTkLabel(self.lakta_frame, text="سعر اللقطة (وجه واحد):", font=("Arial", 16)).pack(pady=(10, 5))
-        lakta_price_frame = ctk.CTkFrame(self.lakta_frame, fg_color="transparent")
-        lakta_price_frame.pack(pady=5)
-        # إنشاء أزرار الراديو ديناميكياً من الإعدادات
-        for price in LAKTA_PRICES:
-            ctk.CTkRadioButton(lakta_price_frame, text=f"{price} ج.م", variable=self.lakta_price_var, value=price).pack(side="right", padx=10)
+        self.lakta_price_frame = ctk.CTkFrame(self.lakta_frame, fg_color="transparent")
+        self.lakta_price_frame.pack(pady=5)
 
         # --- خيارات مشتركة (وجه/وجهين) ---
         ctk.CTkLabel(main_frame, text="أوجه الطباعة:", font=("Arial", 16)).pack(pady=10)
@@ -979,6 +1016,12 @@ class Page2_Details(ctk.CTkFrame):
         ctk.CTkRadioButton(sides_frame, text="وجه واحد", variable=self.printing_side_var, value="وجه").pack(side="right", padx=10)
         ctk.CTkRadioButton(sides_frame, text="وجهين", variable=self.printing_side_var, value="وجهين").pack(side="right", padx=10)
 
+        # --- السعر المباشر ---
+        self.quote_preview = QuotePreview(self, controller, lambda prices: pricing.quote_finishing(prices, self.quote_job(prices)))
+        self.quote_preview.pack(pady=(10, 0))
+        self.quote_preview.watch(self.printing_side_var, self.calculation_method_var, self.lakta_price_var,
+                                 self.copies_entry, self.lakta_entry)
+
         # --- أزرار التحكم السفلية ---
         button_frame = ctk.CTkFrame(self, fg_color="transparent")
         button_frame.pack(pady=20)
@@ -986,8 +1029,21 @@ class Page2_Details(ctk.CTkFrame):
         ctk.CTkButton(button_frame, text="التالي (الإضافات)", font=("Arial", 16, "bold"), height=40, command=self.calculate_and_proceed).pack(side="left", padx=10)
 
         # عرض الإطار الافتراضي عند بدء التشغيل
+        self.refresh_prices()
         self.toggle_view()
 
+    def refresh_prices(self):
+        # إنشاء أزرار الراديو ديناميكياً من نسخة الأسعار الحالية
+        prices = self.controller.prices()
+        if prices.version == self.prices_version:
+            return
+        self.prices_version = prices.version
+        for widget in self.lakta_price_frame.winfo_children(): widget.destroy()
+        for price in prices.lakta_prices:
+            ctk.CTkRadioButton(self.lakta_price_frame, text=f"{price} ج.م", variable=self.lakta_price_var, value=price).pack(side="right", padx=10)
+        if prices.lakta_prices:
+            self.lakta_price_var.set(prices.lakta_prices[0])
+
     def toggle_view(self):
         """تظهر أو تخفي حقول الإدخال بناءً على طريقة الحساب المختارة."""
         if self.calculation_method_var.get() == "نسخ":
@@ -997,51 +1053,23 @@ class Page2_Details(ctk.CTkFrame):
             self.copies_frame.pack_forget()
             self.lakta_frame.pack(pady=10, fill="x")
 
-    def calculate_and_proceed(self):
-        p_type = self.controller.selected_print_type
-        side = self.printing_side_var.get()
-        calculation_method = self.calculation_method_var.get()
-
-        printing_total = 0
-        items_to_finish = 0
-        description = p_type
+    def quote_job(self, prices):
+        if self.calculation_method_var.get() == "نسخ":
+            quantity, lakta_price = int(self.copies_entry.get()), None
+        else:  # "لقطات"
+            quantity, lakta_price = int(self.lakta_entry.get()), self.lakta_price_var.get()
+        return pricing.quote_kocheh(prices, self.controller.selected_print_type, self.printing_side_var.get(),
+                                    quantity, lakta_price)
 
-        if 'استيكر' in p_type and side == 'وجهين':
+    def calculate_and_proceed(self):
+        if 'استيكر' in self.controller.selected_print_type and self.printing_side_var.get() == pricing.DOUBLE_SIDED:
             messagebox.showwarning("تنبيه", "الاستيكر له وجه طباعة واحد فقط. سيتم الحساب على أنه وجه واحد.")
-            side = 'وجه'
-        
-        side_multiplier = 2 if side == 'وجهين' else 1
 
         try:
-            if calculation_method == "نسخ":
-                copies = int(self.copies_entry.get())
-                if copies <= 0: raise ValueError("العدد يجب أن يكون أكبر من صفر")
-                
-                base_price_per_copy = PRINTING_PRICES[p_type].get(side, PRINTING_PRICES[p_type]['وجه'])
-                printing_total = base_price_per_copy * copies
-                items_to_finish = copies
-
-            elif calculation_method == "لقطات":
-                num_laktat = int(self.lakta_entry.get())
-                if num_laktat <= 0: raise ValueError("العدد يجب أن يكون أكبر من صفر")
-                
-                price_per_lakta = self.lakta_price_var.get()
-                printing_total = num_laktat * price_per_lakta * side_multiplier
-                items_to_finish = num_laktat
-                description = f"{p_type} (لقطات)" # تغيير الوصف لتمييزه
-
+            self.controller.intermediate_item = self.quote_job(self.controller.prices())
         except (ValueError, TypeError) as e:
             messagebox.showerror("خطأ في الإدخال", f"الرجاء إدخال عدد صحيح وموجب. \n{e}")
             return
-        
-        self.controller.intermediate_item = {
-            "type": "kocheh", 
-            "paper_size": "A3+", 
-            "is_book_order": True, # نعاملها ككتب لأن كل لقطة قد تحتاج تشطيب منفصل
-            "description": description,
-            "printing_cost": printing_total,
-            "items_to_finish": items_to_finish
-        }
         self.controller.show_frame("Page_Addons", data=self.controller.intermediate_item)
 class Page_IDCards(ctk.CTkFrame):
     def __init__(self, parent, controller):
@@ -1056,57 +1084,37 @@ class Page_IDCards(ctk.CTkFrame):
         ctk.CTkLabel(main_frame, text="أدخل عدد الكروت المطلوبة:", font=("Arial", 18)).pack(pady=(20, 10))
         self.quantity_entry = ctk.CTkEntry(main_frame, font=("Arial", 16), width=250, height=40)
         self.quantity_entry.pack(pady=5)
-        self.quantity_entry.bind("<KeyRelease>", self.update_price_display)
         
-        self.price_label = ctk.CTkLabel(main_frame, text="سعر الكارت الواحد: -- ج.م", font=("Arial", 16, "bold"), text_color="#2ECC71")
-        self.price_label.pack(pady=20)
+        self.quote_preview = QuotePreview(main_frame, controller,
+                                          lambda prices: pricing.quote_id_cards(prices, int(self.quantity_entry.get())))
+        self.quote_preview.pack(pady=20, padx=10)
+        self.quote_preview.watch(self.quantity_entry)
         
         button_frame = ctk.CTkFrame(self, fg_color="transparent")
         button_frame.pack(pady=40)
         ctk.CTkButton(button_frame, text="رجوع", command=lambda: controller.show_frame("Page1_PrintType")).pack(side="right", padx=10)
         ctk.CTkButton(button_frame, text="أضف إلى الطلب", font=("Arial", 16, "bold"), height=40, command=self.add_to_order).pack(side="left", padx=10)
 
-    def get_id_card_price(self, quantity):
-        if quantity <= 0: return 0
-        for max_qty, price in ID_CARD_PRICING:
-            if quantity <= max_qty:
-                return price
-        return 0
-
-    def update_price_display(self, event=None):
-        try:
-            quantity = int(self.quantity_entry.get())
-            price_per_card = self.get_id_card_price(quantity)
-            self.price_label.configure(text=f"سعر الكارت الواحد: {price_per_card:.2f} ج.م")
-        except (ValueError, TypeError):
-            self.price_label.configure(text="سعر الكارت الواحد: -- ج.م")
-
     def add_to_order(self):
         try:
-            quantity = int(self.quantity_entry.get())
-            if quantity <= 0: raise ValueError
+            items = pricing.quote_id_cards(self.controller.prices(), int(self.quantity_entry.get()))
         except (ValueError, TypeError):
             messagebox.showerror("خطأ", "الرجاء إدخال كمية صحيحة وموجبة.")
             return
 
-        price_per_card = self.get_id_card_price(quantity)
-        total_price = quantity * price_per_card
-        
-        self.controller.add_item_to_order({
-            "description": "كروت ID", "quantity": quantity,
-            "unit_price": price_per_card, "subtotal": total_price
-        })
+        for item in items:
+            self.controller.add_item_to_order(item)
         messagebox.showinfo("تم بنجاح", "تمت إضافة الكروت إلى الطلب الحالي.")
         self.quantity_entry.delete(0, 'end')
-        self.update_price_display()
+        self.quote_preview.clear()
         self.controller.show_frame("Page1_PrintType")
 class Page_Addons(ctk.CTkFrame):
     def __init__(self, parent, controller):
         super().__init__(parent)
         self.controller = controller
         self.item_data = {}
-        self.lamination_var = ctk.StringVar(value=list(LAMINATION_PRICES.keys())[0])
-        self.trimming_var = ctk.StringVar(value=list(TRIMMING_PRICES.keys())[0])
+        self.lamination_var = ctk.StringVar(value=pricing.NO_OPTION)
+        self.trimming_var = ctk.StringVar(value=pricing.NO_OPTION)
         
         ctk.CTkLabel(self, text="الخطوة 2: اختر الإضافات (اختياري)", font=ctk.CTkFont(size=24, weight="bold")).pack(pady=20)
         self.info_label = ctk.CTkLabel(self, text="", font=("Arial", 16, "italic"))
@@ -1116,10 +1124,17 @@ class Page_Addons(ctk.CTkFrame):
         main_frame.pack(pady=20, padx=50, expand=True)
         
         ctk.CTkLabel(main_frame, text="السلوفان:", font=("Arial", 16)).pack()
-        ctk.CTkOptionMenu(main_frame, variable=self.lamination_var, values=list(LAMINATION_PRICES.keys())).pack(pady=5)
+        self.lamination_menu = ctk.CTkOptionMenu(main_frame, variable=self.lamination_var, values=[pricing.NO_OPTION])
+        self.lamination_menu.pack(pady=5)
         
         ctk.CTkLabel(main_frame, text="التشريح:", font=("Arial", 16)).pack()
-        ctk.CTkOptionMenu(main_frame, variable=self.trimming_var, values=list(TRIMMING_PRICES.keys())).pack(pady=5)
+        self.trimming_menu = ctk.CTkOptionMenu(main_frame, variable=self.trimming_var, values=[pricing.NO_OPTION])
+        self.trimming_menu.pack(pady=5)
+
+        self.quote_preview = QuotePreview(self, controller, lambda prices: pricing.quote_finishing(
+            prices, self.item_data, lamination=self.lamination_var.get(), trimming=self.trimming_var.get()))
+        self.quote_preview.pack(pady=(10, 0))
+        self.quote_preview.watch(self.lamination_var, self.trimming_var)
         
         button_frame = ctk.CTkFrame(self, fg_color="transparent")
         button_frame.pack(pady=20)
@@ -1130,8 +1145,12 @@ class Page_Addons(ctk.CTkFrame):
     def update_view(self, data):
         self.item_data = data
         self.info_label.configure(text=f"إضافات لـ '{data['description']}'")
-        self.lamination_var.set(list(LAMINATION_PRICES.keys())[0])
-        self.trimming_var.set(list(TRIMMING_PRICES.keys())[0])
+        # الخيارات من نسخة الأسعار الحالية في كل مرة تُفتح فيها الصفحة
+        prices = self.controller.prices()
+        for menu, variable, options in [(self.lamination_menu, self.lamination_var, list(prices.lamination)),
+                                        (self.trimming_menu, self.trimming_var, list(prices.trimming))]:
+            menu.configure(values=options)
+            variable.set(options[0])
 
     def go_back(self):
         if self.item_data.get("type") == "plain_paper":
@@ -1220,6 +1239,11 @@ class Page_Preparation(ctk.CTkFrame):
         ctk.CTkRadioButton(menu_details_frame, text="A4", variable=self.menu_lamination_size_var, value="A4").pack(side="right", padx=5)
         ctk.CTkRadioButton(menu_details_frame, text="A3", variable=self.menu_lamination_size_var, value="A3").pack(side="right", padx=5)
 
+        self.quote_preview = QuotePreview(self, controller, self.quote_items)
+        self.quote_preview.pack(pady=(10, 0))
+        self.quote_preview.watch(self.binding_var, self.stapling_var, self.stapling_size_var, self.menu_lamination_var,
+                                 self.menu_lamination_size_var, self.cutting_entry, self.menu_quantity_entry)
+
         button_frame = ctk.CTkFrame(self, fg_color="transparent")
         button_frame.pack(pady=20)
         ctk.CTkButton(button_frame, text="رجوع (للإضافات)", command=lambda: controller.show_frame("Page_Addons", data=self.item_data)).pack(side="right", padx=10)
@@ -1235,7 +1259,7 @@ class Page_Preparation(ctk.CTkFrame):
         self.stapling_var.set(False)
         self.binding_var.set('لا يوجد')
         self.cutting_entry.delete(0, 'end')
-        self.cutting_entry.insert(0, str(MIN_CUTTING_PRICE))
+        self.cutting_entry.insert(0, str(self.controller.prices().min_cutting_price))
 
         self.menu_lamination_var.set(False)
         self.menu_quantity_entry.delete(0, 'end')
@@ -1244,101 +1268,41 @@ class Page_Preparation(ctk.CTkFrame):
         else:
             self.menu_lamination_frame.pack_forget()
 
-    def get_stapling_price_per_book(self, quantity, size):
-        pricing_table = STAPLING_PRICING_A5 if size == 'A5' else STAPLING_PRICING_A4
-        for max_qty, price in pricing_table:
-            if quantity <= max_qty: return price
-        return 0
-    
-    def get_menu_lamination_price(self, quantity, size):
-        if not isinstance(quantity, (int, float)) or quantity <= 0:
-            return 0
-        for max_qty, prices in MENU_LAMINATION_PRICING:
-            if quantity <= max_qty:
-                return prices.get(size, 0)
-        return 0
-
-    def calculate_and_add_to_order(self):
-        items_to_finish = self.item_data.get("items_to_finish", 1)
-        if items_to_finish <= 0: items_to_finish = 1
-        is_book_order = self.item_data.get("is_book_order", False)
-        
-        printing_cost = self.item_data.get('printing_cost', 0)
-        base_desc_clean = clean_description(self.item_data.get('description', ''))
-        self.controller.add_item_to_order({
-            "description": base_desc_clean, "quantity": items_to_finish,
-            "unit_price": printing_cost / items_to_finish if items_to_finish > 0 else 0,
-            "subtotal": printing_cost,
-        })
-
-        for choice_key, prices_dict in [('lamination_choice', LAMINATION_PRICES), ('trimming_choice', TRIMMING_PRICES)]:
-            choice = self.item_data.get(choice_key)
-            if choice and choice != 'لا يوجد':
-                price = prices_dict[choice]
-                qty = items_to_finish if is_book_order else 1
-                self.controller.add_item_to_order({
-                    "description": choice, "quantity": qty,
-                    "unit_price": price, "subtotal": price * qty
-                })
-        
+    def quote_items(self, prices):
+        """The job's line items with the finishing chosen here; ValueError (with the message to show) for a bad entry."""
         try:
             cutting_price = float(self.cutting_entry.get() or 0)
-            if cutting_price > 0:
-                self.controller.add_item_to_order({
-                    "description": "خدمة قص", "quantity": 1, 
-                    "unit_price": cutting_price, "subtotal": cutting_price
-                })
         except ValueError:
-            messagebox.showerror("خطأ", "الرجاء إدخال سعر قص صحيح."); return
-
-        selected_binding = self.binding_var.get()
-        if selected_binding != 'لا يوجد':
-            price = BINDING_OPTIONS.get(selected_binding, 0)
-            qty = items_to_finish if is_book_order else 1
-            desc = clean_description(f"تجليد: {selected_binding.strip()}")
-            self.controller.add_item_to_order({
-                "description": desc, "quantity": qty,
-                "unit_price": price, "subtotal": price * qty
-            })
-        if self.stapling_var.get():
-            # نحصل على عدد الورق للكتاب الواحد من البيانات التي مررناها
-            papers_per_book = self.item_data.get("papers_per_book", 0)
-
-            # نتأكد أن هذا طلب كتب بالفعل وبه ورق ليتم تدبيسه
-            if is_book_order and papers_per_book > 0:
-                size = self.stapling_size_var.get()
-                
-                # نحسب السعر بناءً على عدد الورق في الكتاب، وليس عدد الكتب
-                price_per = self.get_stapling_price_per_book(papers_per_book, size)
-                
-                desc = clean_description(f"خدمة بشر ({size})")
-                
-                # نضيف البند للفاتورة (الكمية هنا هي عدد الكتب وهو صحيح)
-                self.controller.add_item_to_order({
-                    "description": desc,
-                    "quantity": items_to_finish, # items_to_finish هو عدد الكتب
-                    "unit_price": price_per,      # price_per هو سعر تدبيس الكتاب الواحد
-                    "subtotal": price_per * items_to_finish
-                })
+            raise ValueError("الرجاء إدخال سعر قص صحيح.") from None
 
+        menu_quantity = 0
         if self.menu_lamination_var.get():
             try:
                 menu_quantity = int(self.menu_quantity_entry.get())
                 if menu_quantity <= 0: raise ValueError
             except (ValueError, TypeError):
-                messagebox.showerror("خطأ", "الرجاء إدخال عدد صحيح للمنيوهات.")
-                return
-            
-            menu_size = self.menu_lamination_size_var.get()
-            price_per_menu = self.get_menu_lamination_price(menu_quantity, menu_size)
-            
-            if price_per_menu > 0:
-                self.controller.add_item_to_order({
-                    "description": f"تغليف منيو حراري ({menu_size})",
-                    "quantity": menu_quantity,
-                    "unit_price": price_per_menu,
-                    "subtotal": price_per_menu * menu_quantity
-                })
+                raise ValueError("الرجاء إدخال عدد صحيح للمنيوهات.") from None
+
+        return pricing.quote_finishing(
+            prices, self.item_data,
+            lamination=self.item_data.get('lamination_choice'),
+            trimming=self.item_data.get('trimming_choice'),
+            cutting_price=cutting_price,
+            binding=self.binding_var.get(),
+            stapling_size=self.stapling_size_var.get() if self.stapling_var.get() else None,
+            menu_quantity=menu_quantity,
+            menu_size=self.menu_lamination_size_var.get(),
+        )
+
+    def calculate_and_add_to_order(self):
+        # كل البنود تُحسب أولاً، فلا يُضاف للطلب جزء منها إذا كان أحد المدخلات خاطئاً
+        try:
+            items = self.quote_items(self.controller.prices())
+        except ValueError as e:
+            messagebox.showerror("خطأ", str(e))
+            return
+        for item in items:
+            self.controller.add_item_to_order(item)
 
         messagebox.showinfo("تم بنجاح", "تمت إضافة البنود إلى الطلب.")
         self.controller.show_frame("Page1_PrintType")
@@ -1452,11 +1416,7 @@ class Page_CartAndCheckout(ctk.CTkFrame):
         self.materials_textbox.configure(state="disabled")
 
     def add_consumed_material_popup(self):
-        conn = sqlite3.connect('receipts.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, name, unit, stock_level FROM inventory ORDER BY name")
-        all_materials = cursor.fetchall()
-        conn.close()
+        all_materials = self.controller.store.list_materials()
 
         if not all_materials:
             messagebox.showinfo("تنبيه", "لا توجد مواد خام في المخزون. يرجى إضافتها من صفحة إدارة المخزون أولاً.")
@@ -1509,72 +1469,50 @@ class Page_CartAndCheckout(ctk.CTkFrame):
         if not self.controller.current_order_items:
             messagebox.showwarning("تنبيه", "لا توجد بنود في الطلب لإنهاء الفاتورة."); return
         try:
-            discount = float(self.discount_entry.get() or 0)
-            amount_paid = float(self.paid_entry.get() or 0)
+            pricing.order_versions(self.controller.current_order_items)
         except ValueError:
-            messagebox.showerror("خطأ", "الرجاء إدخال أرقام صحيحة."); return
+            # حُفظت أسعار جديدة أثناء تجهيز الطلب؛ الفاتورة تسجل إصداراً واحداً فتُسعر البنود من جديد ويراجعها الكاشير
+            if messagebox.askyesno("تغيرت الأسعار", "تم حفظ أسعار جديدة أثناء تجهيز الطلب، فبنوده مسعرة بأسعار مختلفة.\n"
+                                                    "هل تريد إعادة تسعير كل البنود بالأسعار الحالية؟"):
+                self.requote_order()
+            return
+        # الحساب بالقرش (أعداد صحيحة) ثم التحويل للجنيه للعرض والطباعة فقط
+        try:
+            discount_piastres = to_piastres(self.discount_entry.get() or 0)
+            paid_piastres = to_piastres(self.paid_entry.get() or 0)
+            if discount_piastres < 0 or paid_piastres < 0: raise ValueError
+        except (ValueError, ArithmeticError):
+            messagebox.showerror("خطأ", "الرجاء إدخال أرقام صحيحة غير سالبة للخصم والمدفوع."); return
         
         due_date = self.due_date_entry.get() or date.today().strftime('%Y-%m-%d')
         notes = self.notes_entry.get()
         now = datetime.now()
-        subtotal = sum(item['subtotal'] for item in self.controller.current_order_items)
-        remaining = (subtotal - discount) - amount_paid
+        subtotal_piastres = sum(to_piastres(item['subtotal']) for item in self.controller.current_order_items)
+        remaining_piastres = (subtotal_piastres - discount_piastres) - paid_piastres
         
         receipt_data_dict = {
             "receipt_id": "PREVIEW", "customer_name": self.controller.current_customer_name, "timestamp": now,
-            "items": self.controller.current_order_items, "subtotal": subtotal, "discount": discount,
-            "paid": amount_paid, "remaining": remaining, "notes": notes, "due_date": due_date
+            "items": self.controller.current_order_items, "subtotal": to_pounds(subtotal_piastres), "discount": to_pounds(discount_piastres),
+            "paid": to_pounds(paid_piastres), "remaining": to_pounds(remaining_piastres), "notes": notes, "due_date": due_date
         }
         
-        receipt_text_for_db = format_receipt_for_display(**receipt_data_dict)
+        # تُحفظ البنود فقط كـ JSON مضغوط، ونص الفاتورة يُبنى عند العرض
+        receipt_payload = receipt_codec.encode_receipt(self.controller.current_order_items)
         
-        # <<<--- تعديل: حفظ الفاتورة والمواد في نفس الوقت --- >>>
-        receipt_id = None
-        conn = None
+        # <<<--- تعديل: حفظ الفاتورة والبنود والمواد في معاملة واحدة --- >>>
         try:
-            # الخطوة 1: حفظ الفاتورة الأساسية والحصول على ID والاتصال
-            receipt_id, conn = self.controller.save_receipt(
-                receipt_text_for_db, subtotal, self.controller.current_customer_id, 
-                due_date, notes, discount, amount_paid, remaining
+            receipt_id = self.controller.save_receipt(
+                receipt_payload, subtotal_piastres, self.controller.current_customer_id,
+                due_date, notes, discount_piastres, paid_piastres, remaining_piastres,
+                items=self.controller.current_order_items, consumed_materials=self.consumed_materials
             )
-            if not receipt_id:
-                raise Exception("لم يتم إنشاء الفاتورة بنجاح.")
-                
-            cursor = conn.cursor()
-
-            # الخطوة 2: تحديث المخزون وحفظ المواد المستخدمة
-            if self.consumed_materials:
-                for item in self.consumed_materials:
-                    # تحديث المخزون
-                    cursor.execute("UPDATE inventory SET stock_level = stock_level - ? WHERE id = ?", 
-                                   (item['quantity'], item['id']))
-                    # حفظ الرابط بين الفاتورة والمادة
-                    cursor.execute("INSERT INTO job_materials (receipt_id, inventory_id, quantity_used) VALUES (?, ?, ?)",
-                                   (receipt_id, item['id'], item['quantity']))
-            
-            conn.commit() # تنفيذ كل العمليات معاً
             messagebox.showinfo("نجاح", "تم حفظ الفاتورة وتحديث المخزون بنجاح.")
-
         except Exception as e:
-            if conn:
-                conn.rollback() # تراجع عن أي تغييرات إذا حدث خطأ
             messagebox.showerror("خطأ جسيم", f"فشل حفظ الفاتورة. تم التراجع عن كل التغييرات.\nالخطأ: {e}")
             return
-        finally:
-            if conn:
-                conn.close()
 
-        # باقي الكود كما هو
         receipt_data_dict['receipt_id'] = receipt_id
-        
-        # <<<--- تعديل: إضافة رقم هاتف العميل إلى البيانات قبل عرضها --- >>>
-        conn_phone = sqlite3.connect('receipts.db')
-        cursor_phone = conn_phone.cursor()
-        cursor_phone.execute("SELECT phone FROM customers WHERE id = ?", (self.controller.current_customer_id,))
-        customer_phone_tuple = cursor_phone.fetchone()
-        conn_phone.close()
-        customer_phone = customer_phone_tuple[0] if customer_phone_tuple else ''
-        receipt_data_dict['customer_phone'] = customer_phone
+        receipt_data_dict['customer_phone'] = self.controller.store.get_customer_phone(self.controller.current_customer_id)
 
         display_text = format_receipt_for_display(**receipt_data_dict)
         
@@ -1586,6 +1524,20 @@ class Page_CartAndCheckout(ctk.CTkFrame):
         self.controller.current_customer_id = None
         self.controller.current_customer_name = None
 
+    def requote_order(self):
+        try:
+            self.controller.current_order_items = repricing.requote_lines(self.controller.prices(),
+                                                                          self.controller.current_order_items)
+        except KeyError as e:
+            messagebox.showerror("خطأ", f"لا يوجد سعر حالي للبند {e}. الرجاء إلغاء الطلب وإدخاله من جديد.")
+            return
+        # تحديث السلة يمسح المواد المصروفة، فتُحفظ وتُعاد
+        materials = list(self.consumed_materials)
+        self.refresh_cart_display()
+        self.consumed_materials.extend(materials)
+        self.refresh_materials_display()
+        messagebox.showinfo("تم", "تمت إعادة تسعير البنود بالأسعار الحالية. راجع الإجمالي ثم احفظ الفاتورة.")
+
     def cancel_order(self):
         if messagebox.askyesno("تأكيد", "هل أنت متأكد من رغبتك في إلغاء الطلب الحالي بالكامل؟"):
             self.controller.clear_current_order()
@@ -1710,6 +1662,13 @@ class AdminDashboard(ctk.CTkFrame):
             ctk.CTkButton(actions_frame, text="📊 تصدير تقرير شامل (Excel)", height=40, font=("Arial", 14, "bold"),
                           fg_color="#16A085", hover_color="#1ABC9C", 
                           command=self.create_admin_report_popup).pack(side="left", padx=20)
+            # الأرشفة والنسخ الاحتياطي خاصة بملف SQLite؛ مع PostgreSQL يتولاها الخادم نفسه
+            if self.controller.store.supports_archive:
+                self.archive_button = ctk.CTkButton(actions_frame, text="أرشفة الفواتير القديمة", command=self.archive_old_receipts)
+                self.archive_button.pack(side="left", padx=10)
+            if self.controller.store.supports_backup:
+                self.backup_button = ctk.CTkButton(actions_frame, text="نسخة احتياطية", command=self.start_backup)
+                self.backup_button.pack(side="left", padx=10)
 
     def create_summary_card(self, title, initial_value, color, row, col):
         card = ctk.CTkFrame(self, fg_color=color, corner_radius=10)
@@ -1720,20 +1679,12 @@ class AdminDashboard(ctk.CTkFrame):
         return value_label
         
     def load_daily_summary(self):
-        conn = sqlite3.connect('receipts.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT SUM(amount_paid) FROM receipts WHERE date(timestamp) = date('now', 'localtime')")
-        total_income = cursor.fetchone()[0] or 0
-        cursor.execute("SELECT SUM(amount) FROM expenses WHERE date(timestamp) = date('now', 'localtime')")
-        total_expenses = cursor.fetchone()[0] or 0
-        cursor.execute("SELECT SUM(remaining_amount) FROM receipts")
-        total_debt = cursor.fetchone()[0] or 0
-        conn.close()
+        total_income, total_expenses, total_debt = self.controller.store.daily_summary(date.today())
         net_profit = total_income - total_expenses
-        self.income_card.configure(text=f"{total_income:.2f} جنيه")
-        self.expense_card.configure(text=f"{total_expenses:.2f} جنيه")
-        self.profit_card.configure(text=f"{net_profit:.2f} جنيه")
-        self.debt_card.configure(text=f"{total_debt:.2f} جنيه")
+        self.income_card.configure(text=f"{format_money(total_income)} جنيه")
+        self.expense_card.configure(text=f"{format_money(total_expenses)} جنيه")
+        self.profit_card.configure(text=f"{format_money(net_profit)} جنيه")
+        self.debt_card.configure(text=f"{format_money(total_debt)} جنيه")
         
     def add_expense_popup(self):
         popup = ctk.CTkToplevel(self)
@@ -1753,21 +1704,54 @@ class AdminDashboard(ctk.CTkFrame):
             if not desc or not amount_str:
                 messagebox.showerror("خطأ", "الرجاء ملء كل الخانات.", parent=popup); return
             try:
-                amount = float(amount_str)
+                amount = to_piastres(amount_str)
                 if amount <= 0: raise ValueError
-            except ValueError:
+            except (ValueError, ArithmeticError):
                 messagebox.showerror("خطأ", "الرجاء إدخال مبلغ صحيح.", parent=popup); return
-            conn = sqlite3.connect('receipts.db')
-            cursor = conn.cursor()
-            cursor.execute("INSERT INTO expenses (timestamp, description, amount) VALUES (?, ?, ?)",
-                           (datetime.now(), desc, amount))
-            conn.commit()
-            conn.close()
+            self.controller.store.add_expense(desc, amount)
             messagebox.showinfo("نجاح", "تم حفظ المصروف بنجاح.", parent=popup)
             popup.destroy()
             self.load_daily_summary()
         ctk.CTkButton(popup, text="حفظ المصروف", command=save_expense).pack(pady=20)
 
+    def archive_old_receipts(self):
+        months = simpledialog.askinteger("أرشفة الفواتير", "نقل الفواتير المسلمة والمدفوعة الأقدم من كم شهر؟",
+                                         initialvalue=12, minvalue=1, parent=self)
+        if months is None:
+            return
+        # الأرشفة تعمل في الخلفية باتصال خاص بها، مثل النسخ الاحتياطي
+        store = self.controller.store
+        self.archive_button.configure(state="disabled", text="جاري الأرشفة...")
+        job = archive.ArchiveJob(store.db_file, store.archive_dir, months_to_keep=months).start()
+        self.after(500, lambda: self.check_archive(job))
+
+    def check_archive(self, job):
+        if not job.done:
+            self.after(500, lambda: self.check_archive(job))
+            return
+        self.archive_button.configure(state="normal", text="أرشفة الفواتير القديمة")
+        if job.error:
+            messagebox.showerror("خطأ", f"فشلت عملية الأرشفة.\nالخطأ: {job.error}")
+        else:
+            messagebox.showinfo("نجاح", f"تم نقل {job.result} فاتورة إلى ملفات الأرشيف.")
+
+    def start_backup(self):
+        # النسخ يعمل في الخلفية، والواجهة تتابع انتهاءه كل نصف ثانية
+        store = self.controller.store
+        self.backup_button.configure(state="disabled", text="جاري النسخ...")
+        job = backup.BackupJob(store.db_file, archive_dir=store.archive_dir).start()
+        self.after(500, lambda: self.check_backup(job))
+
+    def check_backup(self, job):
+        if not job.done:
+            self.after(500, lambda: self.check_backup(job))
+            return
+        self.backup_button.configure(state="normal", text="نسخة احتياطية")
+        if job.error:
+            messagebox.showerror("خطأ", f"فشل عمل النسخة الاحتياطية.\nالخطأ: {job.error}")
+        else:
+            messagebox.showinfo("نجاح", f"تم حفظ النسخة الاحتياطية والتحقق منها في:\n{job.result}")
+
     # <<<--- تعديل: الدالة الجديدة لإنشاء نافذة تحديد تاريخ التقرير --- >>>
     def create_admin_report_popup(self):
         popup = ctk.CTkToplevel(self)
@@ -1793,9 +1777,8 @@ class AdminDashboard(ctk.CTkFrame):
             start_date_str = start_date_entry.get()
             end_date_str = end_date_entry.get()
             try:
-                # أضف ساعة النهاية لضمان شمول اليوم بأكمله
                 start_date = datetime.strptime(start_date_str, '%Y-%m-%d')
-                end_date = datetime.strptime(end_date_str, '%Y-%m-%d').replace(hour=23, minute=59, second=59)
+                end_date = datetime.strptime(end_date_str, '%Y-%m-%d')
                 popup.destroy()
                 self.export_admin_report(start_date, end_date)
             except ValueError:
@@ -1808,35 +1791,11 @@ class AdminDashboard(ctk.CTkFrame):
         try:
             from xlsxwriter.utility import xl_rowcol_to_cell
             # الخطوة 1: جلب كل البيانات المطلوبة
-            conn = sqlite3.connect('receipts.db')
-            query = """
-                SELECT
-                    r.id as 'رقم الفاتورة',
-                    strftime('%Y-%m-%d %H:%M', r.timestamp) as 'تاريخ الفاتورة',
-                    c.name as 'اسم العميل',
-                    r.total_amount as 'إجمالي الفاتورة',
-                    r.discount as 'الخصم',
-                    (r.total_amount - r.discount) as 'الصافي',
-                    r.amount_paid as 'المدفوع',
-                    r.remaining_amount as 'المتبقي',
-                    i.name as 'المادة المستخدمة',
-                    jm.quantity_used as 'الكمية المستخدمة',
-                    i.purchase_price as 'سعر شراء الوحدة',
-                    (jm.quantity_used * i.purchase_price) as 'تكلفة المادة'
-                FROM receipts r
-                JOIN customers c ON r.customer_id = c.id
-                LEFT JOIN job_materials jm ON r.id = jm.receipt_id
-                LEFT JOIN inventory i ON jm.inventory_id = i.id
-                WHERE r.timestamp BETWEEN ? AND ?
-                ORDER BY r.timestamp DESC;
-            """
-            df = pd.read_sql_query(query, conn, params=(start_date, end_date))
+            store = self.controller.store
+            df = store.jobs_report(start_date, end_date)
             
             # جلب بيانات المصروفات
-            expenses_df = pd.read_sql_query("""
-                SELECT strftime('%Y-%m-%d', timestamp) as 'التاريخ', description as 'البيان', amount as 'المبلغ' 
-                FROM expenses WHERE timestamp BETWEEN ? AND ?
-            """, conn, params=(start_date, end_date))
+            expenses_df = store.expenses_report(start_date, end_date)
 
             # الخطوة 2: معالجة البيانات وحساب الربحية
             if not df.empty:
@@ -1858,28 +1817,11 @@ class AdminDashboard(ctk.CTkFrame):
             # الخطوة 3: تحليل أفضل العملاء
             now = datetime.now()
             # الأسبوع الحالي
-            start_week = now - timedelta(days=now.weekday())
-            top_customers_week_df = pd.read_sql_query("""
-                SELECT c.name, SUM(r.total_amount - r.discount) as total
-                FROM receipts r JOIN customers c ON r.customer_id = c.id
-                WHERE r.timestamp >= ? GROUP BY c.id ORDER BY total DESC LIMIT 10
-            """, conn, params=(start_week,))
+            top_customers_week_df = store.top_customers(now - timedelta(days=now.weekday()))
             # الشهر الحالي
-            start_month = now.replace(day=1)
-            top_customers_month_df = pd.read_sql_query("""
-                SELECT c.name, SUM(r.total_amount - r.discount) as total
-                FROM receipts r JOIN customers c ON r.customer_id = c.id
-                WHERE r.timestamp >= ? GROUP BY c.id ORDER BY total DESC LIMIT 10
-            """, conn, params=(start_month,))
+            top_customers_month_df = store.top_customers(now.replace(day=1))
             # السنة الحالية
-            start_year = now.replace(day=1, month=1)
-            top_customers_year_df = pd.read_sql_query("""
-                SELECT c.name, SUM(r.total_amount - r.discount) as total
-                FROM receipts r JOIN customers c ON r.customer_id = c.id
-                WHERE r.timestamp >= ? GROUP BY c.id ORDER BY total DESC LIMIT 10
-            """, conn, params=(start_year,))
-
-            conn.close()
+            top_customers_year_df = store.top_customers(now.replace(day=1, month=1))
 
             # الخطوة 4: كتابة البيانات إلى ملف Excel منسق
             filename = f"Admin_Report_{start_date.strftime('%Y-%m-%d')}_to_{end_date.strftime('%Y-%m-%d')}.xlsx"
@@ -2011,13 +1953,8 @@ class Page_Analysis(ctk.CTkFrame):
         for widget in self.bar_chart_frame.winfo_children(): widget.destroy()
         for widget in self.pie_chart_frame.winfo_children(): widget.destroy()
     def populate_year_selector(self):
-        conn = sqlite3.connect('receipts.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT DISTINCT strftime('%Y', timestamp) FROM receipts UNION SELECT DISTINCT strftime('%Y', timestamp) FROM expenses")
-        years = [row[0] for row in cursor.fetchall() if row[0]]
-        conn.close()
-        if years:
-            sorted_years = sorted(years, reverse=True)
+        sorted_years = self.controller.store.available_years()
+        if sorted_years:
             self.year_menu.configure(values=sorted_years)
             self.year_var.set(sorted_years[0])
         else:
@@ -2033,15 +1970,9 @@ class Page_Analysis(ctk.CTkFrame):
         else:
             self.generate_monthly_analysis(selected_year, selected_month)
     def generate_yearly_analysis(self, year):
-        conn = sqlite3.connect('receipts.db')
-        income_query = f"SELECT strftime('%m', timestamp) as month, SUM(total_amount) as income FROM receipts WHERE strftime('%Y', timestamp) = '{year}' GROUP BY month"
-        expenses_query = f"SELECT strftime('%m', timestamp) as month, SUM(amount) as expenses FROM expenses WHERE strftime('%Y', timestamp) = '{year}' GROUP BY month"
-        income_df = pd.read_sql_query(income_query, conn)
-        expenses_df = pd.read_sql_query(expenses_query, conn)
-        conn.close()
+        totals_df = self.controller.store.monthly_totals(year)
         df = pd.DataFrame({'month': [f"{i:02d}" for i in range(1, 13)]})
-        df = pd.merge(df, income_df, on='month', how='left').fillna(0)
-        df = pd.merge(df, expenses_df, on='month', how='left').fillna(0)
+        df = pd.merge(df, totals_df, on='month', how='left').fillna(0)
         df['profit'] = df['income'] - df['expenses']
         df['month_name_ar'] = df['month'].apply(lambda x: self.ARABIC_MONTHS.get(x, ''))
         self.analysis_df = df
@@ -2067,15 +1998,9 @@ class Page_Analysis(ctk.CTkFrame):
     def generate_monthly_analysis(self, year, month):
         month_int = int(month)
         num_days = calendar.monthrange(int(year), month_int)[1]
-        conn = sqlite3.connect('receipts.db')
-        income_query = f"SELECT strftime('%d', timestamp) as day, SUM(total_amount) as income FROM receipts WHERE strftime('%Y-%m', timestamp) = '{year}-{month_int:02d}' GROUP BY day"
-        expenses_query = f"SELECT strftime('%d', timestamp) as day, SUM(amount) as expenses FROM expenses WHERE strftime('%Y-%m', timestamp) = '{year}-{month_int:02d}' GROUP BY day"
-        income_df = pd.read_sql_query(income_query, conn)
-        expenses_df = pd.read_sql_query(expenses_query, conn)
-        conn.close()
+        totals_df = self.controller.store.daily_totals(year, month_int)
         df = pd.DataFrame({'day': [f"{i:02d}" for i in range(1, num_days + 1)]})
-        df = pd.merge(df, income_df, on='day', how='left').fillna(0)
-        df = pd.merge(df, expenses_df, on='day', how='left').fillna(0)
+        df = pd.merge(df, totals_df, on='day', how='left').fillna(0)
         df['profit'] = df['income'] - df['expenses']
         self.analysis_df = df
         self.export_button.configure(state="normal")
@@ -2163,46 +2088,10 @@ class Page_Analysis(ctk.CTkFrame):
         selected_month = self.month_var.get()
         if selected_year in ["اختر السنة", "لا توجد بيانات"]:
             messagebox.showwarning("تنبيه", "الرجاء اختيار سنة أولاً."); return
-        conn = sqlite3.connect('receipts.db')
-        query = f"SELECT receipt_data FROM receipts WHERE strftime('%Y', timestamp) = '{selected_year}'"
-        if selected_month != "كل الشهور":
-            query += f" AND strftime('%m', timestamp) = '{int(selected_month):02d}'"
-        df = pd.read_sql_query(query, conn)
-        conn.close()
-        if df.empty:
+        month = selected_month if selected_month != "كل الشهور" else None
+        sales_df = self.controller.store.product_sales(selected_year, month)
+        if sales_df.empty:
             messagebox.showinfo("لا توجد بيانات", f"لا توجد فواتير مسجلة في هذه الفترة."); return
-        product_sales = {}
-        for _, row in df.iterrows():
-            lines = row['receipt_data'].split('\n')
-            item_section = False
-            for line in lines:
-                if "الصنف" in line and "الكمية" in line:
-                    item_section = True
-                    continue
-                if "====" in line and item_section:
-                    item_section = False
-                    break
-                if item_section and line.strip() and "----" not in line:
-                    parts = [p.strip() for p in line.split(' ') if p]
-                    if len(parts) >= 4:
-                        try:
-                            item_name = ' '.join(parts[:-3])
-                            subtotal = float(parts[-1])
-                            
-                            if item_name in product_sales:
-                                product_sales[item_name]['count'] += 1
-                                product_sales[item_name]['total_value'] += subtotal
-                            else:
-                                product_sales[item_name] = {'count': 1, 'total_value': subtotal}
-                        except (ValueError, IndexError):
-                            continue
-        
-        if not product_sales:
-            messagebox.showinfo("لا توجد بيانات", "لم يتم العثور على بنود منتجات داخل الفواتير."); return
-        sales_df = pd.DataFrame.from_dict(product_sales, orient='index')
-        sales_df.index.name = 'المنتج'
-        sales_df.rename(columns={'count': 'عدد مرات البيع', 'total_value': 'إجمالي الدخل'}, inplace=True)
-        sales_df.sort_values(by='إجمالي الدخل', ascending=False, inplace=True)
         period_str = f"{selected_year}_{selected_month}" if selected_month != "كل الشهور" else selected_year
         filename = f"Product_Analysis_{period_str}.xlsx"
         try:
@@ -2248,46 +2137,143 @@ class Page_CustomerManagement(ctk.CTkFrame):
         left_panel = ctk.CTkFrame(self)
         left_panel.grid(row=1, column=0, sticky="nsew", padx=10, pady=10)
         ctk.CTkEntry(left_panel, placeholder_text="ابحث بالاسم أو التليفون...").pack(fill="x", padx=10, pady=5)
+        self.sort_options = {"ترتيب بالاسم": "name", "الأعلى مديونية": "balance", "الأعلى مشتريات": "lifetime_spend", "آخر زيارة": "last_visit"}
+        self.sort_var = ctk.StringVar(value="ترتيب بالاسم")
+        ctk.CTkOptionMenu(left_panel, variable=self.sort_var, values=list(self.sort_options.keys()),
+                          command=lambda _: self.load_all_customers()).pack(fill="x", padx=10, pady=5)
         self.customer_list_frame = ctk.CTkScrollableFrame(left_panel)
         self.customer_list_frame.pack(fill="both", expand=True, padx=10, pady=5)
         right_panel = ctk.CTkFrame(self)
         right_panel.grid(row=1, column=1, sticky="nsew", padx=10, pady=10)
         self.history_label = ctk.CTkLabel(right_panel, text="تاريخ طلبات العميل", font=("Arial", 18))
         self.history_label.pack(pady=10)
+        self.selected_customer = None
+        self.prices_button = ctk.CTkButton(right_panel, text="الأسعار الخاصة بالعميل", state="disabled",
+                                           command=self.edit_customer_prices)
+        self.prices_button.pack(pady=(0, 5))
         self.history_textbox = ctk.CTkTextbox(right_panel, font=("Courier New", 12))
         self.history_textbox.pack(fill="both", expand=True, padx=10, pady=10)
     def load_all_customers(self):
         for widget in self.customer_list_frame.winfo_children(): widget.destroy()
-        conn = sqlite3.connect('receipts.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, name, phone FROM customers ORDER BY name")
-        customers = cursor.fetchall()
-        conn.close()
-        for customer_id, name, phone in customers:
-            btn_text = f"{name} - {phone}"
+        customers = self.controller.store.list_customers(sort_by=self.sort_options[self.sort_var.get()])
+        for customer_id, name, phone, balance, lifetime_spend, order_count, last_visit in customers:
+            btn_text = f"{name} - {phone}\nطلبات: {order_count} | مشتريات: {format_money(lifetime_spend)} | مديونية: {format_money(balance)}"
             btn = ctk.CTkButton(self.customer_list_frame, text=btn_text,
                                 command=lambda c_id=customer_id, c_name=name: self.show_customer_history(c_id, c_name))
             btn.pack(fill="x", pady=2)
     def show_customer_history(self, customer_id, customer_name):
         self.history_label.configure(text=f"تاريخ طلبات العميل: {customer_name}")
+        self.selected_customer = (customer_id, customer_name)
+        # الأسعار الخاصة (بدل الخصم اليدوي عند الدفع) يعدلها الأدمن فقط
+        self.prices_button.configure(state="normal" if self.controller.current_user == 'admin' else "disabled")
         self.history_textbox.configure(state="normal")
         self.history_textbox.delete("1.0", "end")
-        conn = sqlite3.connect('receipts.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT timestamp, total_amount, receipt_data, remaining_amount FROM receipts WHERE customer_id = ? ORDER BY timestamp DESC", (customer_id,))
-        receipts = cursor.fetchall()
-        conn.close()
+        receipts = self.controller.store.customer_history(customer_id)
         if not receipts:
             self.history_textbox.insert("1.0", "لا يوجد تاريخ طلبات لهذا العميل.")
         else:
-            for ts, amount, data, remaining in receipts:
-                date_str = datetime.strptime(ts, '%Y-%m-%d %H:%M:%S.%f').strftime('%Y-%m-%d %I:%M %p')
-                remaining_str = f" | المتبقي: {remaining:.2f} جنيه" if remaining and remaining > 0 else ""
-                header = f"{'='*10} فاتورة بتاريخ: {date_str} | المبلغ: {amount:.2f} جنيه{remaining_str} {'='*10}\n"
+            for row in receipts:
+                ts, amount, remaining = row[1], row[2], row[5]
+                receipt_text, _ = render_stored_receipt(row)
+                date_str = datetime.fromtimestamp(ts).strftime('%Y-%m-%d %I:%M %p') if ts is not None else "-"
+                remaining_str = f" | المتبقي: {format_money(remaining)} جنيه" if remaining and remaining > 0 else ""
+                header = f"{'='*10} فاتورة بتاريخ: {date_str} | المبلغ: {format_money(amount)} جنيه{remaining_str} {'='*10}\n"
                 self.history_textbox.insert("end", header, "header_tag")
-                self.history_textbox.insert("end", data + "\n\n")
+                self.history_textbox.insert("end", receipt_text + "\n\n")
+        payments = self.controller.store.customer_payments(customer_id)
+        if payments:
+            payment_kinds = {PAYMENT_CHECKOUT: "عند الشراء", PAYMENT_SETTLEMENT: "تسوية عند التسليم", PAYMENT_PARTIAL: "دفعة جزئية"}
+            self.history_textbox.insert("end", f"{'='*10} المدفوعات {'='*10}\n", "header_tag")
+            for paid_at, receipt_id, amount, kind in payments:
+                date_str = datetime.fromtimestamp(paid_at).strftime('%Y-%m-%d %I:%M %p')
+                self.history_textbox.insert("end", f"{date_str} | فاتورة #{receipt_id} | {format_money(amount)} جنيه | {payment_kinds.get(kind, kind)}\n")
         self.history_textbox.tag_config("header_tag", font=("Courier New", 12, "bold"))
         self.history_textbox.configure(state="disabled")
+
+    def edit_customer_prices(self):
+        customer_id, customer_name = self.selected_customer
+        list_prices = pricing.current_prices().config()
+        customer_prices = self.controller.customer_prices.prices_for(customer_id).config()
+        popup = ctk.CTkToplevel(self)
+        popup.title(f"الأسعار الخاصة: {customer_name}")
+        popup.geometry("650x600")
+        popup.transient(self)
+        popup.grab_set()
+        ctk.CTkLabel(popup, text="الأسعار المتفق عليها مع العميل (الأسعار المتروكة كما هي تتبع قائمة الأسعار)",
+                     font=("Arial", 14, "bold")).pack(pady=10)
+        scrollable_frame = ctk.CTkScrollableFrame(popup)
+        scrollable_frame.pack(fill="both", expand=True, padx=10, pady=5)
+        entries = {}
+        brackets = {'large': "كميات كبيرة", 'small': "كميات صغيرة"}
+
+        def price_leaves(value, path, label):
+            if isinstance(value, dict):
+                for key, nested in value.items():
+                    yield from price_leaves(nested, path + (key,), f"{label} {brackets.get(key, key)}".strip())
+            elif isinstance(value, list):
+                # الشرائح [حتى كمية، السعر]: يُعدل السعر فقط
+                for i, (limit, nested) in enumerate(value):
+                    limit_text = "بلا حد" if limit >= pricing.UNLIMITED_TIER else f"حتى {limit}"
+                    yield from price_leaves(nested, path + (i, 1), f"{label} {limit_text}".strip())
+            else:
+                yield path, label, value
+
+        def list_price(path):
+            value = list_prices
+            try:
+                for key in path:
+                    value = value[key]
+            except (KeyError, IndexError, TypeError):
+                return None
+            return value
+
+        sections = [("أسعار طباعة الكوشيه والاستيكر", 'PRINTING_PRICES'), ("الورق العادي (Ink)", 'PLAIN_PAPER_PRICES'),
+                    ("الورق العادي (ليزر)", 'LASER_PLAIN_PAPER_PRICES'), ("كروت ID", 'ID_CARD_PRICING'),
+                    ("البشر A4 (حسب ورق الكتاب)", 'STAPLING_PRICING_A4'), ("البشر A5 (حسب ورق الكتاب)", 'STAPLING_PRICING_A5'),
+                    ("تغليف المنيو الحراري", 'MENU_LAMINATION_PRICING')]
+        for title, section in sections:
+            ctk.CTkLabel(scrollable_frame, text=title, font=ctk.CTkFont(size=16, weight="bold"), anchor="e").pack(fill="x", pady=(10, 5), padx=10)
+            for path, label, value in price_leaves(customer_prices[section], (section,), ""):
+                frame = ctk.CTkFrame(scrollable_frame, fg_color="transparent")
+                frame.pack(fill="x", pady=2)
+                general = list_price(path)
+                text = label if general is None or general == value else f"{label} (السعر العام: {general})"
+                ctk.CTkLabel(frame, text=text, anchor="e").pack(side="right", padx=10, fill="x", expand=True)
+                entry = ctk.CTkEntry(frame, width=100)
+                entry.insert(0, str(value))
+                entry.pack(side="left", padx=10)
+                entries[path] = entry
+
+        def save(overrides):
+            try:
+                self.controller.store.save_customer_prices(customer_id, overrides)
+            except Exception as e:
+                messagebox.showerror("خطأ", f"حدث خطأ أثناء الحفظ: {e}", parent=popup)
+                return
+            # الأسعار المجمعة للعملاء تُعاد من الإعدادات الجديدة عند أول استخدام
+            self.controller.customer_prices.invalidate()
+            popup.destroy()
+            messagebox.showinfo("نجاح", f"تم حفظ الأسعار الخاصة للعميل: {customer_name}\nعدد الأقسام المعدلة: {len(overrides)}")
+
+        def save_entries():
+            edited = copy.deepcopy(customer_prices)
+            try:
+                for path, entry in entries.items():
+                    temp = edited
+                    for key in path[:-1]:
+                        temp = temp[key]
+                    temp[path[-1]] = float(entry.get())
+            except ValueError:
+                messagebox.showerror("خطأ", "الرجاء إدخال أرقام صالحة فقط في حقول الأسعار.", parent=popup)
+                return
+            save(pricing.price_overrides(list_prices, edited))
+
+        button_frame = ctk.CTkFrame(popup, fg_color="transparent")
+        button_frame.pack(pady=10)
+        ctk.CTkButton(button_frame, text="حفظ الأسعار الخاصة", fg_color="#27ae60", hover_color="#2ecc71",
+                      command=save_entries).pack(side="left", padx=10)
+        ctk.CTkButton(button_frame, text="إلغاء الأسعار الخاصة", fg_color="#c0392b", hover_color="#e74c3c",
+                      command=lambda: save({})).pack(side="right", padx=10)
 class Page_JobTracking(ctk.CTkFrame):
     def __init__(self, parent, controller):
         super().__init__(parent)
@@ -2296,19 +2282,12 @@ class Page_JobTracking(ctk.CTkFrame):
         top_frame = ctk.CTkFrame(self, fg_color="transparent")
         top_frame.pack(fill="x", padx=20, pady=5)
         ctk.CTkButton(top_frame, text="تحديث القائمة", command=self.load_open_jobs).pack(side="left")
+        ctk.CTkButton(top_frame, text="تقرير مراحل الإنتاج", command=self.stage_report_popup).pack(side="left", padx=10)
         self.jobs_frame = ctk.CTkScrollableFrame(self)
         self.jobs_frame.pack(fill="both", expand=True, padx=20, pady=10)
     def load_open_jobs(self):
         for widget in self.jobs_frame.winfo_children(): widget.destroy()
-        conn = sqlite3.connect('receipts.db')
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT r.id, c.name, r.due_date, r.status
-            FROM receipts r JOIN customers c ON r.customer_id = c.id
-            WHERE r.status != 'تم التسليم' ORDER BY r.due_date
-        """)
-        jobs = cursor.fetchall()
-        conn.close()
+        jobs = self.controller.store.open_jobs()
         header_frame = ctk.CTkFrame(self.jobs_frame, fg_color="gray20")
         header_frame.pack(fill="x", pady=2)
         ctk.CTkLabel(header_frame, text="رقم الفاتورة", font=("Arial", 12, "bold")).pack(side="right", padx=10, expand=True)
@@ -2316,6 +2295,7 @@ class Page_JobTracking(ctk.CTkFrame):
         ctk.CTkLabel(header_frame, text="تاريخ التسليم", font=("Arial", 12, "bold")).pack(side="right", padx=10, expand=True)
         ctk.CTkLabel(header_frame, text="الحالة الحالية", font=("Arial", 12, "bold")).pack(side="right", padx=10, expand=True)
         ctk.CTkLabel(header_frame, text="تغيير الحالة", font=("Arial", 12, "bold")).pack(side="left", padx=10, expand=True)
+        ctk.CTkLabel(header_frame, text="الفاتورة", font=("Arial", 12, "bold")).pack(side="left", padx=10, expand=True)
         today_str = date.today().strftime('%Y-%m-%d')
         for job_id, customer_name, due_date, status in jobs:
             job_frame = ctk.CTkFrame(self.jobs_frame)
@@ -2329,27 +2309,84 @@ class Page_JobTracking(ctk.CTkFrame):
             status_menu = ctk.CTkOptionMenu(job_frame, variable=status_var, values=ORDER_STATUSES,
                                             command=lambda new_status, j_id=job_id: self.update_job_status(j_id, new_status))
             status_menu.pack(side="left", padx=10, expand=True)
+            ctk.CTkButton(job_frame, text="إعادة طباعة", width=100,
+                          command=lambda j_id=job_id: self.reprint_receipt(j_id)).pack(side="left", padx=10, expand=True)
+    def reprint_receipt(self, job_id):
+        store = self.controller.store
+        row = store.get_receipt(job_id)
+        if row is None:
+            messagebox.showerror("خطأ", "لم يتم العثور على الفاتورة."); return
+        display_text, receipt_data = render_stored_receipt(row)
+        if not receipt_data['items']:
+            # الفواتير القديمة ليس لها بنود في البيانات المحفوظة، فتؤخذ من receipt_items لملفات PDF والصور
+            receipt_data['items'] = [
+                {"description": desc, "quantity": qty, "unit_price": to_pounds(unit_price), "subtotal": to_pounds(subtotal),
+                 "product_type": product_type, "paper_size": paper_size}
+                for desc, qty, unit_price, subtotal, product_type, paper_size in store.receipt_line_items(job_id)
+            ]
+        receipt_page = self.controller.get_frame("Page3_Receipt")
+        receipt_page.update_receipt_data(display_text, receipt_data)
+        self.controller.show_frame("Page3_Receipt")
     def update_job_status(self, job_id, new_status):
-        conn = sqlite3.connect('receipts.db')
-        cursor = conn.cursor()
-        if new_status == "تم التسليم":
-            cursor.execute("SELECT remaining_amount FROM receipts WHERE id = ?", (job_id,))
-            remaining = cursor.fetchone()[0]
+        store = self.controller.store
+        settle_debt = False
+        if new_status == DELIVERED_STATUS:
+            remaining = store.get_receipt_remaining(job_id)
             if remaining > 0:
                 if messagebox.askyesno("تأكيد تسوية الدين", 
-                                       f"يوجد مبلغ متبقي قدره {remaining:.2f} جنيه على هذه الفاتورة.\nهل تم استلام المبلغ بالكامل؟"):
-                    cursor.execute("""
-                        UPDATE receipts 
-                        SET amount_paid = amount_paid + remaining_amount, 
-                            remaining_amount = 0
-                        WHERE id = ?
-                    """, (job_id,))
-                    messagebox.showinfo("نجاح", "تمت تسوية الدين بنجاح.")
-        cursor.execute("UPDATE receipts SET status = ? WHERE id = ?", (new_status, job_id))
-        conn.commit()
-        conn.close()
+                                       f"يوجد مبلغ متبقي قدره {format_money(remaining)} جنيه على هذه الفاتورة.\nهل تم استلام المبلغ بالكامل؟"):
+                    settle_debt = True
+        store.update_job_status(job_id, new_status, settle_debt=settle_debt)
+        if settle_debt:
+            messagebox.showinfo("نجاح", "تمت تسوية الدين بنجاح.")
         self.load_open_jobs()
         self.controller.get_frame("AdminDashboard").load_daily_summary()
+    def stage_report_popup(self):
+        popup = ctk.CTkToplevel(self)
+        popup.title("تقرير مراحل الإنتاج")
+        popup.geometry("400x250")
+        popup.transient(self)
+        popup.grab_set()
+        today = date.today()
+        ctk.CTkLabel(popup, text="تاريخ البدء (YYYY-MM-DD):", font=("Arial", 14)).pack(pady=(15, 5))
+        start_date_entry = ctk.CTkEntry(popup, width=300)
+        start_date_entry.insert(0, (today - timedelta(days=30)).strftime('%Y-%m-%d'))
+        start_date_entry.pack()
+        ctk.CTkLabel(popup, text="تاريخ الانتهاء (YYYY-MM-DD):", font=("Arial", 14)).pack(pady=(10, 5))
+        end_date_entry = ctk.CTkEntry(popup, width=300)
+        end_date_entry.insert(0, today.strftime('%Y-%m-%d'))
+        end_date_entry.pack()
+
+        def generate():
+            try:
+                start_date = datetime.strptime(start_date_entry.get(), '%Y-%m-%d')
+                end_date = datetime.strptime(end_date_entry.get(), '%Y-%m-%d')
+            except ValueError:
+                messagebox.showerror("خطأ", "الرجاء إدخال التاريخ بالصيغة الصحيحة YYYY-MM-DD.", parent=popup)
+                return
+            popup.destroy()
+            self.export_stage_report(start_date, end_date)
+
+        ctk.CTkButton(popup, text="إنشاء التقرير", command=generate).pack(pady=20)
+    def export_stage_report(self, start_date, end_date):
+        # المدد محسوبة مسبقاً عند كل تغيير حالة (job_stage_daily)، فلا يُعاد فحص سجل المراحل
+        store = self.controller.store
+        try:
+            stages_df = store.job_stage_summary(start_date, end_date)
+            stage_order = {status: i for i, status in enumerate(ORDER_STATUSES)}
+            stages_df = stages_df.sort_values('status', key=lambda col: col.map(stage_order).fillna(len(stage_order)))
+            stages_df['avg_hours'] = stages_df['avg_hours'].round(1)
+            stages_df.columns = ['المرحلة', 'دخلت المرحلة', 'خرجت من المرحلة', 'متوسط المدة (ساعة)']
+            throughput_df = store.job_throughput(start_date, end_date)
+            throughput_df.columns = ['اليوم', 'طلبات مستلمة', 'طلبات مسلمة']
+            filename = f"Stages_Report_{start_date.strftime('%Y-%m-%d')}_to_{end_date.strftime('%Y-%m-%d')}.xlsx"
+            with pd.ExcelWriter(filename, engine='xlsxwriter') as writer:
+                stages_df.to_excel(writer, sheet_name='مدة المراحل', index=False)
+                throughput_df.to_excel(writer, sheet_name='الإنتاجية اليومية', index=False)
+            messagebox.showinfo("نجاح", f"تم إنشاء تقرير مراحل الإنتاج بنجاح!\nتم حفظه باسم: {filename}")
+            os.startfile(filename)
+        except Exception as e:
+            messagebox.showerror("خطأ غير متوقع", f"حدث خطأ أثناء إنشاء التقرير: {e}")
 class Page_DebtsTracking(ctk.CTkFrame):
     def __init__(self, parent, controller):
         super().__init__(parent)
@@ -2362,39 +2399,45 @@ class Page_DebtsTracking(ctk.CTkFrame):
         self.debts_frame.pack(fill="both", expand=True, padx=20, pady=10)
     def load_debts(self):
         for widget in self.debts_frame.winfo_children(): widget.destroy()
-        conn = sqlite3.connect('receipts.db')
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT c.id, c.name, c.phone, SUM(r.remaining_amount), COUNT(r.id)
-            FROM customers c JOIN receipts r ON c.id = r.customer_id
-            WHERE r.remaining_amount > 0.01
-            GROUP BY c.id
-            ORDER BY SUM(r.remaining_amount) DESC
-        """)
-        debts = cursor.fetchall()
-        conn.close()
+        # أعمار الديون تُقرأ من view الـ debt_aging (فهرس الفواتير المفتوحة فقط)
+        debts = self.controller.store.debt_aging()
         header_frame = ctk.CTkFrame(self.debts_frame, fg_color="gray20")
         header_frame.pack(fill="x", pady=2)
-        ctk.CTkLabel(header_frame, text="اسم العميل", font=("Arial", 12, "bold")).pack(side="right", padx=10, expand=True)
-        ctk.CTkLabel(header_frame, text="رقم التليفون", font=("Arial", 12, "bold")).pack(side="right", padx=10, expand=True)
-        ctk.CTkLabel(header_frame, text="إجمالي المديونية", font=("Arial", 12, "bold")).pack(side="right", padx=10, expand=True)
-        ctk.CTkLabel(header_frame, text="عدد الفواتير المفتوحة", font=("Arial", 12, "bold")).pack(side="right", padx=10, expand=True)
+        for title in ["اسم العميل", "رقم التليفون", "إجمالي المديونية", "0-30 يوم", "31-60 يوم", "61-90 يوم", "أكثر من 90 يوم", "عدد الفواتير المفتوحة"]:
+            ctk.CTkLabel(header_frame, text=title, font=("Arial", 12, "bold")).pack(side="right", padx=10, expand=True)
         ctk.CTkLabel(header_frame, text="إجراء", font=("Arial", 12, "bold")).pack(side="left", padx=10, expand=True)
-        for customer_id, name, phone, total_remaining, count in debts:
+        for customer_id, name, phone, total_remaining, count, *buckets in debts:
             debt_frame = ctk.CTkFrame(self.debts_frame)
             debt_frame.pack(fill="x", pady=2)
             ctk.CTkLabel(debt_frame, text=name).pack(side="right", padx=10, expand=True)
             ctk.CTkLabel(debt_frame, text=phone).pack(side="right", padx=10, expand=True)
-            ctk.CTkLabel(debt_frame, text=f"{total_remaining:.2f} جنيه", font=("Arial", 12, "bold"), text_color="tomato").pack(side="right", padx=10, expand=True)
+            ctk.CTkLabel(debt_frame, text=f"{format_money(total_remaining)} جنيه", font=("Arial", 12, "bold"), text_color="tomato").pack(side="right", padx=10, expand=True)
+            for bucket_amount in buckets:
+                ctk.CTkLabel(debt_frame, text=format_money(bucket_amount) if bucket_amount else "-").pack(side="right", padx=10, expand=True)
             ctk.CTkLabel(debt_frame, text=str(count)).pack(side="right", padx=10, expand=True)
             ctk.CTkButton(debt_frame, text="عرض التفاصيل", width=100, command=lambda c_id=customer_id: self.show_customer_details(c_id)).pack(side="left", padx=10, expand=True)
+            ctk.CTkButton(debt_frame, text="تسجيل دفعة", width=100, fg_color="#27AE60", hover_color="#229954",
+                          command=lambda c_id=customer_id, c_name=name: self.record_payment_popup(c_id, c_name)).pack(side="left", padx=10, expand=True)
+    def record_payment_popup(self, customer_id, customer_name):
+        amount_str = simpledialog.askstring("تسجيل دفعة", f"المبلغ المدفوع من {customer_name}:", parent=self)
+        if not amount_str:
+            return
+        try:
+            amount = to_piastres(amount_str)
+            if amount <= 0: raise ValueError
+        except (ValueError, ArithmeticError):
+            messagebox.showerror("خطأ", "الرجاء إدخال مبلغ صحيح.")
+            return
+        # الدفعة تُوزع على الفواتير المفتوحة من الأقدم للأحدث
+        applied = self.controller.store.record_payment(customer_id, amount)
+        message = f"تم تسجيل دفعة بمبلغ {format_money(applied)} جنيه."
+        if applied < amount:
+            message += f"\nالمبلغ أكبر من المديونية، لم يُسجل الباقي ({format_money(amount - applied)} جنيه)."
+        messagebox.showinfo("نجاح", message)
+        self.load_debts()
     def show_customer_details(self, customer_id):
         customer_page = self.controller.get_frame("Page_CustomerManagement")
-        conn = sqlite3.connect('receipts.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT name FROM customers WHERE id = ?", (customer_id,))
-        customer_name = cursor.fetchone()[0]
-        conn.close()
+        customer_name = self.controller.store.get_customer_name(customer_id)
         customer_page.show_customer_history(customer_id, customer_name)
         self.controller.show_frame("Page_CustomerManagement")
 # <<<--- تم التعديل على هذا الكلاس بالكامل (Page_InventoryManagement) --- >>>
@@ -2413,6 +2456,7 @@ class Page_InventoryManagement(ctk.CTkFrame):
         ctk.CTkButton(top_frame, text="إضافة مادة جديدة", command=self.add_product_popup).pack(side="left", padx=10)
         ctk.CTkButton(top_frame, text="تعديل المادة المحددة", command=self.edit_selected_product_popup).pack(side="left", padx=10)
         ctk.CTkButton(top_frame, text="تحديث القائمة", command=self.load_inventory).pack(side="left", padx=10)
+        ctk.CTkButton(top_frame, text="تقرير حركة المخزون", command=self.stock_report_popup).pack(side="left", padx=10)
 
         tree_frame = ctk.CTkFrame(self)
         tree_frame.grid(row=1, column=0, sticky="nsew", padx=20, pady=10)
@@ -2451,11 +2495,7 @@ class Page_InventoryManagement(ctk.CTkFrame):
         for item in self.tree.get_children():
             self.tree.delete(item)
 
-        conn = sqlite3.connect('receipts.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, name, unit, stock_level, low_stock_threshold, purchase_price FROM inventory ORDER BY name")
-        items = cursor.fetchall()
-        conn.close()
+        items = self.controller.store.list_inventory()
 
         for item in items:
             item_id, name, unit, stock, threshold, price = item
@@ -2463,7 +2503,7 @@ class Page_InventoryManagement(ctk.CTkFrame):
             if stock <= threshold:
                 tags = ('low_stock',)
             
-            price_str = f"{price:.2f} ج.م"
+            price_str = f"{format_money(price)} ج.م"
             # <<<--- تعديل: إضافة سعر الشراء للقيم --- >>>
             self.tree.insert("", "end", values=(price_str, stock, unit, name, item_id), tags=tags)
         
@@ -2488,11 +2528,7 @@ class Page_InventoryManagement(ctk.CTkFrame):
         selected_item = self.tree.item(item_id)
         price_str, stock, unit, name, db_id = selected_item['values']
         
-        conn = sqlite3.connect('receipts.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM inventory WHERE id = ?", (db_id,))
-        product_data = cursor.fetchone()
-        conn.close()
+        product_data = self.controller.store.get_inventory_item(db_id)
         
         self.product_form_popup(is_edit=True, data=product_data)
         
@@ -2531,7 +2567,7 @@ class Page_InventoryManagement(ctk.CTkFrame):
             name_entry.insert(0, data[1])
             unit_entry.insert(0, data[2])
             threshold_entry.insert(0, str(data[4]))
-            price_entry.insert(0, str(data[5]))
+            price_entry.insert(0, format_money(data[5]))
 
         def save_product():
             name = name_entry.get().strip()
@@ -2547,30 +2583,20 @@ class Page_InventoryManagement(ctk.CTkFrame):
             try:
                 stock = float(stock_str)
                 threshold = float(threshold_str)
-                price = float(price_str)
-            except (ValueError, TypeError):
+                price = to_piastres(price_str)
+            except (ValueError, TypeError, ArithmeticError):
                 messagebox.showerror("خطأ", "الكمية والسعر وحد التنبيه يجب أن تكون أرقاماً.", parent=popup)
                 return
             
             try:
-                conn = sqlite3.connect('receipts.db')
-                cursor = conn.cursor()
                 if is_edit:
-                    cursor.execute("""
-                        UPDATE inventory SET name=?, unit=?, low_stock_threshold=?, purchase_price=? 
-                        WHERE id = ?
-                    """, (name, unit, threshold, price, data[0]))
+                    self.controller.store.update_inventory_item(data[0], name, unit, threshold, price)
                 else:
-                    cursor.execute("""
-                        INSERT INTO inventory (name, unit, stock_level, low_stock_threshold, purchase_price) 
-                        VALUES (?, ?, ?, ?, ?)
-                    """, (name, unit, stock, threshold, price))
-                conn.commit()
-                conn.close()
+                    self.controller.store.add_inventory_item(name, unit, stock, threshold, price)
                 messagebox.showinfo("نجاح", f"تم حفظ بيانات المادة بنجاح.", parent=popup)
                 self.load_inventory()
                 popup.destroy()
-            except sqlite3.IntegrityError:
+            except DuplicateRecordError:
                 messagebox.showerror("خطأ", "هذا الاسم موجود بالفعل في المخزون.", parent=popup)
             except Exception as e:
                 messagebox.showerror("خطأ", f"حدث خطأ غير متوقع: {e}", parent=popup)
@@ -2580,12 +2606,16 @@ class Page_InventoryManagement(ctk.CTkFrame):
     def adjust_stock_popup(self, item_id, item_name, current_stock):
         popup = ctk.CTkToplevel(self)
         popup.title(f"إضافة مخزون لـ: {item_name}")
-        popup.geometry("400x250")
+        popup.geometry("400x320")
         popup.transient(self)
         popup.grab_set()
 
         ctk.CTkLabel(popup, text=f"الكمية الحالية: {current_stock}", font=("Arial", 16)).pack(pady=15)
-        ctk.CTkLabel(popup, text="أدخل الكمية *للإضافة* إلى المخزون:", font=("Arial", 14)).pack(pady=(10, 5))
+        # الشراء يضيف فقط، والتسوية (جرد أو تالف) تقبل كمية بالسالب
+        movement_kinds = {"شراء": STOCK_PURCHASE, "تسوية (جرد / تالف)": STOCK_ADJUSTMENT}
+        kind_var = ctk.StringVar(value="شراء")
+        ctk.CTkOptionMenu(popup, variable=kind_var, values=list(movement_kinds.keys())).pack()
+        ctk.CTkLabel(popup, text="أدخل الكمية *للإضافة* إلى المخزون (بالسالب للخصم في التسوية):", font=("Arial", 14)).pack(pady=(10, 5))
         
         add_entry = ctk.CTkEntry(popup, width=300, placeholder_text="0.0")
         add_entry.pack()
@@ -2596,18 +2626,16 @@ class Page_InventoryManagement(ctk.CTkFrame):
                 popup.destroy()
                 return
 
+            kind = movement_kinds[kind_var.get()]
             try:
                 quantity_to_add = float(add_str)
+                if kind == STOCK_PURCHASE and quantity_to_add <= 0: raise ValueError
             except (ValueError, TypeError):
                 messagebox.showerror("خطأ", "الرجاء إدخال رقم صحيح.", parent=popup)
                 return
 
             try:
-                conn = sqlite3.connect('receipts.db')
-                cursor = conn.cursor()
-                cursor.execute("UPDATE inventory SET stock_level = stock_level + ? WHERE id = ?", (quantity_to_add, item_id))
-                conn.commit()
-                conn.close()
+                self.controller.store.add_stock(item_id, quantity_to_add, kind=kind)
                 messagebox.showinfo("نجاح", "تم تحديث كمية المخزون.", parent=popup)
                 self.load_inventory()
                 popup.destroy()
@@ -2616,6 +2644,45 @@ class Page_InventoryManagement(ctk.CTkFrame):
 
         ctk.CTkButton(popup, text="تحديث الكمية", command=update_stock).pack(pady=20)
 
+    def stock_report_popup(self):
+        popup = ctk.CTkToplevel(self)
+        popup.title("تقرير حركة المخزون")
+        popup.geometry("400x250")
+        popup.transient(self)
+        popup.grab_set()
+        today = date.today()
+        ctk.CTkLabel(popup, text="تاريخ البدء (YYYY-MM-DD):", font=("Arial", 14)).pack(pady=(15, 5))
+        start_date_entry = ctk.CTkEntry(popup, width=300)
+        start_date_entry.insert(0, today.replace(day=1).strftime('%Y-%m-%d'))
+        start_date_entry.pack()
+        ctk.CTkLabel(popup, text="تاريخ الانتهاء (YYYY-MM-DD):", font=("Arial", 14)).pack(pady=(10, 5))
+        end_date_entry = ctk.CTkEntry(popup, width=300)
+        end_date_entry.insert(0, today.strftime('%Y-%m-%d'))
+        end_date_entry.pack()
+
+        def generate():
+            try:
+                start_date = datetime.strptime(start_date_entry.get(), '%Y-%m-%d')
+                end_date = datetime.strptime(end_date_entry.get(), '%Y-%m-%d')
+            except ValueError:
+                messagebox.showerror("خطأ", "الرجاء إدخال التاريخ بالصيغة الصحيحة YYYY-MM-DD.", parent=popup)
+                return
+            popup.destroy()
+            self.export_stock_report(start_date, end_date)
+
+        ctk.CTkButton(popup, text="إنشاء التقرير", command=generate).pack(pady=20)
+
+    def export_stock_report(self, start_date, end_date):
+        # الرصيد في بداية ونهاية الفترة يُقرأ من لقطات الرصيد الشهرية وحركات ما بعدها
+        try:
+            report_df = self.controller.store.stock_movement_report(start_date, end_date)
+            filename = f"Stock_Report_{start_date.strftime('%Y-%m-%d')}_to_{end_date.strftime('%Y-%m-%d')}.xlsx"
+            report_df.to_excel(filename, sheet_name='حركة المخزون', index=False)
+            messagebox.showinfo("نجاح", f"تم إنشاء تقرير حركة المخزون بنجاح!\nتم حفظه باسم: {filename}")
+            os.startfile(filename)
+        except Exception as e:
+            messagebox.showerror("خطأ غير متوقع", f"حدث خطأ أثناء إنشاء التقرير: {e}")
+
 
 # ... (كلاس Page_PriceManagement يبقى كما هو) ...
 class Page_PriceManagement(ctk.CTkFrame):
@@ -2637,6 +2704,9 @@ class Page_PriceManagement(ctk.CTkFrame):
                       fg_color="#27ae60", hover_color="#2ecc71", command=self.save_changes).pack(side="left", padx=10)
         ctk.CTkButton(bottom_frame, text="إعادة تعيين للأسعار الافتراضية", font=("Arial", 14),
                       fg_color="#e67e22", hover_color="#d35400", command=self.reset_to_defaults).pack(side="left", padx=10)
+        self.simulate_button = ctk.CTkButton(bottom_frame, text="محاكاة أثر الأسعار", font=("Arial", 14),
+                                             command=self.simulate_prices)
+        self.simulate_button.pack(side="right", padx=10)
         
         # self.populate_prices() # Will be called by show_frame
 
@@ -2644,7 +2714,8 @@ class Page_PriceManagement(ctk.CTkFrame):
         for widget in self.scrollable_frame.winfo_children():
             widget.destroy()
 
-        self.prices_data = config_manager.load_prices()
+        # نسخة قابلة للتعديل من الأسعار المطبقة حالياً، بدل قراءة الملف من القرص في كل مرة
+        self.prices_data = pricing.current_prices().config()
         self.price_entries = {}
         row_counter = 0
 
@@ -2722,18 +2793,25 @@ class Page_PriceManagement(ctk.CTkFrame):
             
             row_counter += 1
 
+    def entered_prices(self, prices_data):
+        """Writes the values typed in the entries into prices_data and returns it; ValueError if one is not a number."""
+        for path, entry in self.price_entries.items():
+            new_value = float(entry.get())
+
+            temp = prices_data
+            for key in path[:-1]:
+                temp = temp[key]
+            temp[path[-1]] = new_value
+        return prices_data
+
     def save_changes(self):
         try:
-            for path, entry in self.price_entries.items():
-                new_value = float(entry.get())
-                
-                temp = self.prices_data
-                for key in path[:-1]:
-                    temp = temp[key]
-                temp[path[-1]] = new_value
+            self.entered_prices(self.prices_data)
 
+            # تُجمع النسخة الجديدة أولاً، فإذا فشلت تبقى الأسعار الحالية ولا يُكتب الملف؛ وإلا تُحفظ كإصدار جديد
+            self.controller.price_history.publish(self.prices_data)
             config_manager.save_prices(self.prices_data)
-            messagebox.showinfo("نجاح", "تم حفظ الأسعار بنجاح!\nيرجى إعادة تشغيل البرنامج لتطبيق التغييرات.")
+            messagebox.showinfo("نجاح", "تم حفظ الأسعار بنجاح!\nالأسعار الجديدة مطبقة على الطلبات من الآن.")
         except ValueError:
             messagebox.showerror("خطأ", "الرجاء إدخال أرقام صالحة فقط في حقول الأسعار.")
         except Exception as e:
@@ -2742,16 +2820,74 @@ class Page_PriceManagement(ctk.CTkFrame):
     def reset_to_defaults(self):
         if messagebox.askyesno("تأكيد", "هل أنت متأكد من رغبتك في إعادة كل الأسعار إلى الوضع الافتراضي؟"):
             default_prices = config_manager.get_default_prices()
+            # إعداد قاعدة البيانات ليس من الأسعار، فلا يُعاد للوضع الافتراضي
+            default_prices['DATABASE'] = self.prices_data.get('DATABASE', default_prices['DATABASE'])
+            self.controller.price_history.publish(default_prices)
             config_manager.save_prices(default_prices)
             self.populate_prices()
-            messagebox.showinfo("نجاح", "تمت استعادة الأسعار الافتراضية.\nيرجى إعادة تشغيل البرنامج.")
+            messagebox.showinfo("نجاح", "تمت استعادة الأسعار الافتراضية وتطبيقها.")
+
+    def simulate_prices(self):
+        # الأسعار المكتوبة تُجرب على مبيعات الفترة دون حفظها أو تطبيقها
+        try:
+            candidate = self.entered_prices(pricing.current_prices().config())
+        except ValueError:
+            messagebox.showerror("خطأ", "الرجاء إدخال أرقام صالحة فقط في حقول الأسعار.")
+            return
+        days = simpledialog.askinteger("محاكاة أثر الأسعار", "تطبيق الأسعار المكتوبة على مبيعات آخر كم يوم؟",
+                                       initialvalue=repricing.DEFAULT_DAYS, minvalue=1, parent=self)
+        if days is None:
+            return
+        today = date.today()
+        history = self.controller.price_history
+        try:
+            # إصدارات سجلتها فروع أخرى على نفس قاعدة البيانات
+            history.reload()
+            lines, legacy_receipts, sale_prices, customer_overrides = repricing.load_history(
+                self.controller.store, history, today - timedelta(days=days - 1), today)
+        except Exception as e:
+            messagebox.showerror("خطأ", f"تعذر قراءة المبيعات السابقة.\nالخطأ: {e}")
+            return
+        # إعادة التسعير تعمل في الخلفية، والواجهة تتابع انتهاءها كل نصف ثانية
+        self.simulate_button.configure(state="disabled", text="جاري المحاكاة...")
+        job = repricing.RepricingJob(sale_prices, candidate, lines, legacy_receipts, customer_overrides).start()
+        self.after(500, lambda: self.check_simulation(job, days))
+
+    def check_simulation(self, job, days):
+        if not job.done:
+            self.after(500, lambda: self.check_simulation(job, days))
+            return
+        self.simulate_button.configure(state="normal", text="محاكاة أثر الأسعار")
+        if job.error:
+            messagebox.showerror("خطأ", f"فشلت محاكاة الأسعار.\nالخطأ: {job.error}")
+            return
+        by_product, totals = job.result
+        change = "" if pd.isna(totals['delta_pct']) else f" ({totals['delta_pct']:+.1f}%)"
+        summary = (f"مبيعات آخر {days} يوم ({int(totals['lines'])} بند):\n"
+                   f"الدخل الفعلي: {format_money(to_piastres(totals['actual']))} ج.م\n"
+                   f"بالأسعار المكتوبة: {format_money(to_piastres(totals['candidate']))} ج.م\n"
+                   f"الفرق: {format_money(to_piastres(totals['delta']))} ج.م{change}\n"
+                   f"بنود بقيت بسعرها الفعلي (سعر يدوي أو غير معروف): {int(totals['unmatched'])}")
+        if not messagebox.askyesno("نتيجة المحاكاة", summary + "\n\nهل تريد حفظ التقرير التفصيلي لكل منتج؟"):
+            return
+        filename = f"Price_Simulation_{date.today().strftime('%Y-%m-%d')}.xlsx"
+        try:
+            repricing.export_simulation(by_product, totals, filename)
+            messagebox.showinfo("نجاح", f"تم حفظ تقرير المحاكاة باسم: {filename}")
+            os.startfile(filename)
+        except Exception as e:
+            messagebox.showerror("خطأ", f"حدث خطأ أثناء حفظ التقرير: {e}")
 # ==============================================================================
 # 7. تشغيل التطبيق
 # ==============================================================================
 if __name__ == "__main__":
-    init_database()
+    store = open_store(CONFIG.get('DATABASE'))
+    store.init_schema()
+    # لقطة رصيد المخزون لبداية الشهر الحالي (مرة واحدة في الشهر)
+    store.take_stock_snapshot()
     ctk.set_appearance_mode("dark")
     ctk.set_default_color_theme("dark-blue")
     
-    app = CashierApp()
-    app.mainloop()
\ No newline at end of file
+    app = CashierApp(store)
+    app.mainloop()
+    store.close()
\ No newline at end of file
@@ -12,6 +12,11 @@ def get_default_prices():
     """
     return {
         'USERS': {"admin": "1234", "ahmed": "5678"},
+        # قاعدة البيانات: 'sqlite' (ملف receipts.db المحلي) أو 'postgresql' لخادم مشترك بين أجهزة الفرع
+        'DATABASE': {
+            'BACKEND': 'sqlite', 'SQLITE_FILE': 'receipts.db',
+            'POSTGRES_DSN': '', 'POOL_MIN_CONNECTIONS': 1, 'POOL_MAX_CONNECTIONS': 5,
+        },
         'ORDER_STATUSES': [
             "تم الاستلام", "في مرحلة التصميم", "جاهز للطباعة", "جاري الطباعة",
             "في مرحلة التشطيب", "جاهز للتسليم", "تم التسليم"
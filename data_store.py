@@ -0,0 +1,591 @@
+# data_store.py
+
+import json
+import os
+import sqlite3
+from datetime import date, datetime
+from pathlib import Path
+
+import pandas as pd
+
+import archive
+import maintenance
+import migrations
+from money import pounds_sql, to_piastres
+from storage import (CUSTOMER_SORT_ORDERS, DELIVERED_STATUS, NEW_JOB_STATUS, PAYMENT_CHECKOUT, PAYMENT_PARTIAL, PAYMENT_SETTLEMENT, RECEIPT_COLUMNS,
+                     STOCK_ADJUSTMENT, STOCK_CONSUMPTION, STOCK_OPENING, STOCK_PURCHASE, ArchivingBackend, DuplicateRecordError,
+                     StorageBackend, day_key, day_range, month_range, month_start, price_ref_text, year_range,
+                     timestamp_columns)
+
+DB_FILE = 'receipts.db'
+
+# إعدادات الاتصال الدائم بقاعدة البيانات
+BUSY_TIMEOUT_MS = 5000
+CACHED_STATEMENTS = 256
+MMAP_SIZE = 256 * 1024 * 1024
+
+# اتصال التقارير للقراءة فقط، بذاكرة mmap أكبر لأنه يقرأ جداول كاملة
+REPORT_MMAP_SIZE = 1024 * 1024 * 1024
+
+
+# ==============================================================================
+# طبقة الوصول للبيانات
+# ==============================================================================
+class DataStore(ArchivingBackend, StorageBackend):
+    """
+    The default StorageBackend (see storage.py). Owns the application's single
+    long-lived SQLite connection and exposes every
+    query the pages need as a named method.
+
+    The connection runs in WAL mode so readers never block the checkout writer,
+    and statements are cached across calls instead of being re-prepared by a new
+    connection in every page method.
+
+    Money is stored as integer piastres (see money.py): amounts passed to and
+    returned by these methods are piastres, except the report DataFrames which are
+    already converted to pounds for Excel and the charts.
+
+    Old closed receipts may live in yearly archive files (see archive.py); the
+    report methods attach them when the requested range needs them.
+
+    Report and analysis queries run on a separate read-only connection, so a long
+    export only reads a WAL snapshot and never holds a lock the checkout needs.
+    """
+
+    supports_backup = True
+    supports_maintenance = True
+
+    def __init__(self, db_file=DB_FILE):
+        self.db_file = db_file
+        self.archive_dir = archive.archive_dir_for(db_file)
+        self.conn = sqlite3.connect(db_file, cached_statements=CACHED_STATEMENTS)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+        self.conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+        self._report_conn = None
+
+    @property
+    def report_conn(self):
+        """Read-only (mode=ro, query_only) connection for reports, opened on first use after migrations ran."""
+        if self._report_conn is None:
+            self._report_conn = sqlite3.connect(Path(os.path.abspath(self.db_file)).as_uri() + "?mode=ro", uri=True,
+                                                cached_statements=CACHED_STATEMENTS)
+            self._report_conn.execute("PRAGMA query_only=ON")
+            self._report_conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+            self._report_conn.execute(f"PRAGMA mmap_size={REPORT_MMAP_SIZE}")
+        return self._report_conn
+
+    def close(self):
+        if self._report_conn is not None:
+            self._report_conn.close()
+        self.conn.close()
+
+    # --------------------------------------------------------------------------
+    # إعداد الجداول
+    # --------------------------------------------------------------------------
+    def init_schema(self, progress=print):
+        """Runs any pending versioned migrations (see migrations.py), then switches the file to incremental auto_vacuum."""
+        version = migrations.run_migrations(self.conn, progress=progress)
+        # VACUUM الكامل مرة واحدة فقط، خارج معاملات الترحيل وقبل ظهور الواجهة
+        result = maintenance.enable_incremental_vacuum(self.conn)
+        if result is not None:
+            progress(f"Database setup: {result}")
+        return version
+
+    # --------------------------------------------------------------------------
+    # العملاء
+    # --------------------------------------------------------------------------
+    def find_customer_by_phone(self, phone):
+        return self.conn.execute("SELECT id, name FROM customers WHERE phone = ?", (phone,)).fetchone()
+
+    def add_customer(self, name, phone, notes):
+        """Inserts a customer and returns its id. Raises DuplicateRecordError for a duplicate phone."""
+        try:
+            with self.conn:
+                cursor = self.conn.execute("INSERT INTO customers (name, phone, notes) VALUES (?, ?, ?)", (name, phone, notes))
+                self.conn.execute("INSERT INTO customer_stats (customer_id) VALUES (?)", (cursor.lastrowid,))
+        except sqlite3.IntegrityError as e:
+            raise DuplicateRecordError(str(e)) from e
+        return cursor.lastrowid
+
+    def get_customer_name(self, customer_id):
+        row = self.conn.execute("SELECT name FROM customers WHERE id = ?", (customer_id,)).fetchone()
+        return row[0] if row else None
+
+    def get_customer_phone(self, customer_id):
+        row = self.conn.execute("SELECT phone FROM customers WHERE id = ?", (customer_id,)).fetchone()
+        return row[0] if row else ''
+
+    def list_customers(self, sort_by='name'):
+        """Returns (id, name, phone, balance, lifetime_spend, order_count, last_visit) rows, ordered by one of CUSTOMER_SORT_ORDERS."""
+        return self.conn.execute(f"""
+            SELECT c.id, c.name, c.phone, IFNULL(s.balance, 0), IFNULL(s.lifetime_spend, 0), IFNULL(s.order_count, 0), s.last_visit
+            FROM customers c LEFT JOIN customer_stats s ON s.customer_id = c.id
+            ORDER BY {CUSTOMER_SORT_ORDERS[sort_by]}
+        """).fetchall()
+
+    def customer_history(self, customer_id):
+        """Returns the customer's receipts as RECEIPT_COLUMNS rows, newest first."""
+        return self.conn.execute(f"""
+            SELECT {RECEIPT_COLUMNS}
+            FROM receipts r LEFT JOIN customers c ON c.id = r.customer_id
+            WHERE r.customer_id = ? ORDER BY r.ts_epoch DESC
+        """, (customer_id,)).fetchall()
+
+    def customer_debts(self):
+        return self.conn.execute("""
+            SELECT c.id, c.name, c.phone, s.balance, s.open_debt_count
+            FROM customer_stats s JOIN customers c ON c.id = s.customer_id
+            WHERE s.balance > 0
+            ORDER BY s.balance DESC
+        """).fetchall()
+
+    def debt_aging(self):
+        return self.conn.execute("""
+            SELECT c.id, c.name, c.phone, a.total, a.open_count, a.days_0_30, a.days_31_60, a.days_61_90, a.days_over_90
+            FROM debt_aging a JOIN customers c ON c.id = a.customer_id
+            ORDER BY a.total DESC
+        """).fetchall()
+
+    def customer_payments(self, customer_id):
+        return self.conn.execute("""
+            SELECT paid_at, receipt_id, amount, kind FROM payments
+            WHERE customer_id = ? ORDER BY paid_at DESC, id DESC
+        """, (customer_id,)).fetchall()
+
+    def record_payment(self, customer_id, amount):
+        now = datetime.now()
+        left = amount
+        closed = 0
+        with self.conn:
+            cursor = self.conn.cursor()
+            open_receipts = cursor.execute("""
+                SELECT id, remaining_amount FROM receipts
+                WHERE customer_id = ? AND remaining_amount > 0 ORDER BY local_day, id
+            """, (customer_id,)).fetchall()
+            for receipt_id, remaining in open_receipts:
+                if left <= 0:
+                    break
+                part = min(left, remaining)
+                cursor.execute("""
+                    UPDATE receipts SET amount_paid = amount_paid + ?, remaining_amount = remaining_amount - ?
+                    WHERE id = ?
+                """, (part, part, receipt_id))
+                self._add_payment(cursor, receipt_id, customer_id, part, PAYMENT_PARTIAL, now)
+                closed += part == remaining
+                left -= part
+            self._bump_customer_stats(cursor, customer_id, balance=-(amount - left), open_debts=-closed)
+        return amount - left
+
+    def customer_price_version(self, customer_id):
+        row = self.conn.execute("""
+            SELECT id, overrides FROM customer_price_versions WHERE customer_id = ? ORDER BY id DESC LIMIT 1
+        """, (customer_id,)).fetchone()
+        return row[0] if row is not None and json.loads(row[1]) else None
+
+    def get_customer_price_version(self, version_id):
+        row = self.conn.execute("SELECT customer_id, overrides FROM customer_price_versions WHERE id = ?", (version_id,)).fetchone()
+        return None if row is None else (row[0], json.loads(row[1]))
+
+    def save_customer_prices(self, customer_id, overrides):
+        with self.conn:
+            return self.conn.execute("INSERT INTO customer_price_versions (customer_id, saved_at, overrides) VALUES (?, ?, ?)",
+                                     (customer_id, int(datetime.now().timestamp()),
+                                      json.dumps(overrides or {}, ensure_ascii=False))).lastrowid
+
+    def _add_payment(self, cursor, receipt_id, customer_id, amount, kind, moment):
+        """Writes one row of the payments ledger (inside the caller's transaction)."""
+        cursor.execute("INSERT INTO payments (receipt_id, customer_id, paid_at, local_day, amount, kind) VALUES (?, ?, ?, ?, ?, ?)",
+                       (receipt_id, customer_id, int(moment.timestamp()), day_key(moment), amount, kind))
+
+    def _bump_customer_stats(self, cursor, customer_id, balance=0, open_debts=0, spend=0, orders=0, visit=None):
+        """Adds the given deltas to a customer's row in customer_stats (inside the caller's transaction)."""
+        if customer_id is None:
+            return
+        cursor.execute("""
+            INSERT INTO customer_stats (customer_id, balance, open_debt_count, lifetime_spend, order_count, last_visit)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (customer_id) DO UPDATE SET
+                balance = balance + excluded.balance,
+                open_debt_count = open_debt_count + excluded.open_debt_count,
+                lifetime_spend = lifetime_spend + excluded.lifetime_spend,
+                order_count = order_count + excluded.order_count,
+                last_visit = COALESCE(MAX(last_visit, excluded.last_visit), last_visit, excluded.last_visit)
+        """, (customer_id, balance, open_debts, spend, orders, visit))
+
+    # --------------------------------------------------------------------------
+    # الفواتير والطلبات
+    # --------------------------------------------------------------------------
+    def save_receipt(self, receipt_payload, total_amount, customer_id, due_date, notes, discount, amount_paid, remaining,
+                     items=(), consumed_materials=(), price_version_id=None, customer_price_version_id=None):
+        """
+        Saves a receipt together with its line items and consumed materials in a
+        single transaction, and returns the new receipt id. Nothing is written if
+        any step fails. receipt_payload is the compact blob from
+        receipt_codec.encode_receipt. The receipt amounts are piastres; the line
+        items are the pages' order dicts, priced in pounds.
+        """
+        now = datetime.now()
+        with self.conn:
+            cursor = self.conn.cursor()
+            cursor.execute("""
+                INSERT INTO receipts (timestamp, ts_epoch, local_day, receipt_data, total_amount, customer_id, status, due_date, notes, discount, amount_paid, remaining_amount, price_version_id, customer_price_version_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (*timestamp_columns(now), receipt_payload, total_amount, customer_id, NEW_JOB_STATUS, due_date, notes, discount, amount_paid, remaining,
+                  price_version_id, customer_price_version_id))
+            receipt_id = cursor.lastrowid
+            self._record_status_change(cursor, receipt_id, NEW_JOB_STATUS, now)
+            if amount_paid > 0:
+                self._add_payment(cursor, receipt_id, customer_id, amount_paid, PAYMENT_CHECKOUT, now)
+
+            is_debt = remaining > 0
+            self._bump_customer_stats(cursor, customer_id, balance=remaining if is_debt else 0, open_debts=int(is_debt),
+                                      spend=total_amount - discount, orders=1, visit=timestamp_columns(now)[0])
+
+            # حفظ بنود الفاتورة في جدول منفصل لتقارير المنتجات
+            cursor.executemany("""
+                INSERT INTO receipt_items (receipt_id, description, quantity, unit_price, subtotal, product_type, paper_size, price_ref)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, [(receipt_id, item.get('description', ''), item.get('quantity', 1), to_piastres(item.get('unit_price', 0)),
+                   to_piastres(item.get('subtotal', 0)), item.get('product_type'), item.get('paper_size'), price_ref_text(item))
+                  for item in items])
+
+            # تحديث المخزون وحفظ المواد المستخدمة
+            for item in consumed_materials:
+                cursor.execute("UPDATE inventory SET stock_level = stock_level - ? WHERE id = ?",
+                               (item['quantity'], item['id']))
+                cursor.execute("INSERT INTO job_materials (receipt_id, inventory_id, quantity_used) VALUES (?, ?, ?)",
+                               (receipt_id, item['id'], item['quantity']))
+                self._add_stock_movement(cursor, item['id'], -item['quantity'], STOCK_CONSUMPTION, now, receipt_id=receipt_id)
+        return receipt_id
+
+    def get_receipt(self, receipt_id):
+        """Returns one receipt as a RECEIPT_COLUMNS row, or None."""
+        return self.conn.execute(f"""
+            SELECT {RECEIPT_COLUMNS}
+            FROM receipts r LEFT JOIN customers c ON c.id = r.customer_id
+            WHERE r.id = ?
+        """, (receipt_id,)).fetchone()
+
+    def receipt_line_items(self, receipt_id):
+        """Line items of a receipt from receipt_items, priced in piastres."""
+        return self.conn.execute("""
+            SELECT description, quantity, unit_price, subtotal, product_type, paper_size
+            FROM receipt_items WHERE receipt_id = ? ORDER BY id
+        """, (receipt_id,)).fetchall()
+
+    def open_jobs(self):
+        return self.conn.execute("""
+            SELECT r.id, c.name, r.due_date, r.status
+            FROM receipts r JOIN customers c ON r.customer_id = c.id
+            WHERE r.status != ? ORDER BY r.due_date
+        """, (DELIVERED_STATUS,)).fetchall()
+
+    def get_receipt_remaining(self, receipt_id):
+        return self.conn.execute("SELECT remaining_amount FROM receipts WHERE id = ?", (receipt_id,)).fetchone()[0]
+
+    def update_job_status(self, receipt_id, new_status, settle_debt=False):
+        with self.conn:
+            if settle_debt:
+                customer_id, remaining = self.conn.execute(
+                    "SELECT customer_id, remaining_amount FROM receipts WHERE id = ?", (receipt_id,)).fetchone()
+                self.conn.execute("""
+                    UPDATE receipts
+                    SET amount_paid = amount_paid + remaining_amount,
+                        remaining_amount = 0
+                    WHERE id = ?
+                """, (receipt_id,))
+                if remaining > 0:
+                    cursor = self.conn.cursor()
+                    self._add_payment(cursor, receipt_id, customer_id, remaining, PAYMENT_SETTLEMENT, datetime.now())
+                    self._bump_customer_stats(cursor, customer_id, balance=-remaining, open_debts=-1)
+            self._record_status_change(self.conn.cursor(), receipt_id, new_status, datetime.now())
+            self.conn.execute("UPDATE receipts SET status = ? WHERE id = ?", (new_status, receipt_id))
+
+    def _record_status_change(self, cursor, receipt_id, new_status, moment):
+        """
+        Closes the job's open event in job_status_events, adds its duration to
+        job_stage_durations and job_stage_daily, and opens an event for new_status
+        (inside the caller's transaction). Does nothing if the status is unchanged.
+        """
+        now_epoch, today = int(moment.timestamp()), day_key(moment)
+        current = cursor.execute("""
+            SELECT id, status, entered_at FROM job_status_events
+            WHERE receipt_id = ? AND left_at IS NULL ORDER BY entered_at DESC, id DESC LIMIT 1
+        """, (receipt_id,)).fetchone()
+        if current and current[1] == new_status:
+            return
+        if current:
+            event_id, status, entered_at = current
+            duration = max(now_epoch - entered_at, 0)
+            cursor.execute("UPDATE job_status_events SET left_at = ?, duration = ? WHERE id = ?", (now_epoch, duration, event_id))
+            cursor.execute("""
+                INSERT INTO job_stage_durations (receipt_id, status, seconds, visits) VALUES (?, ?, ?, 1)
+                ON CONFLICT (receipt_id, status) DO UPDATE SET seconds = seconds + excluded.seconds, visits = visits + 1
+            """, (receipt_id, status, duration))
+            self._bump_job_stage_daily(cursor, today, status, completed=1, seconds=duration)
+        cursor.execute("INSERT INTO job_status_events (receipt_id, status, entered_at, local_day) VALUES (?, ?, ?, ?)",
+                       (receipt_id, new_status, now_epoch, today))
+        self._bump_job_stage_daily(cursor, today, new_status, entered=1)
+
+    def _bump_job_stage_daily(self, cursor, day, status, entered=0, completed=0, seconds=0):
+        cursor.execute("""
+            INSERT INTO job_stage_daily (day_key, status, entered, completed, total_seconds) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (day_key, status) DO UPDATE SET
+                entered = entered + excluded.entered,
+                completed = completed + excluded.completed,
+                total_seconds = total_seconds + excluded.total_seconds
+        """, (day, status, entered, completed, seconds))
+
+    def job_stage_durations(self, receipt_id):
+        return self.conn.execute("""
+            SELECT d.status, d.seconds, d.visits FROM job_stage_durations d
+            WHERE d.receipt_id = ?
+            ORDER BY (SELECT MIN(e.entered_at) FROM job_status_events e WHERE e.receipt_id = d.receipt_id AND e.status = d.status)
+        """, (receipt_id,)).fetchall()
+
+    def archive_old_receipts(self, months_to_keep=archive.DEFAULT_MONTHS_TO_KEEP, progress=print):
+        """Moves old delivered, fully paid receipts into the yearly archive files. Returns how many moved."""
+        return archive.archive_database(self.db_file, self.archive_dir, months_to_keep, progress=progress)
+
+    # --------------------------------------------------------------------------
+    # لوحة التحكم والمصروفات
+    # --------------------------------------------------------------------------
+    def daily_summary(self, day):
+        """Returns (income, expenses, total debt) for the given day."""
+        row = self.conn.execute("SELECT paid, expenses FROM sales_rollup_daily WHERE day_key = ?", (day_key(day),)).fetchone()
+        total_income, total_expenses = row if row else (0, 0)
+        total_debt = self.conn.execute("SELECT SUM(balance) FROM customer_stats").fetchone()[0] or 0
+        return total_income, total_expenses, total_debt
+
+    def add_expense(self, description, amount):
+        with self.conn:
+            self.conn.execute("INSERT INTO expenses (timestamp, ts_epoch, local_day, description, amount) VALUES (?, ?, ?, ?, ?)",
+                              (*timestamp_columns(datetime.now()), description, amount))
+
+    # --------------------------------------------------------------------------
+    # التقارير والتحليل
+    # --------------------------------------------------------------------------
+    def jobs_report(self, start_date, end_date):
+        """Receipts between the two dates (end date inclusive) joined with their consumed materials."""
+        range_start, range_end = day_key(start_date), day_range(end_date)[1]
+        with archive.report_sources(self.report_conn, self.archive_dir, range_start, range_end) as sources:
+            query = f"""
+                SELECT
+                    r.id as 'رقم الفاتورة',
+                    strftime('%Y-%m-%d %H:%M', r.ts_epoch, 'unixepoch', 'localtime') as 'تاريخ الفاتورة',
+                    c.name as 'اسم العميل',
+                    {pounds_sql('r.total_amount')} as 'إجمالي الفاتورة',
+                    {pounds_sql('r.discount')} as 'الخصم',
+                    {pounds_sql('r.total_amount - r.discount')} as 'الصافي',
+                    {pounds_sql('r.amount_paid')} as 'المدفوع',
+                    {pounds_sql('r.remaining_amount')} as 'المتبقي',
+                    i.name as 'المادة المستخدمة',
+                    jm.quantity_used as 'الكمية المستخدمة',
+                    {pounds_sql('i.purchase_price')} as 'سعر شراء الوحدة',
+                    {pounds_sql('jm.quantity_used * i.purchase_price')} as 'تكلفة المادة'
+                FROM {sources['receipts']} r
+                JOIN customers c ON r.customer_id = c.id
+                LEFT JOIN {sources['job_materials']} jm ON r.id = jm.receipt_id
+                LEFT JOIN inventory i ON jm.inventory_id = i.id
+                WHERE r.local_day >= ? AND r.local_day < ?
+                ORDER BY r.ts_epoch DESC;
+            """
+            return pd.read_sql_query(query, self.report_conn, params=(range_start, range_end))
+
+    def expenses_report(self, start_date, end_date):
+        range_start, range_end = day_key(start_date), day_range(end_date)[1]
+        return pd.read_sql_query(f"""
+            SELECT printf('%04d-%02d-%02d', local_day / 10000, local_day / 100 % 100, local_day % 100) as 'التاريخ',
+                   description as 'البيان', {pounds_sql('amount')} as 'المبلغ'
+            FROM expenses WHERE local_day >= ? AND local_day < ?
+            ORDER BY ts_epoch
+        """, self.report_conn, params=(range_start, range_end))
+
+    def top_customers(self, since, limit=10):
+        range_start, range_end = day_key(since), day_range(date.today())[1]
+        with archive.report_sources(self.report_conn, self.archive_dir, range_start, range_end) as sources:
+            return pd.read_sql_query(f"""
+                SELECT c.name, {pounds_sql('SUM(r.total_amount - r.discount)')} as total
+                FROM {sources['receipts']} r JOIN customers c ON r.customer_id = c.id
+                WHERE r.local_day >= ? AND r.local_day < ? GROUP BY c.id ORDER BY total DESC LIMIT ?
+            """, self.report_conn, params=(range_start, range_end, limit))
+
+    def available_years(self):
+        """Returns the years that have receipts or expenses, newest first."""
+        rows = self.report_conn.execute("""
+            SELECT DISTINCT day_key / 10000 FROM sales_rollup_daily
+            WHERE receipt_count > 0 OR expenses != 0 ORDER BY 1 DESC
+        """).fetchall()
+        return [str(row[0]) for row in rows]
+
+    def monthly_totals(self, year):
+        """Income and expenses per month ('01'..'12') of the given year, read from the daily rollups."""
+        year = int(year)
+        return pd.read_sql_query(f"""
+            SELECT printf('%02d', day_key / 100 % 100) as month,
+                   {pounds_sql('SUM(gross)')} as income, {pounds_sql('SUM(expenses)')} as expenses
+            FROM sales_rollup_daily WHERE day_key >= ? AND day_key < ? GROUP BY month
+        """, self.report_conn, params=(year * 10000, (year + 1) * 10000))
+
+    def daily_totals(self, year, month):
+        """Income and expenses per day ('01'..'31') of the given month, read from the daily rollups."""
+        first_key = int(year) * 10000 + int(month) * 100
+        return pd.read_sql_query(f"""
+            SELECT printf('%02d', day_key % 100) as day, {pounds_sql('gross')} as income, {pounds_sql('expenses')} as expenses
+            FROM sales_rollup_daily WHERE day_key >= ? AND day_key < ?
+        """, self.report_conn, params=(first_key, first_key + 100))
+
+    def product_sales(self, year, month=None):
+        range_start, range_end = month_range(year, month) if month else year_range(year)
+        with archive.report_sources(self.report_conn, self.archive_dir, range_start, range_end) as sources:
+            query = f"""
+                SELECT ri.description as 'المنتج', COUNT(*) as 'عدد مرات البيع', {pounds_sql('SUM(ri.subtotal)')} as 'إجمالي الدخل'
+                FROM {sources['receipts']} r JOIN {sources['receipt_items']} ri ON ri.receipt_id = r.id
+                WHERE r.local_day >= ? AND r.local_day < ?
+                GROUP BY ri.description ORDER BY SUM(ri.subtotal) DESC
+            """
+            return pd.read_sql_query(query, self.report_conn, params=(range_start, range_end), index_col='المنتج')
+
+    def sold_line_items(self, start_date, end_date):
+        range_start, range_end = day_key(start_date), day_range(end_date)[1]
+        with archive.report_sources(self.report_conn, self.archive_dir, range_start, range_end) as sources:
+            return pd.read_sql_query(f"""
+                SELECT ri.receipt_id, r.ts_epoch, r.price_version_id, r.customer_price_version_id, ri.description,
+                       ri.quantity, ri.unit_price, ri.subtotal, ri.product_type, ri.paper_size, ri.price_ref
+                FROM {sources['receipts']} r JOIN {sources['receipt_items']} ri ON ri.receipt_id = r.id
+                WHERE r.local_day >= ? AND r.local_day < ?
+            """, self.report_conn, params=(range_start, range_end))
+
+    def receipts_without_items(self, start_date, end_date):
+        range_start, range_end = day_key(start_date), day_range(end_date)[1]
+        with archive.report_sources(self.report_conn, self.archive_dir, range_start, range_end) as sources:
+            return self.report_conn.execute(f"""
+                SELECT r.id, r.ts_epoch, r.price_version_id, r.receipt_data FROM {sources['receipts']} r
+                WHERE r.local_day >= ? AND r.local_day < ?
+                  AND NOT EXISTS (SELECT 1 FROM {sources['receipt_items']} ri WHERE ri.receipt_id = r.id)
+            """, (range_start, range_end)).fetchall()
+
+    def job_stage_summary(self, start_date, end_date):
+        range_start, range_end = day_key(start_date), day_range(end_date)[1]
+        return pd.read_sql_query("""
+            SELECT status, SUM(entered) as entered, SUM(completed) as completed,
+                   SUM(total_seconds) / 3600.0 / NULLIF(SUM(completed), 0) as avg_hours
+            FROM job_stage_daily WHERE day_key >= ? AND day_key < ? GROUP BY status
+        """, self.report_conn, params=(range_start, range_end))
+
+    def job_throughput(self, start_date, end_date):
+        range_start, range_end = day_key(start_date), day_range(end_date)[1]
+        return pd.read_sql_query("""
+            SELECT printf('%04d-%02d-%02d', day_key / 10000, day_key / 100 % 100, day_key % 100) as day,
+                   SUM(CASE WHEN status = ? THEN entered ELSE 0 END) as received,
+                   SUM(CASE WHEN status = ? THEN entered ELSE 0 END) as delivered
+            FROM job_stage_daily WHERE day_key >= ? AND day_key < ? AND status IN (?, ?)
+            GROUP BY day_key ORDER BY day_key
+        """, self.report_conn, params=(NEW_JOB_STATUS, DELIVERED_STATUS, range_start, range_end, NEW_JOB_STATUS, DELIVERED_STATUS))
+
+    # --------------------------------------------------------------------------
+    # إصدارات الأسعار
+    # --------------------------------------------------------------------------
+    def save_price_version(self, config, effective_from):
+        with self.conn:
+            return self.conn.execute("INSERT INTO price_versions (effective_from, config) VALUES (?, ?)",
+                                     (int(effective_from.timestamp()), json.dumps(config, ensure_ascii=False))).lastrowid
+
+    def price_versions(self):
+        return self.conn.execute("SELECT id, effective_from FROM price_versions ORDER BY effective_from, id").fetchall()
+
+    def get_price_version(self, version_id):
+        row = self.conn.execute("SELECT config FROM price_versions WHERE id = ?", (version_id,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    # --------------------------------------------------------------------------
+    # المخزون
+    # --------------------------------------------------------------------------
+    def list_materials(self):
+        return self.conn.execute("SELECT id, name, unit, stock_level FROM inventory ORDER BY name").fetchall()
+
+    def list_inventory(self):
+        return self.conn.execute(
+            "SELECT id, name, unit, stock_level, low_stock_threshold, purchase_price FROM inventory ORDER BY name").fetchall()
+
+    def get_inventory_item(self, inventory_id):
+        return self.conn.execute(
+            "SELECT id, name, unit, stock_level, low_stock_threshold, purchase_price FROM inventory WHERE id = ?",
+            (inventory_id,)).fetchone()
+
+    def add_inventory_item(self, name, unit, stock, threshold, price):
+        """Records the initial stock as an opening movement. Raises DuplicateRecordError if the name already exists."""
+        try:
+            with self.conn:
+                cursor = self.conn.execute("""
+                    INSERT INTO inventory (name, unit, stock_level, low_stock_threshold, purchase_price)
+                    VALUES (?, ?, ?, ?, ?)
+                """, (name, unit, stock, threshold, price))
+                if stock:
+                    self._add_stock_movement(cursor, cursor.lastrowid, stock, STOCK_OPENING, datetime.now())
+        except sqlite3.IntegrityError as e:
+            raise DuplicateRecordError(str(e)) from e
+
+    def update_inventory_item(self, inventory_id, name, unit, threshold, price):
+        """Raises DuplicateRecordError if the new name already exists."""
+        try:
+            with self.conn:
+                self.conn.execute("""
+                    UPDATE inventory SET name=?, unit=?, low_stock_threshold=?, purchase_price=?
+                    WHERE id = ?
+                """, (name, unit, threshold, price, inventory_id))
+        except sqlite3.IntegrityError as e:
+            raise DuplicateRecordError(str(e)) from e
+
+    def add_stock(self, inventory_id, quantity, kind=STOCK_PURCHASE, note=None):
+        with self.conn:
+            cursor = self.conn.execute("UPDATE inventory SET stock_level = stock_level + ? WHERE id = ?", (quantity, inventory_id))
+            self._add_stock_movement(cursor, inventory_id, quantity, kind, datetime.now(), note=note)
+
+    def _add_stock_movement(self, cursor, inventory_id, quantity, kind, moment, receipt_id=None, note=None):
+        """Appends one row to stock_movements (inside the caller's transaction)."""
+        cursor.execute("""
+            INSERT INTO stock_movements (inventory_id, moved_at, local_day, quantity, kind, receipt_id, note)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (inventory_id, int(moment.timestamp()), day_key(moment), quantity, kind, receipt_id, note))
+
+    # --------------------------------------------------------------------------
+    # حركات المخزون ولقطات الرصيد
+    # --------------------------------------------------------------------------
+    def take_stock_snapshot(self, moment=None):
+        taken_at = int(month_start(moment or datetime.now()).timestamp())
+        with self.conn:
+            # الرصيد عند بداية الشهر = الرصيد الحالي ناقص حركات ما بعد بداية الشهر فقط
+            cursor = self.conn.execute("""
+                INSERT OR IGNORE INTO stock_snapshots (inventory_id, taken_at, stock_level)
+                SELECT i.id, ?, i.stock_level - IFNULL((
+                    SELECT SUM(m.quantity) FROM stock_movements m WHERE m.inventory_id = i.id AND m.moved_at >= ?), 0)
+                FROM inventory i
+            """, (taken_at, taken_at))
+        return cursor.rowcount
+
+    def stock_at(self, moment):
+        until = int(moment.timestamp())
+        return self.report_conn.execute("""
+            SELECT i.id, i.name, i.unit,
+                   IFNULL(s.stock_level, 0) + IFNULL((
+                       SELECT SUM(m.quantity) FROM stock_movements m
+                       WHERE m.inventory_id = i.id AND m.moved_at >= IFNULL(s.taken_at, 0) AND m.moved_at < ?), 0)
+            FROM inventory i
+            LEFT JOIN stock_snapshots s ON s.inventory_id = i.id AND s.taken_at = (
+                SELECT MAX(taken_at) FROM stock_snapshots WHERE inventory_id = i.id AND taken_at <= ?)
+            ORDER BY i.name
+        """, (until, until)).fetchall()
+
+    def stock_movement_totals(self, range_start, range_end):
+        rows = self.report_conn.execute("""
+            SELECT inventory_id,
+                   SUM(CASE WHEN kind IN (?, ?) THEN quantity ELSE 0 END),
+                   SUM(CASE WHEN kind = ? THEN -quantity ELSE 0 END),
+                   SUM(CASE WHEN kind = ? THEN quantity ELSE 0 END)
+            FROM stock_movements WHERE local_day >= ? AND local_day < ?
+            GROUP BY inventory_id
+        """, (STOCK_OPENING, STOCK_PURCHASE, STOCK_CONSUMPTION, STOCK_ADJUSTMENT, range_start, range_end)).fetchall()
+        return {row[0]: row[1:] for row in rows}
@@ -0,0 +1,134 @@
+# maintenance.py
+
+import time
+
+# الصيانة تبدأ فقط بعد توقف استخدام البرنامج لعدة دقائق، وتعمل على خطوات صغيرة عبر after()
+IDLE_SECONDS = 5 * 60
+CHECK_INTERVAL_MS = 30 * 1000
+STEP_GAP_MS = 200
+MIN_SECONDS_BETWEEN_RUNS = 6 * 60 * 60
+
+# حدود كل خطوة حتى لا تتجمد الواجهة إذا عاد الكاشير للعمل
+ANALYSIS_LIMIT = 1000
+VACUUM_PAGES_PER_SLICE = 500
+MAX_VACUUM_SLICES = 40
+
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+# ==============================================================================
+# خطوات الصيانة
+# ==============================================================================
+def _freelist_bytes(conn):
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    return conn.execute("PRAGMA freelist_count").fetchone()[0] * page_size
+
+def optimize(conn):
+    """PRAGMA optimize with a bounded analysis, so ANALYZE statistics stay current on large tables."""
+    conn.execute(f"PRAGMA analysis_limit={ANALYSIS_LIMIT}")
+    conn.execute("PRAGMA optimize")
+    return "statistics refreshed"
+
+def checkpoint(conn):
+    """Passive WAL checkpoint: copies what it can into the main file without waiting on readers or writers."""
+    busy, wal_frames, checkpointed = conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+    return f"{checkpointed}/{wal_frames} WAL frames checkpointed" + (" (busy)" if busy else "")
+
+def enable_incremental_vacuum(conn):
+    """
+    Switches the file to auto_vacuum=INCREMENTAL. This needs one full VACUUM, which
+    can take a while on a large file and cannot run inside a transaction, so
+    DataStore.init_schema calls it once at startup, after the migrations and
+    before the UI is shown. Returns None if the file is already incremental.
+    """
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == AUTO_VACUUM_INCREMENTAL:
+        return None
+    before = _freelist_bytes(conn)
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("VACUUM")
+    return f"one-time VACUUM to enable incremental auto_vacuum, reclaimed {before / 1024:.0f} KB"
+
+def incremental_vacuum_slice(conn):
+    """
+    Frees at most VACUUM_PAGES_PER_SLICE pages from the freelist. Returns None once
+    nothing is left to reclaim.
+    """
+    before = _freelist_bytes(conn)
+    if before == 0:
+        return None
+    # execute() يحرر صفحة واحدة فقط لأن الـ pragma لا يعيد أعمدة؛ executescript ينفذه حتى النهاية
+    conn.executescript(f"PRAGMA incremental_vacuum({VACUUM_PAGES_PER_SLICE});")
+    return f"reclaimed {(before - _freelist_bytes(conn)) / 1024:.0f} KB"
+
+
+# ==============================================================================
+# الجدولة أثناء الخمول
+# ==============================================================================
+class MaintenanceScheduler:
+    """
+    Runs database maintenance from the Tk event loop when the app has had no
+    keyboard or mouse input for IDLE_SECONDS, at most once every
+    MIN_SECONDS_BETWEEN_RUNS.
+
+    Each step is a separate after() callback, and a run stops at the next step
+    boundary as soon as the user is active again. Every step logs how long it took
+    and what it did or reclaimed.
+    """
+
+    def __init__(self, root, conn, log=print):
+        self.root = root
+        self.conn = conn
+        self.log = log
+        self.last_activity = time.monotonic()
+        self.last_run = None
+        self.running = False
+
+    def start(self):
+        self.root.bind_all('<Any-KeyPress>', self._mark_activity, add='+')
+        self.root.bind_all('<Any-ButtonPress>', self._mark_activity, add='+')
+        self.root.after(CHECK_INTERVAL_MS, self._check_idle)
+
+    def _mark_activity(self, event=None):
+        self.last_activity = time.monotonic()
+
+    def _is_idle(self):
+        return time.monotonic() - self.last_activity >= IDLE_SECONDS
+
+    def _check_idle(self):
+        if (not self.running and self._is_idle()
+                and (self.last_run is None or time.monotonic() - self.last_run >= MIN_SECONDS_BETWEEN_RUNS)):
+            self.running = True
+            steps = [('optimize', optimize), ('checkpoint', checkpoint)]
+            steps += [('incremental vacuum', incremental_vacuum_slice)] * MAX_VACUUM_SLICES
+            self.root.after(0, lambda: self._run_steps(steps))
+        self.root.after(CHECK_INTERVAL_MS, self._check_idle)
+
+    def _run_steps(self, steps):
+        if not steps or not self._is_idle():
+            if steps:
+                self.log("Maintenance: paused, the app is in use again")
+            self._finish(completed=not steps)
+            return
+        if self.conn.in_transaction:
+            self.root.after(STEP_GAP_MS, lambda: self._run_steps(steps))
+            return
+
+        (name, step), remaining_steps = steps[0], steps[1:]
+        started = time.perf_counter()
+        try:
+            result = step(self.conn)
+        except Exception as e:
+            self.log(f"Maintenance: {name} failed: {e}")
+            self._finish(completed=False)
+            return
+        if result is not None:
+            self.log(f"Maintenance: {name} took {time.perf_counter() - started:.2f}s, {result}")
+        elif step is incremental_vacuum_slice:
+            # لا توجد صفحات فارغة أخرى، فلا داعي لبقية الشرائح
+            remaining_steps = [s for s in remaining_steps if s[1] is not incremental_vacuum_slice]
+        self.root.after(STEP_GAP_MS, lambda: self._run_steps(remaining_steps))
+
+    def _finish(self, completed):
+        self.running = False
+        if completed:
+            self.last_run = time.monotonic()
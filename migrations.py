@@ -0,0 +1,597 @@
+# migrations.py
+
+import sqlite3
+import time
+from datetime import datetime
+
+import receipt_codec
+from storage import day_key
+
+
+# ==============================================================================
+# دوال مساعدة لترحيل البيانات القديمة
+# ==============================================================================
+def convert_numbers_from_hindi(text):
+    mapping = {
+        '٠': '0', '١': '1', '٢': '2', '٣': '3', '٤': '4',
+        '٥': '5', '٦': '6', '٧': '7', '٨': '8', '٩': '9',
+        '٫': '.'
+    }
+    return "".join([mapping.get(char, char) for char in str(text)])
+
+def parse_legacy_receipt_items(receipt_text):
+    """
+    تستخرج بنود الفاتورة من النص القديم المحفوظ في receipt_data.
+    تستخدم فقط لنقل الفواتير القديمة إلى جدول receipt_items.
+    """
+    items = []
+    item_section = False
+    for line in receipt_text.split('\n'):
+        if "الصنف" in line and "الكمية" in line:
+            item_section = True
+            continue
+        if not item_section or "----" in line or not line.strip():
+            continue
+        if "====" in line:
+            break
+        parts = line.split()
+        try:
+            # ترتيب الأعمدة في السطر: الإجمالي، السعر، الكمية، ثم الصنف
+            subtotal, unit_price, quantity = (float(convert_numbers_from_hindi(p)) for p in parts[:3])
+            description = ' '.join(parts[3:])
+        except ValueError:
+            # سطر تكملة لوصف طويل تم تقسيمه بواسطة textwrap
+            if items:
+                items[-1]['description'] = f"{items[-1]['description']} {line.strip()}"
+            continue
+        items.append({
+            'description': description, 'quantity': quantity,
+            'unit_price': unit_price, 'subtotal': subtotal
+        })
+    return items
+
+
+# ==============================================================================
+# خطوات الترحيل (بالترتيب، كل خطوة تنفذ مرة واحدة فقط)
+# ==============================================================================
+def create_base_tables(cursor):
+    # جدول العملاء
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS customers (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, phone TEXT UNIQUE NOT NULL, notes TEXT
+        )
+    ''')
+
+    # جدول الفواتير
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS receipts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp DATETIME NOT NULL, receipt_data TEXT NOT NULL,
+            total_amount REAL NOT NULL, customer_id INTEGER, status TEXT, due_date TEXT, notes TEXT,
+            discount REAL, amount_paid REAL, remaining_amount REAL,
+            FOREIGN KEY (customer_id) REFERENCES customers (id)
+        )
+    ''')
+
+    # جدول المصروفات
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS expenses (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp DATETIME NOT NULL,
+            description TEXT NOT NULL, amount REAL NOT NULL
+        )
+    ''')
+
+    # جدول المخزون
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS inventory (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL UNIQUE,
+            unit TEXT NOT NULL,
+            stock_level REAL NOT NULL DEFAULT 0,
+            low_stock_threshold REAL DEFAULT 10,
+            purchase_price REAL NOT NULL DEFAULT 0
+        )
+    ''')
+
+    # جدول ربط المواد بالفواتير
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS job_materials (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            receipt_id INTEGER NOT NULL,
+            inventory_id INTEGER NOT NULL,
+            quantity_used REAL NOT NULL,
+            FOREIGN KEY (receipt_id) REFERENCES receipts (id),
+            FOREIGN KEY (inventory_id) REFERENCES inventory (id)
+        )
+    ''')
+
+    # قواعد البيانات القديمة جداً أُنشئ فيها جدول المخزون بدون عمود سعر الشراء
+    cursor.execute("PRAGMA table_info(inventory)")
+    cols = [col[1] for col in cursor.fetchall()]
+    if 'purchase_price' not in cols:
+        cursor.execute("ALTER TABLE inventory ADD COLUMN purchase_price REAL NOT NULL DEFAULT 0")
+
+def create_receipt_items(cursor):
+    # جدول بنود الفواتير (بيانات منظمة بدلاً من تحليل نص الفاتورة)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS receipt_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            receipt_id INTEGER NOT NULL,
+            description TEXT NOT NULL,
+            quantity REAL NOT NULL,
+            unit_price REAL NOT NULL,
+            subtotal REAL NOT NULL,
+            product_type TEXT,
+            paper_size TEXT,
+            FOREIGN KEY (receipt_id) REFERENCES receipts (id)
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_receipt_items_receipt ON receipt_items (receipt_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_receipt_items_description ON receipt_items (description)")
+
+    # نقل بنود الفواتير القديمة التي ليس لها بنود محفوظة
+    cursor.execute("""
+        SELECT id, receipt_data FROM receipts
+        WHERE id NOT IN (SELECT receipt_id FROM receipt_items)
+    """)
+    for receipt_id, receipt_text in cursor.fetchall():
+        cursor.executemany("""
+            INSERT INTO receipt_items (receipt_id, description, quantity, unit_price, subtotal)
+            VALUES (?, ?, ?, ?, ?)
+        """, [(receipt_id, item['description'], item['quantity'], item['unit_price'], item['subtotal'])
+              for item in parse_legacy_receipt_items(receipt_text)])
+
+def create_query_indexes(cursor):
+    # فهارس الاستعلامات المرتبطة بالوقت والعملاء والديون
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_receipts_timestamp ON receipts (timestamp)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_receipts_customer ON receipts (customer_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_receipts_status_due ON receipts (status, due_date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_receipts_remaining ON receipts (remaining_amount)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_expenses_timestamp ON expenses (timestamp)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_job_materials_receipt ON job_materials (receipt_id)")
+
+# أعمدة جداول التجميع (rollups) والقيم التي تضيفها كل فاتورة أو مصروف
+ROLLUP_TABLES = {
+    'sales_rollup_hourly': ('hour_key', "CAST(strftime('%Y%m%d%H', {ts}) AS INTEGER)"),
+    'sales_rollup_daily': ('day_key', "CAST(strftime('%Y%m%d', {ts}) AS INTEGER)"),
+}
+
+def _rollup_upsert(table, key_expr, values):
+    """SQL that adds a row of deltas (gross, discount, paid, remaining, expenses, receipt_count) to one bucket."""
+    key_column = ROLLUP_TABLES[table][0]
+    return f"""
+        INSERT INTO {table} ({key_column}, gross, discount, paid, remaining, expenses, receipt_count)
+        VALUES ({key_expr}, {values})
+        ON CONFLICT ({key_column}) DO UPDATE SET
+            gross = gross + excluded.gross,
+            discount = discount + excluded.discount,
+            paid = paid + excluded.paid,
+            remaining = remaining + excluded.remaining,
+            expenses = expenses + excluded.expenses,
+            receipt_count = receipt_count + excluded.receipt_count;
+    """
+
+def create_rollup_triggers(cursor):
+    """
+    تحدث جداول التجميع تلقائياً عند إضافة أو تعديل فاتورة أو مصروف.
+    لا يوجد trigger للحذف عن قصد: حذف أو أرشفة الفواتير القديمة لا يغير الإجماليات التاريخية.
+    """
+    receipt_values = "IFNULL({r}.total_amount, 0), IFNULL({r}.discount, 0), IFNULL({r}.amount_paid, 0), IFNULL({r}.remaining_amount, 0), 0, 1"
+    receipt_deltas = "-IFNULL({r}.total_amount, 0), -IFNULL({r}.discount, 0), -IFNULL({r}.amount_paid, 0), -IFNULL({r}.remaining_amount, 0), 0, -1"
+    expense_values = "0, 0, 0, 0, {r}.amount, 0"
+    expense_deltas = "0, 0, 0, 0, -{r}.amount, 0"
+
+    for name, table, event, statements in [
+        ('trg_receipts_rollup_insert', 'receipts', 'INSERT', [('NEW', receipt_values)]),
+        ('trg_receipts_rollup_update', 'receipts',
+         'UPDATE OF timestamp, total_amount, discount, amount_paid, remaining_amount',
+         [('OLD', receipt_deltas), ('NEW', receipt_values)]),
+        ('trg_expenses_rollup_insert', 'expenses', 'INSERT', [('NEW', expense_values)]),
+        ('trg_expenses_rollup_update', 'expenses', 'UPDATE OF timestamp, amount',
+         [('OLD', expense_deltas), ('NEW', expense_values)]),
+    ]:
+        body = "".join(
+            _rollup_upsert(rollup_table, key_expr.format(ts=f"{row}.timestamp"), values.format(r=row))
+            for row, values in statements
+            for rollup_table, (_, key_expr) in ROLLUP_TABLES.items()
+        )
+        cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+        cursor.execute(f"CREATE TRIGGER {name} AFTER {event} ON {table} BEGIN {body} END")
+
+def rebuild_rollups(cursor):
+    """تعيد حساب جداول التجميع بالكامل من الفواتير والمصروفات."""
+    for table, (key_column, key_expr) in ROLLUP_TABLES.items():
+        cursor.execute(f"DELETE FROM {table}")
+        cursor.execute(f"""
+            INSERT INTO {table} ({key_column}, gross, discount, paid, remaining, expenses, receipt_count)
+            SELECT {key_expr.format(ts='timestamp')}, SUM(IFNULL(total_amount, 0)), SUM(IFNULL(discount, 0)),
+                   SUM(IFNULL(amount_paid, 0)), SUM(IFNULL(remaining_amount, 0)), 0, COUNT(*)
+            FROM receipts GROUP BY 1
+        """)
+        cursor.execute(f"""
+            INSERT INTO {table} ({key_column}, gross, discount, paid, remaining, expenses, receipt_count)
+            SELECT {key_expr.format(ts='timestamp')}, 0, 0, 0, 0, SUM(amount), 0
+            FROM expenses WHERE true GROUP BY 1
+            ON CONFLICT ({key_column}) DO UPDATE SET expenses = expenses + excluded.expenses
+        """)
+
+def _create_rollup_tables(cursor, money_type):
+    for table, (key_column, _) in ROLLUP_TABLES.items():
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table} (
+                {key_column} INTEGER PRIMARY KEY,
+                gross {money_type} NOT NULL DEFAULT 0,
+                discount {money_type} NOT NULL DEFAULT 0,
+                paid {money_type} NOT NULL DEFAULT 0,
+                remaining {money_type} NOT NULL DEFAULT 0,
+                expenses {money_type} NOT NULL DEFAULT 0,
+                receipt_count INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+
+def create_sales_rollups(cursor):
+    # إجماليات مجمعة بالساعة وباليوم حتى لا تعيد لوحة التحكم والتحليل حساب كل الفواتير
+    _create_rollup_tables(cursor, 'REAL')
+    rebuild_rollups(cursor)
+    create_rollup_triggers(cursor)
+
+def rebuild_customer_stats(cursor):
+    """تعيد حساب إجماليات كل العملاء من الفواتير."""
+    cursor.execute("DELETE FROM customer_stats")
+    cursor.execute("""
+        INSERT INTO customer_stats (customer_id, balance, open_debt_count, lifetime_spend, order_count, last_visit)
+        SELECT c.id,
+               IFNULL(SUM(CASE WHEN r.remaining_amount > 0 THEN r.remaining_amount END), 0),
+               COUNT(CASE WHEN r.remaining_amount > 0 THEN 1 END),
+               IFNULL(SUM(IFNULL(r.total_amount, 0) - IFNULL(r.discount, 0)), 0),
+               COUNT(r.id),
+               MAX(r.timestamp)
+        FROM customers c LEFT JOIN receipts r ON r.customer_id = c.id
+        GROUP BY c.id
+    """)
+
+def _create_customer_stats_table(cursor, money_type):
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS customer_stats (
+            customer_id INTEGER PRIMARY KEY REFERENCES customers (id),
+            balance {money_type} NOT NULL DEFAULT 0,
+            open_debt_count INTEGER NOT NULL DEFAULT 0,
+            lifetime_spend {money_type} NOT NULL DEFAULT 0,
+            order_count INTEGER NOT NULL DEFAULT 0,
+            last_visit TIMESTAMP
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_customer_stats_balance ON customer_stats (balance)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_customer_stats_lifetime_spend ON customer_stats (lifetime_spend)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_customer_stats_last_visit ON customer_stats (last_visit)")
+
+def create_customer_stats(cursor):
+    # إجماليات لكل عميل (الرصيد، إجمالي المشتريات، عدد الطلبات، آخر زيارة) تُحدث مع كل فاتورة وتسوية
+    _create_customer_stats_table(cursor, 'REAL')
+    rebuild_customer_stats(cursor)
+
+def add_epoch_columns(cursor):
+    # أعمدة رقمية للوقت (ثواني unix) واليوم المحلي (YYYYMMDD) بدلاً من مقارنة النص وتحويله بـ strftime
+    for table in ('receipts', 'expenses'):
+        columns = [info[1] for info in cursor.execute(f"PRAGMA table_info({table})").fetchall()]
+        if 'ts_epoch' not in columns:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN ts_epoch INTEGER")
+        if 'local_day' not in columns:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN local_day INTEGER")
+        # النص القديم محفوظ بالتوقيت المحلي، لذلك 'utc' تحوله إلى ثواني unix الصحيحة
+        cursor.execute(f"""
+            UPDATE {table} SET
+                ts_epoch = CAST(strftime('%s', timestamp, 'utc') AS INTEGER),
+                local_day = CAST(strftime('%Y%m%d', timestamp) AS INTEGER)
+            WHERE ts_epoch IS NULL
+        """)
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_local_day ON {table} (local_day)")
+        cursor.execute(f"DROP INDEX IF EXISTS idx_{table}_timestamp")
+    # سجل العميل يُرتب بالوقت، فالفهرس المركب يغني عن فهرس customer_id وحده
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_receipts_customer_epoch ON receipts (customer_id, ts_epoch)")
+    cursor.execute("DROP INDEX IF EXISTS idx_receipts_customer")
+
+# تعريف جداول المبالغ بعد تحويلها إلى أعداد صحيحة بالقرش، وأعمدة المبالغ في كل جدول
+MONEY_TABLES = {
+    'receipts': ('''
+        CREATE TABLE {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp DATETIME NOT NULL, ts_epoch INTEGER, local_day INTEGER,
+            receipt_data TEXT NOT NULL, total_amount INTEGER NOT NULL, customer_id INTEGER, status TEXT, due_date TEXT, notes TEXT,
+            discount INTEGER NOT NULL DEFAULT 0, amount_paid INTEGER NOT NULL DEFAULT 0, remaining_amount INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY (customer_id) REFERENCES customers (id)
+        )
+    ''', ('total_amount', 'discount', 'amount_paid', 'remaining_amount')),
+    'expenses': ('''
+        CREATE TABLE {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp DATETIME NOT NULL, ts_epoch INTEGER, local_day INTEGER,
+            description TEXT NOT NULL, amount INTEGER NOT NULL
+        )
+    ''', ('amount',)),
+    'inventory': ('''
+        CREATE TABLE {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL UNIQUE,
+            unit TEXT NOT NULL,
+            stock_level REAL NOT NULL DEFAULT 0,
+            low_stock_threshold REAL DEFAULT 10,
+            purchase_price INTEGER NOT NULL DEFAULT 0
+        )
+    ''', ('purchase_price',)),
+    'receipt_items': ('''
+        CREATE TABLE {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            receipt_id INTEGER NOT NULL,
+            description TEXT NOT NULL,
+            quantity REAL NOT NULL,
+            unit_price INTEGER NOT NULL,
+            subtotal INTEGER NOT NULL,
+            product_type TEXT,
+            paper_size TEXT,
+            FOREIGN KEY (receipt_id) REFERENCES receipts (id)
+        )
+    ''', ('unit_price', 'subtotal')),
+}
+
+def _rebuild_money_table(cursor, table, create_sql, money_columns):
+    """تعيد إنشاء الجدول بالتعريف الجديد وتنقل بياناته مع تحويل أعمدة المبالغ من جنيهات إلى قروش."""
+    columns = [info[1] for info in cursor.execute(f"PRAGMA table_info({table})").fetchall()]
+    cursor.execute(create_sql.format(table=f"{table}_new"))
+    select = ", ".join(f"CAST(ROUND(IFNULL({column}, 0) * 100) AS INTEGER)" if column in money_columns else column
+                       for column in columns)
+    cursor.execute(f"INSERT INTO {table}_new ({', '.join(columns)}) SELECT {select} FROM {table}")
+    cursor.execute(f"DROP TABLE {table}")
+    cursor.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+
+def convert_money_to_piastres(cursor):
+    # المبالغ REAL كانت تتراكم فيها أخطاء التقريب؛ تُحفظ الآن كأعداد صحيحة بالقرش (انظر money.py)
+    for table, (create_sql, money_columns) in MONEY_TABLES.items():
+        _rebuild_money_table(cursor, table, create_sql, money_columns)
+
+    # حذف الجداول يحذف فهارسها والـ triggers الخاصة بها، فيعاد إنشاؤها
+    cursor.execute("CREATE INDEX idx_receipts_status_due ON receipts (status, due_date)")
+    cursor.execute("CREATE INDEX idx_receipts_remaining ON receipts (remaining_amount)")
+    cursor.execute("CREATE INDEX idx_receipts_local_day ON receipts (local_day)")
+    cursor.execute("CREATE INDEX idx_receipts_customer_epoch ON receipts (customer_id, ts_epoch)")
+    cursor.execute("CREATE INDEX idx_expenses_local_day ON expenses (local_day)")
+    cursor.execute("CREATE INDEX idx_receipt_items_receipt ON receipt_items (receipt_id)")
+    cursor.execute("CREATE INDEX idx_receipt_items_description ON receipt_items (description)")
+
+    # الجداول المجمعة تُبنى من جديد بأعمدة صحيحة
+    for table in ROLLUP_TABLES:
+        cursor.execute(f"DROP TABLE IF EXISTS {table}")
+    _create_rollup_tables(cursor, 'INTEGER')
+    rebuild_rollups(cursor)
+    create_rollup_triggers(cursor)
+
+    cursor.execute("DROP TABLE IF EXISTS customer_stats")
+    _create_customer_stats_table(cursor, 'INTEGER')
+    rebuild_customer_stats(cursor)
+
+def compress_legacy_receipts(cursor):
+    # الفواتير القديمة محفوظة كنص كامل؛ تُضغط كما هي بدون إعادة تحليل حتى لا يضيع أي سطر
+    rows = cursor.execute("SELECT id, receipt_data FROM receipts WHERE typeof(receipt_data) = 'text'").fetchall()
+    cursor.executemany("UPDATE receipts SET receipt_data = ? WHERE id = ?",
+                       [(receipt_codec.encode_legacy_text(text), receipt_id) for receipt_id, text in rows])
+
+def create_payments_ledger(cursor):
+    # سجل لكل دفعة (عند البيع، وعند تسوية الدين، والدفعات الجزئية) بدلاً من تعديل amount_paid فقط
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS payments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            receipt_id INTEGER NOT NULL,
+            customer_id INTEGER,
+            paid_at INTEGER NOT NULL,
+            local_day INTEGER NOT NULL,
+            amount INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            FOREIGN KEY (receipt_id) REFERENCES receipts (id),
+            FOREIGN KEY (customer_id) REFERENCES customers (id)
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_payments_customer_paid_at ON payments (customer_id, paid_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_payments_receipt ON payments (receipt_id)")
+
+    # لا يمكن فصل الدفعات القديمة عن بعضها، فكل ما دُفع في فاتورة قديمة يُسجل كدفعة واحدة بتاريخها
+    cursor.execute("""
+        INSERT INTO payments (receipt_id, customer_id, paid_at, local_day, amount, kind)
+        SELECT id, customer_id, ts_epoch, local_day, amount_paid, 'checkout' FROM receipts
+        WHERE amount_paid > 0 AND id NOT IN (SELECT receipt_id FROM payments)
+    """)
+
+    # فهرس جزئي للفواتير المفتوحة فقط: أعمار الديون والدفعات الجزئية لا تقرأ الفواتير المسددة
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_receipts_open_debt ON receipts (customer_id, local_day, remaining_amount)
+        WHERE remaining_amount > 0
+    """)
+    cursor.execute("DROP INDEX IF EXISTS idx_receipts_remaining")
+    cursor.execute("DROP VIEW IF EXISTS debt_aging")
+    cursor.execute(f"""
+        CREATE VIEW debt_aging AS
+        SELECT customer_id, COUNT(*) AS open_count, SUM(remaining_amount) AS total,
+               {_aging_bucket(None, 30)} AS days_0_30,
+               {_aging_bucket(30, 60)} AS days_31_60,
+               {_aging_bucket(60, 90)} AS days_61_90,
+               {_aging_bucket(90, None)} AS days_over_90
+        FROM receipts WHERE remaining_amount > 0
+        GROUP BY customer_id
+    """)
+
+def _aging_bucket(older_than, up_to):
+    """SUM of remaining_amount for open receipts more than older_than and at most up_to days old (local_day keys)."""
+    def day_key_ago(days):
+        return f"CAST(strftime('%Y%m%d', 'now', 'localtime', '-{days} days') AS INTEGER)"
+    conditions = []
+    if up_to is not None:
+        conditions.append(f"local_day >= {day_key_ago(up_to)}")
+    if older_than is not None:
+        conditions.append(f"local_day < {day_key_ago(older_than)}")
+    return f"SUM(CASE WHEN {' AND '.join(conditions)} THEN remaining_amount ELSE 0 END)"
+
+def create_stock_movements(cursor):
+    # سجل حركات المخزون (شراء، استهلاك، تسوية) لا يُعدل ولا يُحذف، و inventory.stock_level هو مجموعه الحالي
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stock_movements (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            inventory_id INTEGER NOT NULL,
+            moved_at INTEGER NOT NULL,
+            local_day INTEGER NOT NULL,
+            quantity REAL NOT NULL,
+            kind TEXT NOT NULL,
+            receipt_id INTEGER,
+            note TEXT,
+            FOREIGN KEY (inventory_id) REFERENCES inventory (id),
+            FOREIGN KEY (receipt_id) REFERENCES receipts (id)
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_stock_movements_item_time ON stock_movements (inventory_id, moved_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_stock_movements_local_day ON stock_movements (local_day)")
+
+    # رصيد كل مادة في بداية كل شهر: رصيد أي لحظة = آخر لقطة قبلها + حركات ما بعدها فقط
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stock_snapshots (
+            inventory_id INTEGER NOT NULL,
+            taken_at INTEGER NOT NULL,
+            stock_level REAL NOT NULL,
+            PRIMARY KEY (inventory_id, taken_at)
+        ) WITHOUT ROWID
+    ''')
+
+    # الحركات السابقة غير معروفة (الشراء لم يكن يُسجل)، فالرصيد الحالي يُسجل كرصيد افتتاحي من لحظة الترحيل
+    now = datetime.now()
+    cursor.execute("""
+        INSERT INTO stock_movements (inventory_id, moved_at, local_day, quantity, kind)
+        SELECT id, ?, ?, stock_level, 'opening' FROM inventory
+        WHERE stock_level != 0 AND id NOT IN (SELECT inventory_id FROM stock_movements)
+    """, (int(now.timestamp()), day_key(now)))
+
+def create_job_status_events(cursor):
+    # سجل بكل انتقال بين مراحل الطلب؛ left_at و duration يُملآن عند الانتقال للمرحلة التالية
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS job_status_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            receipt_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            entered_at INTEGER NOT NULL,
+            local_day INTEGER NOT NULL,
+            left_at INTEGER,
+            duration INTEGER,
+            FOREIGN KEY (receipt_id) REFERENCES receipts (id)
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_job_status_events_receipt ON job_status_events (receipt_id, entered_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_job_status_events_local_day ON job_status_events (local_day)")
+
+    # إجمالي الوقت الذي قضاه كل طلب في كل مرحلة (قد يعود الطلب لنفس المرحلة أكثر من مرة)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS job_stage_durations (
+            receipt_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            seconds INTEGER NOT NULL DEFAULT 0,
+            visits INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (receipt_id, status)
+        ) WITHOUT ROWID
+    ''')
+
+    # لكل يوم ومرحلة: عدد الطلبات التي دخلتها، وعدد التي خرجت منها ومجموع مدتها، لمتوسط المدة والإنتاجية اليومية
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS job_stage_daily (
+            day_key INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            entered INTEGER NOT NULL DEFAULT 0,
+            completed INTEGER NOT NULL DEFAULT 0,
+            total_seconds INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day_key, status)
+        ) WITHOUT ROWID
+    ''')
+
+    # تاريخ المراحل السابقة غير معروف؛ الطلبات المفتوحة تبدأ حالتها الحالية من تاريخ الفاتورة
+    cursor.execute("""
+        INSERT INTO job_status_events (receipt_id, status, entered_at, local_day)
+        SELECT id, IFNULL(status, 'تحت التنفيذ'), ts_epoch, local_day FROM receipts
+        WHERE IFNULL(status, '') != 'تم التسليم' AND id NOT IN (SELECT receipt_id FROM job_status_events)
+    """)
+
+def add_price_ref_column(cursor):
+    # مرجع السعر في إعدادات الأسعار لكل بند (انظر pricing.line_item)، لإعادة تسعير المبيعات السابقة بأسعار أخرى؛
+    # البنود القديمة تبقى NULL ويُستنتج مرجعها من الوصف والسعر عند الحاجة (انظر repricing.py)
+    cursor.execute("ALTER TABLE receipt_items ADD COLUMN price_ref TEXT")
+
+def create_price_versions(cursor):
+    # كل قائمة أسعار تُحفظ كإصدار له تاريخ بداية سريان (epoch)، والإصدار الساري في أي لحظة هو آخر إصدار بدأ قبلها
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS price_versions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            effective_from INTEGER NOT NULL,
+            config TEXT NOT NULL
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_price_versions_effective ON price_versions (effective_from)")
+    # الفواتير السابقة لا يُعرف إصدارها، فتبقى NULL ويُستخدم الإصدار الساري وقتها (انظر pricing.PriceHistory)
+    cursor.execute("ALTER TABLE receipts ADD COLUMN price_version_id INTEGER REFERENCES price_versions (id)")
+
+def create_customer_prices(cursor):
+    # الأسعار الخاصة لكل عميل: الأسعار التي تختلف عن قائمة الأسعار فقط (انظر pricing.overlay_prices).
+    # تُحفظ كإصدارات لا تتغير، وكل فاتورة تسجل الإصدار الذي سُعرت به حتى يُعرف السعر المدفوع لاحقاً؛
+    # آخر إصدار للعميل هو أسعاره الحالية، وإلغاء الأسعار الخاصة يُحفظ كإصدار فارغ
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS customer_price_versions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            customer_id INTEGER NOT NULL REFERENCES customers (id),
+            saved_at INTEGER NOT NULL,
+            overrides TEXT NOT NULL
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_customer_price_versions_customer ON customer_price_versions (customer_id, id)")
+    cursor.execute("ALTER TABLE receipts ADD COLUMN customer_price_version_id INTEGER REFERENCES customer_price_versions (id)")
+
+
+# رقم الإصدار يُحفظ في PRAGMA user_version بعد نجاح كل خطوة.
+# لا تعدل أو تعيد ترتيب خطوة تم نشرها؛ أضف خطوة جديدة في آخر القائمة.
+MIGRATIONS = [
+    (1, "الجداول الأساسية", create_base_tables),
+    (2, "جدول بنود الفواتير", create_receipt_items),
+    (3, "فهارس الاستعلامات", create_query_indexes),
+    (4, "جداول الإجماليات المجمعة", create_sales_rollups),
+    (5, "إجماليات العملاء", create_customer_stats),
+    (6, "أعمدة الوقت الرقمية", add_epoch_columns),
+    (7, "تحويل المبالغ إلى قروش", convert_money_to_piastres),
+    (8, "ضغط بيانات الفواتير", compress_legacy_receipts),
+    (9, "سجل المدفوعات وأعمار الديون", create_payments_ledger),
+    (10, "سجل حركات المخزون", create_stock_movements),
+    (11, "سجل مراحل الطلبات", create_job_status_events),
+    (12, "مرجع سعر بنود الفواتير", add_price_ref_column),
+    (13, "إصدارات قوائم الأسعار", create_price_versions),
+    (14, "الأسعار الخاصة بالعملاء", create_customer_prices),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def run_migrations(conn, progress=print):
+    """
+    Brings the database up to LATEST_VERSION. Each pending step runs exactly once
+    inside its own transaction together with the user_version bump, so a failed
+    step leaves the database at the previous version and is retried on next start.
+    An up-to-date database costs a single PRAGMA read.
+    """
+    current_version = get_schema_version(conn)
+    pending = [m for m in MIGRATIONS if m[0] > current_version]
+    if not pending:
+        return current_version
+
+    for index, (version, description, migrate) in enumerate(pending, start=1):
+        progress(f"Database migration {index}/{len(pending)}: v{version} {description}...")
+        started = time.perf_counter()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("BEGIN")
+            migrate(cursor)
+            cursor.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        progress(f"Database migration v{version} done in {time.perf_counter() - started:.1f}s")
+    return get_schema_version(conn)
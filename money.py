@@ -0,0 +1,28 @@
+# money.py
+
+from decimal import Decimal, ROUND_HALF_UP
+
+# كل المبالغ تُحفظ في قاعدة البيانات كأعداد صحيحة بالقرش حتى تكون الجمع والمقارنة دقيقة
+PIASTRES_PER_POUND = 100
+
+
+def to_piastres(amount):
+    """Converts an amount in pounds (float, int, str or None) to an exact integer number of piastres."""
+    if amount is None or amount == '':
+        return 0
+    return int((Decimal(str(amount)) * PIASTRES_PER_POUND).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+def to_pounds(piastres):
+    """Converts integer piastres back to pounds for display, charts and the receipt renderers."""
+    return (piastres or 0) / PIASTRES_PER_POUND
+
+def format_money(piastres):
+    """Formats integer piastres as 'pounds.piastres' without going through float."""
+    piastres = piastres or 0
+    sign = '-' if piastres < 0 else ''
+    pounds, rest = divmod(abs(piastres), PIASTRES_PER_POUND)
+    return f"{sign}{pounds}.{rest:02d}"
+
+def pounds_sql(column):
+    """SQL expression that reads a piastre column as pounds, for report DataFrames."""
+    return f"(({column}) / {PIASTRES_PER_POUND}.0)"
@@ -0,0 +1,522 @@
+# pricing.py
+
+import copy
+import re
+import threading
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+from functools import lru_cache
+from types import MappingProxyType
+
+# حد الشريحة الأخيرة في prices_config.json (لأن JSON لا يدعم inf)، ويُعامل كـ "بلا حد"
+UNLIMITED_TIER = 999999
+
+NO_OPTION = 'لا يوجد'
+SINGLE_SIDED = 'وجه'
+DOUBLE_SIDED = 'وجهين'
+LASER_METHOD = 'ليزر'
+INK_METHOD = 'Ink'
+ID_CARD_PRODUCT = "كروت ID"
+
+# أنواع المنتجات كما تُحفظ في receipt_items.product_type
+PLAIN_PAPER = 'plain_paper'
+KOCHEH = 'kocheh'
+ID_CARD = 'id_card'
+
+# أقسام prices_config.json التي تُحفظ في كل إصدار أسعار (بدون المستخدمين وإعداد قاعدة البيانات)
+PRICE_SECTIONS = (
+    'PRINTING_PRICES', 'LAMINATION_PRICES', 'TRIMMING_PRICES', 'BINDING_OPTIONS', 'LAKTA_PRICES', 'ID_CARD_PRICING',
+    'MIN_CUTTING_PRICE', 'PLAIN_PAPER_TYPES', 'QUANTITY_THRESHOLD', 'PLAIN_PAPER_PRICES', 'LASER_PLAIN_PAPER_PRICES',
+    'STAPLING_PRICING_A5', 'STAPLING_PRICING_A4', 'MENU_LAMINATION_PRICING',
+)
+
+# عدد إصدارات الأسعار المجمعة التي تبقى في الذاكرة
+PRICE_VERSION_CACHE_SIZE = 16
+
+# الأقسام التي يمكن أن يكون للعميل فيها أسعار خاصة: أسعار الطباعة تُستبدل سعراً سعراً، والشرائح تُستبدل كاملة
+CUSTOMER_PRICE_SECTIONS = ('PRINTING_PRICES', 'PLAIN_PAPER_PRICES', 'LASER_PLAIN_PAPER_PRICES')
+CUSTOMER_TIER_SECTIONS = ('ID_CARD_PRICING', 'STAPLING_PRICING_A4', 'STAPLING_PRICING_A5', 'MENU_LAMINATION_PRICING')
+# عدد العملاء الذين تبقى أسعارهم المجمعة في الذاكرة
+CUSTOMER_PRICES_CACHE_SIZE = 32
+
+
+# ==============================================================================
+# وصف البنود
+# ==============================================================================
+def convert_numbers_to_hindi(text):
+    mapping = {
+        '0': '٠', '1': '١', '2': '٢', '3': '٣', '4': '٤',
+        '5': '٥', '6': '٦', '7': '٧', '8': '٨', '9': '٩',
+        '.': '٫'
+    }
+    return "".join([mapping.get(char, char) for char in str(text)])
+
+def clean_description(text):
+    text = convert_numbers_to_hindi(text)
+    text = re.sub(r'[a-zA-Z]', '', text)
+    text = re.sub(r'\s+', ' ', text).strip()
+    return text
+
+def line_item(description, quantity, unit_price, subtotal, product_type, paper_size, price_ref=None, versions=(None, None)):
+    """
+    One order line as the cart, receipt_codec and save_receipt expect it (prices
+    in pounds). price_ref names the config price the line was quoted from, so it
+    can be priced again later (see repricing.py); lines priced by hand have None.
+    versions are the snapshot_versions of the prices it was quoted with.
+    """
+    return {
+        "description": description, "quantity": quantity,
+        "unit_price": unit_price, "subtotal": subtotal,
+        "product_type": product_type, "paper_size": paper_size,
+        "price_ref": price_ref,
+        "price_version_id": versions[0], "customer_price_version_id": versions[1],
+    }
+
+def snapshot_versions(prices):
+    """(version_id, customer_version_id) of a PriceTables: what a receipt records for lines quoted with it."""
+    return prices.version_id, prices.customer_version_id
+
+def order_versions(items):
+    """
+    The (price_version_id, customer_price_version_id) the order lines were
+    quoted with, for the receipt; (None, None) if none came from a stored
+    version. Raises ValueError if the lines were quoted with different
+    versions, i.e. prices were saved while the order was open.
+    """
+    versions = {(item.get("price_version_id"), item.get("customer_price_version_id")) for item in items} - {(None, None)}
+    if len(versions) > 1:
+        raise ValueError("بنود الطلب مسعرة بإصدارات أسعار مختلفة")
+    return versions.pop() if versions else (None, None)
+
+
+# ==============================================================================
+# جداول الأسعار المجمعة
+# ==============================================================================
+def compile_tiers(tiers):
+    """
+    Compiles [[max_quantity, value], ...] into parallel (limits, values) tuples
+    sorted by limit, with the UNLIMITED_TIER limit read as infinity.
+    """
+    tiers = sorted(tiers, key=lambda tier: tier[0])
+    limits = tuple(float('inf') if limit >= UNLIMITED_TIER else limit for limit, _ in tiers)
+    return limits, tuple(value for _, value in tiers)
+
+def tier_value(tiers, quantity, default=0):
+    """The value of the first tier whose limit is >= quantity, found by binary search."""
+    limits, values = tiers
+    index = bisect_left(limits, quantity)
+    return values[index] if index < len(values) else default
+
+
+class PriceTables:
+    """
+    A price config (the config_manager.load_prices dict) compiled once into flat
+    lookups: fixed prices in dicts keyed by tuples, quantity tiers as sorted
+    (limits, values) tuples searched with bisect. It has no Tk or database
+    dependency, so the quote functions below can run anywhere.
+
+    A PriceTables is a read-only snapshot: its tables are tuples and mapping
+    proxies and its attributes cannot be reassigned. Price changes build a new
+    snapshot with the next version (see publish_prices), so a quote that holds
+    one keeps consistent prices even if the prices are saved meanwhile.
+    version_id is the id of the stored price version it was compiled from
+    (see PriceHistory), or None if the prices were never stored. customer_id
+    and customer_version_id are set on snapshots that include a customer's
+    special prices, the latter naming the stored version of those prices (see
+    CustomerPrices).
+    """
+
+    def __init__(self, config, version=0, version_id=None, customer_id=None, customer_version_id=None):
+        self.version = version
+        self.version_id = version_id
+        self.customer_id = customer_id
+        self.customer_version_id = customer_version_id
+        self.plain_paper_types = tuple(config['PLAIN_PAPER_TYPES'])
+        self.printing_types = tuple(config['PRINTING_PRICES'])
+        self.printing = MappingProxyType({(p_type, side): price
+                                          for p_type, sides in config['PRINTING_PRICES'].items()
+                                          for side, price in sides.items()})
+        self.plain_paper = MappingProxyType({(p_type, size, bracket, side): price
+                                             for p_type, sizes in config['PLAIN_PAPER_PRICES'].items()
+                                             for size, brackets in sizes.items()
+                                             for bracket, sides in brackets.items()
+                                             for side, price in sides.items()})
+        self.laser_paper = MappingProxyType({(p_type, size, side): price
+                                             for p_type, sizes in config['LASER_PLAIN_PAPER_PRICES'].items()
+                                             for size, sides in sizes.items()
+                                             for side, price in sides.items()})
+        self.quantity_threshold = config['QUANTITY_THRESHOLD']
+        self.lakta_prices = tuple(config['LAKTA_PRICES'])
+        self.lamination = MappingProxyType(dict(config['LAMINATION_PRICES']))
+        self.trimming = MappingProxyType(dict(config['TRIMMING_PRICES']))
+        self.binding = MappingProxyType(dict(config['BINDING_OPTIONS']))
+        self.min_cutting_price = config['MIN_CUTTING_PRICE']
+        self.id_cards = compile_tiers(config['ID_CARD_PRICING'])
+        self.stapling = MappingProxyType({'A4': compile_tiers(config['STAPLING_PRICING_A4']),
+                                          'A5': compile_tiers(config['STAPLING_PRICING_A5'])})
+        # شرائح تغليف المنيو واحدة لكل المقاسات، فتُفصل إلى جدول لكل مقاس
+        menu_tiers = config['MENU_LAMINATION_PRICING']
+        sizes = {size for _, prices in menu_tiers for size in prices}
+        self.menu_lamination = MappingProxyType({
+            size: compile_tiers([[limit, prices.get(size, 0)] for limit, prices in menu_tiers]) for size in sizes
+        })
+        self._config = copy.deepcopy(config)
+        self._frozen = True
+
+    def __setattr__(self, name, value):
+        if getattr(self, '_frozen', False):
+            raise AttributeError("price snapshots are read-only; use publish_prices to change prices")
+        super().__setattr__(name, value)
+
+    def config(self):
+        """A mutable deep copy of the config this snapshot was compiled from, for editing."""
+        return copy.deepcopy(self._config)
+
+    def sheet_price(self, paper_type, size, side, print_method, total_papers):
+        """Price of one plain paper sheet; ink prices drop above QUANTITY_THRESHOLD sheets."""
+        if print_method == LASER_METHOD:
+            return self.laser_paper[paper_type, size, side]
+        bracket = 'large' if total_papers > self.quantity_threshold else 'small'
+        return self.plain_paper[paper_type, size, bracket, side]
+
+    def copy_price(self, paper_type, side):
+        """Price of one coated paper or sticker copy; types with one side price fall back to it."""
+        key = (paper_type, side) if (paper_type, side) in self.printing else (paper_type, SINGLE_SIDED)
+        return self.printing[key]
+
+    def id_card_price(self, quantity):
+        if quantity <= 0:
+            return 0
+        return tier_value(self.id_cards, quantity)
+
+    def stapling_price(self, papers_per_book, size):
+        """Stapling price per book, tiered by the number of sheets in the book."""
+        return tier_value(self.stapling['A5' if size == 'A5' else 'A4'], papers_per_book)
+
+    def menu_lamination_price(self, quantity, size):
+        if not isinstance(quantity, (int, float)) or quantity <= 0 or size not in self.menu_lamination:
+            return 0
+        return tier_value(self.menu_lamination[size], quantity)
+
+
+# ==============================================================================
+# نسخة الأسعار الحالية
+# ==============================================================================
+_current = None
+_publish_lock = threading.Lock()
+
+def current_prices():
+    """
+    The PriceTables snapshot in force. Pages and services read prices only
+    through this, and should fetch it once per quote rather than keep it.
+    """
+    if _current is None:
+        import config_manager
+        publish_prices(config_manager.load_prices())
+    return _current
+
+def publish_prices(config, version_id=None):
+    """
+    Compiles config into a snapshot with the next version number and makes it
+    current in one reference swap, so readers see either the old or the new
+    prices, never a mix. Raises the compile error (and keeps the old prices)
+    if the config is incomplete. version_id is the stored price version the
+    config is (see PriceHistory.publish).
+    """
+    global _current
+    with _publish_lock:
+        snapshot = PriceTables(config, version=_current.version + 1 if _current else 1, version_id=version_id)
+        _current = snapshot
+    return snapshot
+
+
+# ==============================================================================
+# إصدارات الأسعار السابقة
+# ==============================================================================
+def price_sections(config):
+    """The PRICE_SECTIONS of a config, as stored in a price version."""
+    return {section: copy.deepcopy(config[section]) for section in PRICE_SECTIONS}
+
+class PriceHistory:
+    """
+    The effective-dated price versions of a store (price_versions table). The
+    (effective_from, id) index is loaded once and kept sorted, so the version in
+    force at a moment is one binary search; the configs themselves are read and
+    compiled on first use and kept in an LRU cache. Only `starts` and `ids`
+    may be read from other threads; prices() reads the store.
+    """
+
+    def __init__(self, store, cache_size=PRICE_VERSION_CACHE_SIZE):
+        self.store = store
+        self._compiled = lru_cache(maxsize=cache_size)(self._compile)
+        self.reload()
+
+    def reload(self):
+        versions = self.store.price_versions()
+        self.starts = tuple(effective_from for _, effective_from in versions)
+        self.ids = tuple(version_id for version_id, _ in versions)
+
+    def _compile(self, version_id):
+        config = self.store.get_price_version(version_id)
+        return None if config is None else PriceTables(config, version_id=version_id)
+
+    def prices(self, version_id):
+        """The PriceTables of a stored version, or None if there is no such version."""
+        return self._compiled(version_id)
+
+    def version_at(self, moment):
+        """
+        Id of the version in force at moment (a datetime or epoch seconds). Moments
+        before the first version get the first one, the oldest prices known.
+        None if no version was stored yet.
+        """
+        if not self.ids:
+            return None
+        epoch = moment.timestamp() if isinstance(moment, datetime) else moment
+        return self.ids[max(bisect_right(self.starts, epoch) - 1, 0)]
+
+    def prices_at(self, moment):
+        version_id = self.version_at(moment)
+        return None if version_id is None else self.prices(version_id)
+
+    def publish(self, config, effective_from=None):
+        """
+        Makes config the prices in force: compiles it (raising, with nothing
+        stored, if it is incomplete), stores it as a new version effective from
+        effective_from (default now) unless its prices equal the latest
+        version's, and publishes it with that version id. Returns the snapshot.
+        """
+        sections = price_sections(PriceTables(config).config())
+        latest = self.prices(self.ids[-1]) if self.ids else None
+        if latest is not None and price_sections(latest.config()) == sections:
+            version_id = latest.version_id
+        else:
+            version_id = self.store.save_price_version(sections, effective_from or datetime.now())
+            self.reload()
+        return publish_prices(config, version_id=version_id)
+
+
+# ==============================================================================
+# الأسعار الخاصة بالعملاء
+# ==============================================================================
+def _overlay(prices, overrides):
+    merged = dict(prices)
+    for key, value in overrides.items():
+        if key in merged:
+            merged[key] = _overlay(merged[key], value) if isinstance(merged[key], dict) else value
+    return merged
+
+def _changed(prices, edited):
+    changed = {}
+    for key, value in edited.items():
+        if isinstance(value, dict):
+            nested = _changed(prices.get(key, {}), value)
+            if nested:
+                changed[key] = nested
+        elif prices.get(key) != value:
+            changed[key] = value
+    return changed
+
+def overlay_prices(config, overrides):
+    """
+    config with a customer's overrides layered on top: in CUSTOMER_PRICE_SECTIONS
+    each overridden price replaces the list's, CUSTOMER_TIER_SECTIONS are
+    replaced whole. Overridden prices the list no longer has (a removed paper
+    type or size) are ignored.
+    """
+    merged = dict(config)
+    for section in CUSTOMER_PRICE_SECTIONS:
+        if section in overrides:
+            merged[section] = _overlay(config[section], overrides[section])
+    for section in CUSTOMER_TIER_SECTIONS:
+        if section in overrides:
+            merged[section] = copy.deepcopy(overrides[section])
+    return merged
+
+def price_overrides(config, edited):
+    """The overrides that turn config into edited: the inverse of overlay_prices, keeping only what differs."""
+    overrides = {}
+    for section in CUSTOMER_PRICE_SECTIONS:
+        changed = _changed(config[section], edited[section])
+        if changed:
+            overrides[section] = changed
+    for section in CUSTOMER_TIER_SECTIONS:
+        if edited[section] != config[section]:
+            overrides[section] = copy.deepcopy(edited[section])
+    return overrides
+
+def with_customer_prices(prices, overrides, customer_id=None, customer_version_id=None):
+    """prices with a customer's overrides layered on (see overlay_prices), or prices itself if there are none."""
+    if not overrides:
+        return prices
+    return PriceTables(overlay_prices(prices.config(), overrides), version=prices.version,
+                       version_id=prices.version_id, customer_id=customer_id,
+                       customer_version_id=customer_version_id)
+
+class CustomerPrices:
+    """
+    Customer price lists: a customer's overrides (customer_price_versions table)
+    layered on the price list in force and compiled into one PriceTables, so
+    quoting for the customer costs the same flat lookups as the list itself.
+    Overrides are stored as versions that never change and each receipt records
+    the version it was priced with, so past sales can be priced again exactly.
+    Snapshots are built when first asked for (on customer selection) and kept in
+    an LRU cache keyed by customer version and list snapshot, so publishing new
+    prices rebuilds them on next use. Call invalidate() after saving a customer's
+    overrides.
+    """
+
+    def __init__(self, store, cache_size=CUSTOMER_PRICES_CACHE_SIZE):
+        self.store = store
+        self._versions = lru_cache(maxsize=cache_size)(store.customer_price_version)
+        self._compiled = lru_cache(maxsize=cache_size)(self._compile)
+
+    def _compile(self, customer_version_id, prices):
+        version = self.store.get_customer_price_version(customer_version_id)
+        if version is None:
+            return prices
+        customer_id, overrides = version
+        return with_customer_prices(prices, overrides, customer_id, customer_version_id)
+
+    def prices_with(self, customer_version_id, prices=None):
+        """prices (default the list in force) with a stored customer prices version, or prices itself for None."""
+        prices = prices or current_prices()
+        if customer_version_id is None:
+            return prices
+        return self._compiled(customer_version_id, prices)
+
+    def prices_for(self, customer_id, prices=None):
+        """
+        The snapshot to quote customer_id with: prices (default the list in force)
+        with the customer's current overrides, or prices itself for a customer
+        without any.
+        """
+        if customer_id is None:
+            return prices or current_prices()
+        return self.prices_with(self._versions(customer_id), prices)
+
+    def invalidate(self):
+        # الإصدارات المحفوظة لا تتغير، فيكفي نسيان الإصدار الحالي لكل عميل
+        self._versions.cache_clear()
+
+
+# ==============================================================================
+# حساب الأسعار
+# ==============================================================================
+def _positive_count(value):
+    if value <= 0:
+        raise ValueError("العدد يجب أن يكون أكبر من صفر")
+    return value
+
+def quote_plain_paper(prices, paper_type, size, side, print_method, quantity, papers_per_book=None):
+    """
+    Prices the printing of a plain paper job: quantity loose sheets, or quantity
+    books of papers_per_book sheets each. Returns the job dict the finishing step
+    takes (printing_cost in pounds, items_to_finish = sheets or books).
+    """
+    is_book_order = papers_per_book is not None
+    total_papers = _positive_count(quantity) * (_positive_count(papers_per_book) if is_book_order else 1)
+    price_per_sheet = prices.sheet_price(paper_type, size, side, print_method, total_papers)
+    return {
+        "type": PLAIN_PAPER,
+        "paper_size": size,
+        "is_book_order": is_book_order,
+        "papers_per_book": papers_per_book or 0,
+        "description": f"{paper_type} ({size})",
+        "printing_cost": price_per_sheet * total_papers,
+        "items_to_finish": quantity,
+        "price_ref": ('sheet', paper_type, size, side, print_method, total_papers),
+        "versions": snapshot_versions(prices),
+    }
+
+def quote_kocheh(prices, paper_type, side, quantity, lakta_price=None):
+    """
+    Prices coated paper or sticker printing: quantity copies at the config price,
+    or, when lakta_price is given, quantity shots at that price per side.
+    Stickers are always printed on one side.
+    """
+    if 'استيكر' in paper_type and side == DOUBLE_SIDED:
+        side = SINGLE_SIDED
+    _positive_count(quantity)
+    if lakta_price is None:
+        printing_cost = prices.copy_price(paper_type, side) * quantity
+        description = paper_type
+        price_ref = ('copy', paper_type, side)
+    else:
+        printing_cost = quantity * lakta_price * (2 if side == DOUBLE_SIDED else 1)
+        description = f"{paper_type} (لقطات)"
+        price_ref = None  # سعر اللقطة يُكتب يدوياً
+    return {
+        "type": KOCHEH,
+        "paper_size": "A3+",
+        "is_book_order": True,  # كل لقطة قد تحتاج تشطيب منفصل
+        "description": description,
+        "printing_cost": printing_cost,
+        "items_to_finish": quantity,
+        "price_ref": price_ref,
+        "versions": snapshot_versions(prices),
+    }
+
+def quote_id_cards(prices, quantity):
+    price_per_card = prices.id_card_price(_positive_count(quantity))
+    return [line_item(ID_CARD_PRODUCT, quantity, price_per_card, quantity * price_per_card, ID_CARD, None,
+                      ('id_card',), snapshot_versions(prices))]
+
+def quote_finishing(prices, job, lamination=NO_OPTION, trimming=NO_OPTION, cutting_price=0, binding=NO_OPTION,
+                    stapling_size=None, menu_quantity=0, menu_size='A4'):
+    """
+    Returns the line items of a printed job (from quote_plain_paper or
+    quote_kocheh) with its finishing: lamination, trimming, cutting, binding,
+    stapling (book orders only, stapling_size 'A4' or 'A5') and menu lamination.
+    The printing line keeps the versions of the prices the job was quoted with.
+    """
+    versions = snapshot_versions(prices)
+    items_to_finish = max(job.get("items_to_finish", 1), 1)
+    is_book_order = job.get("is_book_order", False)
+    product_type, paper_size = job.get("type"), job.get("paper_size")
+    finishing_quantity = items_to_finish if is_book_order else 1
+
+    printing_cost = job.get('printing_cost', 0)
+    items = [line_item(clean_description(job.get('description', '')), items_to_finish,
+                       printing_cost / items_to_finish, printing_cost, product_type, paper_size, job.get('price_ref'),
+                       job.get('versions', versions))]
+    for kind, choice, table in [('lamination', lamination, prices.lamination), ('trimming', trimming, prices.trimming)]:
+        if choice and choice != NO_OPTION:
+            items.append(line_item(choice, finishing_quantity, table[choice], table[choice] * finishing_quantity,
+                                   product_type, paper_size, (kind, choice), versions))
+    if cutting_price > 0:
+        items.append(line_item("خدمة قص", 1, cutting_price, cutting_price, product_type, paper_size))
+    if binding and binding != NO_OPTION:
+        price = prices.binding.get(binding, 0)
+        items.append(line_item(clean_description(f"تجليد: {binding.strip()}"), finishing_quantity, price, price * finishing_quantity,
+                               product_type, paper_size, ('binding', binding), versions))
+    # سعر البشر حسب عدد ورق الكتاب الواحد، والكمية هي عدد الكتب
+    papers_per_book = job.get("papers_per_book", 0)
+    if stapling_size and is_book_order and papers_per_book > 0:
+        price = prices.stapling_price(papers_per_book, stapling_size)
+        items.append(line_item(clean_description(f"خدمة بشر ({stapling_size})"), items_to_finish, price,
+                               price * items_to_finish, product_type, paper_size,
+                               ('stapling', stapling_size, papers_per_book), versions))
+    if menu_quantity:
+        price = prices.menu_lamination_price(_positive_count(menu_quantity), menu_size)
+        if price > 0:
+            items.append(line_item(f"تغليف منيو حراري ({menu_size})", menu_quantity, price, price * menu_quantity,
+                                   product_type, paper_size, ('menu', menu_size), versions))
+    return items
+
+def quote(prices, paper_type, quantity, size='A4', side=SINGLE_SIDED, print_method=INK_METHOD, papers_per_book=None,
+          lakta_price=None, **finishing):
+    """
+    Prices one job end to end, the way the order wizard does, and returns its
+    line items. paper_type picks the product: ID_CARD_PRODUCT, one of the plain
+    paper types, or a coated paper/sticker type. finishing is passed to
+    quote_finishing. Raises ValueError for non-positive counts and KeyError for
+    a paper type, size or side the config has no price for.
+    """
+    if paper_type == ID_CARD_PRODUCT:
+        return quote_id_cards(prices, quantity)
+    if paper_type in prices.plain_paper_types:
+        job = quote_plain_paper(prices, paper_type, size, side, print_method, quantity, papers_per_book)
+    else:
+        job = quote_kocheh(prices, paper_type, side, quantity, lakta_price)
+    return quote_finishing(prices, job, **finishing)
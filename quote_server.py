@@ -0,0 +1,305 @@
+# quote_server.py
+
+import argparse
+import asyncio
+import json
+import math
+import urllib.error
+import urllib.request
+from datetime import datetime
+from functools import lru_cache
+from http import HTTPStatus
+
+import pricing
+from batch_quote import DEFAULTS, JOB_COLUMNS
+from money import to_piastres, to_pounds
+
+# الخدمة على الجهاز نفسه افتراضياً؛ للشبكة الداخلية شغلها بـ --host 0.0.0.0
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+
+# عدد الطلبات التي تُخدم في نفس الوقت، والباقي ينتظر دوره
+MAX_CONCURRENT_REQUESTS = 8
+# مهلة قراءة الطلب كاملاً (ثانية)، وأقصى حجم لجسم الطلب
+REQUEST_TIMEOUT = 10
+MAX_BODY_BYTES = 64 * 1024
+# عدد عروض الأسعار المحفوظة في الذاكرة: نفس الطلب بنفس الأسعار يُرد بدون إعادة حساب
+QUOTE_CACHE_SIZE = 1024
+# كل كم ثانية تُقرأ الأسعار التي حفظها البرنامج (إصدار جديد أو أسعار خاصة بعميل)
+PRICE_REFRESH_SECONDS = 30
+
+NO_PRICE_ERROR = "لا يوجد سعر لهذا النوع أو المقاس أو الأوجه"
+# القيم المقبولة للأوجه ونوع الطباعة (ثابتة في البرنامج وليست في الأسعار)
+SIDES = (pricing.SINGLE_SIDED, pricing.DOUBLE_SIDED)
+PRINT_METHODS = (pricing.INK_METHOD, pricing.LASER_METHOD)
+
+
+# ==============================================================================
+# تسعير طلب واحد
+# ==============================================================================
+def _amount(value):
+    try:
+        number = float(value)
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError(f"قيمة غير صالحة: {value}") from None
+    # json يقبل Infinity و NaN، و 1e400 تُقرأ كـ inf
+    if not math.isfinite(number):
+        raise ValueError(f"قيمة غير صالحة: {value}")
+    return number
+
+def _whole(value):
+    number = _amount(value)
+    if number != int(number):
+        raise ValueError("الأعداد يجب أن تكون أعداداً صحيحة")
+    return int(number)
+
+def _choice(field, value, choices):
+    if value not in choices:
+        raise ValueError(f"قيمة غير صالحة لـ {field}: {value} (المتاح: {', '.join(choices)})")
+    return value
+
+def paper_sizes(prices, paper_type):
+    """The sizes the prices have a sheet price for, for a plain paper type."""
+    return sorted({key[1] for table in (prices.plain_paper, prices.laser_paper) for key in table if key[0] == paper_type})
+
+def check_choices(prices, arguments):
+    """
+    Raises KeyError for a size or finishing choice in job_arguments that the
+    prices have no price for, instead of letting pricing.quote price it as 0 or
+    as another size.
+    """
+    choices = [('lamination', prices.lamination), ('trimming', prices.trimming), ('binding', prices.binding),
+               ('stapling_size', prices.stapling), ('menu_size', prices.menu_lamination)]
+    if arguments['paper_type'] in prices.plain_paper_types:
+        choices.append(('size', paper_sizes(prices, arguments['paper_type'])))
+    for field, table in choices:
+        value = arguments[field]
+        if value and value != pricing.NO_OPTION and value not in table:
+            raise KeyError(f"{field}: {value}")
+
+def job_arguments(job):
+    """
+    pricing.quote keyword arguments for a job dict with the batch_quote.JOB_COLUMNS
+    field names (missing fields get the wizard's defaults), the same mapping as
+    batch_quote.to_line_items. Raises ValueError for unknown fields, a missing
+    paper_type or quantity, a number that is not finite, a count that is not a
+    whole number, or sides or print_method outside SIDES and PRINT_METHODS.
+    """
+    unknown = sorted(set(job) - set(JOB_COLUMNS))
+    if unknown:
+        raise ValueError(f"حقول غير معروفة: {', '.join(unknown)}")
+    missing = [key for key in ('paper_type', 'quantity') if job.get(key) is None]
+    if missing:
+        raise ValueError(f"حقول إجبارية: {', '.join(missing)}")
+    values = {**DEFAULTS, **{key: value for key, value in job.items() if value is not None}}
+    return dict(
+        paper_type=str(values['paper_type']).strip(), quantity=_whole(values['quantity']),
+        size=values['size'], side=_choice('sides', values['sides'], SIDES),
+        print_method=_choice('print_method', values['print_method'], PRINT_METHODS),
+        papers_per_book=_whole(values['papers_per_book']) if values.get('papers_per_book') else None,
+        lakta_price=_amount(values['lakta_price']) if 'lakta_price' in values else None,
+        lamination=values['lamination'], trimming=values['trimming'],
+        cutting_price=_amount(values.get('cutting_price', 0)),
+        binding=values['binding'], stapling_size=values['stapling_size'] or None,
+        menu_quantity=_whole(values.get('menu_quantity', 0)), menu_size=values['menu_size'],
+    )
+
+def quote_response(prices, job):
+    """
+    Prices one job with pricing.quote, the rules of the order wizard pages.
+    Returns (HTTPStatus, payload): the line items and total in pounds, or an
+    'error' message for a bad job (400) or one the prices have no price for (422).
+    """
+    try:
+        arguments = job_arguments(job)
+        check_choices(prices, arguments)
+        items = pricing.quote(prices, **arguments)
+    except (ValueError, TypeError, ArithmeticError) as e:
+        return HTTPStatus.BAD_REQUEST, {'error': str(e)}
+    except KeyError as e:
+        return HTTPStatus.UNPROCESSABLE_ENTITY, {'error': f"{NO_PRICE_ERROR}: {e}"}
+    return HTTPStatus.OK, {
+        'items': [{key: item[key] for key in ('description', 'quantity', 'unit_price', 'subtotal')} for item in items],
+        'total': to_pounds(sum(to_piastres(item['subtotal']) for item in items)),
+        'price_version_id': prices.version_id,
+        'special_prices': prices.customer_id is not None,
+    }
+
+def price_options(prices):
+    """The choices a job can use, so a client can offer the same options as the wizard."""
+    return {
+        'fields': JOB_COLUMNS,
+        'plain_paper_types': list(prices.plain_paper_types),
+        'printing_types': list(prices.printing_types),
+        'id_card_product': pricing.ID_CARD_PRODUCT,
+        'sizes': {paper_type: paper_sizes(prices, paper_type) for paper_type in prices.plain_paper_types},
+        'sides': list(SIDES),
+        'print_methods': list(PRINT_METHODS),
+        'lakta_prices': list(prices.lakta_prices),
+        'lamination': list(prices.lamination),
+        'trimming': list(prices.trimming),
+        'binding': list(prices.binding),
+        'stapling_sizes': list(prices.stapling),
+        'menu_sizes': list(prices.menu_lamination),
+    }
+
+
+# ==============================================================================
+# خادم HTTP
+# ==============================================================================
+def _json(payload):
+    return json.dumps(payload, ensure_ascii=False).encode('utf-8')
+
+class QuoteServer:
+    """
+    A headless HTTP JSON quote service on asyncio, so phone and WhatsApp quotes
+    do not tie up a counter terminal:
+
+        POST /quote    a job with the batch_quote.JOB_COLUMNS fields, plus an
+                       optional customer_phone for the customer's special prices
+        GET  /options  the paper types and finishing choices
+
+    At most max_concurrent requests are served at a time; the rest wait. Answers
+    are kept in an LRU cache keyed by the price snapshot and the job, so a
+    repeated quote costs one dict lookup and new prices start a fresh set of
+    keys. The store is only used from the event loop's thread.
+    """
+
+    def __init__(self, store, host=DEFAULT_HOST, port=DEFAULT_PORT, max_concurrent=MAX_CONCURRENT_REQUESTS,
+                 cache_size=QUOTE_CACHE_SIZE):
+        self.store = store
+        self.host = host
+        self.port = port
+        self.max_concurrent = max_concurrent
+        self.limit = None
+        self.history = pricing.PriceHistory(store)
+        self.customer_prices = pricing.CustomerPrices(store)
+        self._cached_quote = lru_cache(maxsize=cache_size)(self._quote)
+
+    def _quote(self, prices, job_text):
+        status, payload = quote_response(prices, json.loads(job_text))
+        return status, _json(payload)
+
+    def refresh_prices(self):
+        """Publishes the stored price version in force if the app saved new prices, and drops compiled customer prices."""
+        self.history.reload()
+        version_id = self.history.version_at(datetime.now())
+        if version_id is not None and version_id != pricing.current_prices().version_id:
+            pricing.publish_prices(self.history.prices(version_id).config(), version_id=version_id)
+        self.customer_prices.invalidate()
+
+    def prices_for(self, customer_phone):
+        customer = self.store.find_customer_by_phone(str(customer_phone)) if customer_phone else None
+        return self.customer_prices.prices_for(customer[0] if customer else None)
+
+    def respond(self, method, target, body):
+        """(HTTPStatus, JSON body bytes) for one request."""
+        path = target.split('?', 1)[0]
+        if path == '/options':
+            if method != 'GET':
+                return HTTPStatus.METHOD_NOT_ALLOWED, _json({'error': "استخدم GET"})
+            return HTTPStatus.OK, _json(price_options(pricing.current_prices()))
+        if path != '/quote':
+            return HTTPStatus.NOT_FOUND, _json({'error': "المسار غير موجود (/quote أو /options)"})
+        if method != 'POST':
+            return HTTPStatus.METHOD_NOT_ALLOWED, _json({'error': "استخدم POST"})
+        try:
+            job = json.loads(body or b'null')
+        except ValueError:
+            return HTTPStatus.BAD_REQUEST, _json({'error': "JSON غير صالح"})
+        if not isinstance(job, dict):
+            return HTTPStatus.BAD_REQUEST, _json({'error': "الطلب يجب أن يكون JSON object"})
+        prices = self.prices_for(job.pop('customer_phone', None))
+        return self._cached_quote(prices, json.dumps(job, sort_keys=True, ensure_ascii=False))
+
+    async def _read_request(self, reader):
+        request_line = (await reader.readline()).decode('latin-1').split()
+        if len(request_line) != 3:
+            raise ValueError("bad request line")
+        method, target, _ = request_line
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length') or 0)
+        if length > MAX_BODY_BYTES:
+            return HTTPStatus.REQUEST_ENTITY_TOO_LARGE, _json({'error': "الطلب أكبر من المسموح"})
+        body = await reader.readexactly(length) if length > 0 else b''
+        return self.respond(method, target, body)
+
+    async def handle(self, reader, writer):
+        async with self.limit:
+            try:
+                status, body = await asyncio.wait_for(self._read_request(reader), REQUEST_TIMEOUT)
+            except asyncio.TimeoutError:
+                status, body = HTTPStatus.REQUEST_TIMEOUT, _json({'error': "انتهت مهلة الطلب"})
+            except (ValueError, asyncio.IncompleteReadError):
+                status, body = HTTPStatus.BAD_REQUEST, _json({'error': "طلب HTTP غير صالح"})
+            except Exception as e:
+                status, body = HTTPStatus.INTERNAL_SERVER_ERROR, _json({'error': str(e)})
+            writer.write(f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+                         f"Content-Type: application/json; charset=utf-8\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode('latin-1') + body)
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
+            finally:
+                writer.close()
+
+    async def serve(self, progress=print):
+        """Serves until cancelled, re-reading the stored prices every PRICE_REFRESH_SECONDS."""
+        self.limit = asyncio.Semaphore(self.max_concurrent)
+        self.refresh_prices()
+        server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = server.sockets[0].getsockname()[1]
+        progress(f"Quote server: listening on http://{self.host}:{self.port}")
+        async with server:
+            while True:
+                await asyncio.sleep(PRICE_REFRESH_SECONDS)
+                try:
+                    self.refresh_prices()
+                except Exception as e:
+                    progress(f"Quote server: could not re-read prices ({e}); keeping the current ones")
+
+
+# ==============================================================================
+# عميل للتجربة
+# ==============================================================================
+def request_quote(job, url=f"http://{DEFAULT_HOST}:{DEFAULT_PORT}"):
+    """Sends a job to a running quote server and returns (status code, response dict)."""
+    request = urllib.request.Request(url.rstrip('/') + '/quote', data=_json(job),
+                                     headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request, timeout=REQUEST_TIMEOUT) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+if __name__ == '__main__':
+    import config_manager
+    from storage import open_store
+
+    parser = argparse.ArgumentParser(description="Answer print job quote requests over HTTP with the current prices.")
+    parser.add_argument('--host', default=DEFAULT_HOST, help="address to listen on (0.0.0.0 for the local network)")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--ask', metavar='JOB_JSON',
+                        help='send this job to a running server instead, e.g. \'{"paper_type": "كروت ID", "quantity": 50}\'')
+    args = parser.parse_args()
+
+    if args.ask:
+        code, answer = request_quote(json.loads(args.ask), f"http://{args.host}:{args.port}")
+        print(code, json.dumps(answer, ensure_ascii=False, indent=2))
+    else:
+        store = open_store(config_manager.load_prices().get('DATABASE'))
+        try:
+            store.init_schema()
+            asyncio.run(QuoteServer(store, args.host, args.port).serve())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            store.close()
@@ -0,0 +1,68 @@
+# receipt_codec.py
+
+import json
+import zlib
+from datetime import datetime
+
+from money import to_piastres, to_pounds
+
+# receipts.receipt_data يحفظ بنود الفاتورة فقط كـ JSON مضغوط، والنص الكامل يُبنى عند العرض
+PAYLOAD_VERSION = 1
+COMPRESSION_LEVEL = 9
+
+
+def _compress(payload):
+    return zlib.compress(json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8'), COMPRESSION_LEVEL)
+
+def encode_receipt(items):
+    """
+    Returns the compact receipt_data blob for a list of order line dicts (as built
+    by the pages, priced in pounds). Prices are stored as integer piastres.
+    """
+    return _compress({
+        'v': PAYLOAD_VERSION,
+        'items': [{
+            'description': item.get('description', ''),
+            'quantity': item.get('quantity', 1),
+            'unit_price': to_piastres(item.get('unit_price', 0)),
+            'subtotal': to_piastres(item.get('subtotal', 0)),
+            'product_type': item.get('product_type'),
+            'paper_size': item.get('paper_size'),
+        } for item in items],
+    })
+
+def encode_legacy_text(receipt_text):
+    """Compresses a receipt that was saved as fully rendered text before this format existed."""
+    return _compress({'v': PAYLOAD_VERSION, 'text': receipt_text})
+
+def decode_receipt(receipt_data):
+    """Returns the payload dict of a stored receipt. Uncompressed legacy text comes back as {'text': ...}."""
+    if isinstance(receipt_data, str):
+        return {'v': 0, 'text': receipt_data}
+    return json.loads(zlib.decompress(receipt_data).decode('utf-8'))
+
+def receipt_render_data(receipt_id, ts_epoch, total_amount, discount, amount_paid, remaining_amount, notes, due_date,
+                        receipt_data, customer_name, customer_phone):
+    """
+    Builds the dict that format_receipt_for_display and the PDF/image/printer
+    renderers take, from one row of DataStore.RECEIPT_COLUMNS. Returns
+    (data, legacy_text): legacy_text is the stored text for receipts saved before
+    the compact format, and None otherwise.
+    """
+    payload = decode_receipt(receipt_data)
+    items = [dict(item, unit_price=to_pounds(item['unit_price']), subtotal=to_pounds(item['subtotal']))
+             for item in payload.get('items', [])]
+    data = {
+        "receipt_id": receipt_id,
+        "customer_name": customer_name or '',
+        "timestamp": datetime.fromtimestamp(ts_epoch) if ts_epoch is not None else datetime.now(),
+        "items": items,
+        "subtotal": to_pounds(total_amount),
+        "discount": to_pounds(discount),
+        "paid": to_pounds(amount_paid),
+        "remaining": to_pounds(remaining_amount),
+        "notes": notes or '',
+        "due_date": due_date or '',
+        "customer_phone": customer_phone,
+    }
+    return data, payload.get('text')
@@ -0,0 +1,420 @@
+# repricing.py
+
+import argparse
+import json
+import threading
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+
+import pricing
+from batch_quote import lookup, tier_values
+from migrations import parse_legacy_receipt_items
+from money import PIASTRES_PER_POUND, to_piastres
+from receipt_codec import decode_receipt
+
+DEFAULT_DAYS = 90
+
+# أعمدة بنود المبيعات (الأسعار بالقرش)؛ sale_version هو إصدار الأسعار الذي بيع به البند (انظر sale_versions)
+# و customer_version إصدار أسعار العميل الخاصة المسجل على الفاتورة
+LINE_COLUMNS = ['receipt_id', 'sale_version', 'customer_version', 'description', 'quantity', 'unit_price', 'subtotal',
+                'product_type', 'paper_size', 'price_ref']
+
+# إصدار البنود المبيعة قبل حفظ أي إصدار أسعار، وتُقارن بالأسعار الحالية؛
+# وفي customer_version: بيع بأسعار القائمة بدون أسعار خاصة
+NO_VERSION = -1
+
+# أعمدة تقرير المحاكاة لكل منتج (المبالغ بالجنيه) وأسماؤها العربية
+REPORT_COLUMNS = {
+    'lines': 'عدد البنود',
+    'actual': 'الدخل الفعلي',
+    'candidate': 'الدخل بالأسعار الجديدة',
+    'delta': 'الفرق',
+    'delta_pct': 'نسبة التغير %',
+    'unmatched': 'بنود بدون سعر مرجعي',
+}
+
+
+# ==============================================================================
+# قراءة المبيعات السابقة
+# ==============================================================================
+def sale_versions(history, ts_epoch, price_version_id):
+    """
+    The price version each sale was priced with: the one recorded on the
+    receipt, or else the version in force at its time, found for all rows with
+    one np.searchsorted over the sorted effective dates (see
+    pricing.PriceHistory.version_at). NO_VERSION if no version was stored yet.
+    """
+    recorded = pd.to_numeric(pd.Series(price_version_id, dtype=object), errors='coerce').fillna(NO_VERSION)
+    if not history.ids:
+        return recorded.to_numpy(dtype=np.int64)
+    position = np.searchsorted(np.asarray(history.starts, dtype=float), np.asarray(ts_epoch, dtype=float), side='right')
+    in_force = np.asarray(history.ids, dtype=np.int64)[np.maximum(position - 1, 0)]
+    return np.where(recorded >= 0, recorded, in_force).astype(np.int64)
+
+def load_history(store, history, start_date, end_date):
+    """
+    Reads what was sold over the dates (end date inclusive) through the store.
+    Returns (lines, legacy_receipts, sale_prices, customer_overrides): the
+    receipt_items rows (LINE_COLUMNS), the (receipt_id, sale_version,
+    receipt_data) of receipts that have none, {sale_version: PriceTables} for
+    every version they were sold with (NO_VERSION maps to the current prices)
+    and {customer_version: overrides} for every customer prices version they
+    were sold with (None if it is no longer stored). Everything that reads the
+    store runs here; history_lines and simulate can then run off the Tk thread.
+    """
+    lines = store.sold_line_items(start_date, end_date)
+    lines['sale_version'] = sale_versions(history, lines['ts_epoch'], lines['price_version_id'])
+    lines['customer_version'] = (pd.to_numeric(pd.Series(lines['customer_price_version_id'], dtype=object), errors='coerce')
+                                 .fillna(NO_VERSION).to_numpy(dtype=np.int64))
+    receipts = store.receipts_without_items(start_date, end_date)
+    versions = sale_versions(history, [row[1] for row in receipts], [row[2] for row in receipts])
+    legacy_receipts = [(row[0], int(version), row[3]) for row, version in zip(receipts, versions)]
+
+    sale_prices = {}
+    for version in set(lines['sale_version'].tolist()) | set(versions.tolist()):
+        # إصدار محذوف أو غير موجود يُعامل كأنه لم يُسجل
+        sale_prices[version] = (history.prices(version) if version != NO_VERSION else None) or pricing.current_prices()
+    customer_overrides = {}
+    for version in set(lines['customer_version'].tolist()) - {NO_VERSION}:
+        stored = store.get_customer_price_version(version)
+        customer_overrides[version] = stored[1] if stored is not None else None
+    return lines[LINE_COLUMNS], legacy_receipts, sale_prices, customer_overrides
+
+def legacy_lines(receipts):
+    """
+    Line items (LINE_COLUMNS, in piastres, no price_ref) read back from the
+    receipt_data of receipts without receipt_items, which predate special prices.
+    """
+    rows = []
+    for receipt_id, sale_version, receipt_data in receipts:
+        payload = decode_receipt(receipt_data)
+        if 'items' in payload:
+            items = payload['items']
+        else:
+            # النص القديم مسعر بالجنيه
+            items = [{**item, 'unit_price': to_piastres(item['unit_price']), 'subtotal': to_piastres(item['subtotal'])}
+                     for item in parse_legacy_receipt_items(payload.get('text', ''))]
+        rows.extend((receipt_id, sale_version, NO_VERSION, item.get('description', ''), item.get('quantity', 1), item.get('unit_price', 0),
+                     item.get('subtotal', 0), item.get('product_type'), item.get('paper_size'), None) for item in items)
+    return pd.DataFrame(rows, columns=LINE_COLUMNS)
+
+def history_lines(lines, legacy_receipts):
+    """All sold line items: the receipt_items rows followed by the lines recovered from legacy receipts."""
+    if not legacy_receipts:
+        return lines
+    return pd.concat([lines, legacy_lines(legacy_receipts)], ignore_index=True)
+
+
+# ==============================================================================
+# مراجع الأسعار
+# ==============================================================================
+def _description_index(prices):
+    """
+    Maps every line description the quote functions can write (after
+    clean_description) to the price_ref it comes from. For copies, sheets and
+    stapling the side, print method or book size is not in the description, so
+    the ref is partial and _infer_ref completes it from the unit price.
+    """
+    index = {}
+
+    def add(description, price_ref):
+        index.setdefault(pricing.clean_description(description), price_ref)
+
+    add(pricing.ID_CARD_PRODUCT, ('id_card',))
+    for kind, table in [('lamination', prices.lamination), ('trimming', prices.trimming)]:
+        for choice in table:
+            if choice != pricing.NO_OPTION:
+                add(choice, (kind, choice))
+    for binding in prices.binding:
+        if binding != pricing.NO_OPTION:
+            add(f"تجليد: {binding.strip()}", ('binding', binding))
+    for size in prices.stapling:
+        add(f"خدمة بشر ({size})", ('stapling', size))
+    for size in prices.menu_lamination:
+        add(f"تغليف منيو حراري ({size})", ('menu', size))
+    for paper_type in prices.printing_types:
+        add(paper_type, ('copy', paper_type))
+    for paper_type, size, *_ in list(prices.plain_paper) + list(prices.laser_paper):
+        add(f"{paper_type} ({size})", ('sheet', paper_type, size))
+    return index
+
+def _same_price(price, unit_price):
+    return abs(to_piastres(price) - unit_price) <= 1
+
+def _infer_sheet(prices, paper_type, size, quantity, unit_price):
+    # سعر وحدة بند الطباعة = سعر الورقة × عدد ورق الكتاب (1 للورق الفردي)، فيُجرب كل وجه وطريقة طباعة
+    # ويُختار أقل عدد ورق يعطي نفس السعر في نفس شريحة الكمية
+    matches = []
+    for method in (pricing.INK_METHOD, pricing.LASER_METHOD):
+        for side in (pricing.SINGLE_SIDED, pricing.DOUBLE_SIDED):
+            if method == pricing.LASER_METHOD:
+                sheet_prices = [prices.laser_paper.get((paper_type, size, side))]
+            else:
+                sheet_prices = [prices.plain_paper.get((paper_type, size, bracket, side)) for bracket in ('small', 'large')]
+            for price in sheet_prices:
+                if not price or price <= 0:
+                    continue
+                papers = round(unit_price / to_piastres(price))
+                if (papers >= 1 and _same_price(price * papers, unit_price)
+                        and prices.sheet_price(paper_type, size, side, method, quantity * papers) == price):
+                    matches.append((papers, ('sheet', paper_type, size, side, method, quantity * papers)))
+    return min(matches, key=lambda match: match[0])[1] if matches else None
+
+def _infer_ref(prices, index, description, quantity, unit_price):
+    price_ref = index.get(pricing.clean_description(description))
+    if price_ref is None or quantity <= 0:
+        return None
+    kind = price_ref[0]
+    if kind == 'copy':
+        paper_type = price_ref[1]
+        for side in (pricing.SINGLE_SIDED, pricing.DOUBLE_SIDED):
+            if (paper_type, side) in prices.printing and _same_price(prices.printing[paper_type, side], unit_price):
+                return ('copy', paper_type, side)
+        return None
+    if kind == 'stapling':
+        # يكفي أي عدد ورق داخل الشريحة التي سعرها هو سعر البند
+        limits, values = prices.stapling[price_ref[1]]
+        for i, value in enumerate(values):
+            if _same_price(value, unit_price):
+                papers_per_book = limits[i] if limits[i] != float('inf') else (limits[i - 1] + 1 if i else 1)
+                return ('stapling', price_ref[1], int(papers_per_book))
+        return None
+    if kind == 'sheet':
+        return _infer_sheet(prices, price_ref[1], price_ref[2], quantity, unit_price)
+    return price_ref
+
+def with_customer_version(prices, customer_overrides, customer_version):
+    """
+    prices with the special prices of customer_version layered on (prices itself
+    for NO_VERSION), or None if that version's overrides are unknown.
+    """
+    if customer_version == NO_VERSION:
+        return prices
+    overrides = (customer_overrides or {}).get(customer_version)
+    if overrides is None:
+        return None
+    return pricing.with_customer_prices(prices, overrides)
+
+def price_refs(sale_prices, lines, customer_overrides=None):
+    """
+    The price_ref tuple of every line (None where unknown). Stored refs are
+    parsed; lines saved before refs were recorded are matched by description
+    and unit price against the prices they were sold at: sale_prices[sale_version]
+    with the customer_version special prices. Each distinct (version, customer
+    version, description, quantity, unit price) is matched once.
+    """
+    stored = lines['price_ref']
+    parsed = {text: tuple(json.loads(text)) for text in stored.dropna().unique()}
+    refs = pd.Series(stored.map(parsed), dtype=object)
+    missing = stored.isna().to_numpy()
+    if missing.any():
+        keys = list(lines.loc[missing, ['sale_version', 'customer_version', 'description', 'quantity', 'unit_price']]
+                    .itertuples(index=False, name=None))
+        sold_at = {(version, customer_version): with_customer_version(sale_prices[version], customer_overrides, customer_version)
+                   for version, customer_version, *_ in set(keys)}
+        indexes = {versions: _description_index(prices) for versions, prices in sold_at.items() if prices is not None}
+        inferred = {key: _infer_ref(sold_at[key[:2]], indexes[key[:2]], *key[2:]) if sold_at[key[:2]] is not None else None
+                    for key in set(keys)}
+        refs[missing] = pd.Series([inferred[key] for key in keys], index=refs.index[missing], dtype=object)
+    return refs
+
+
+# ==============================================================================
+# إعادة التسعير
+# ==============================================================================
+def _ref_table(refs):
+    """
+    Factorizes the refs: returns (codes, table) where table has one row per
+    distinct ref (kind and parameters a..e) plus a last empty row, so that the
+    code -1 of lines without a ref picks it.
+    """
+    codes, uniques = pd.factorize(refs)
+    rows = [list(price_ref) + [None] * (6 - len(price_ref)) for price_ref in uniques] + [[None] * 6]
+    return codes, pd.DataFrame(rows, columns=['kind', 'a', 'b', 'c', 'd', 'e'], dtype=object)
+
+def reprice(prices, quantity, refs):
+    """
+    Subtotals in piastres of lines with the given quantities and price_refs under
+    prices, as whole-column operations like batch_quote.quote_jobs: the prices of
+    the distinct refs are looked up once, tiers that depend on the line quantity
+    are searched for all lines at once. NaN where a line has no ref or prices
+    has no price for it.
+    """
+    codes, table = _ref_table(refs)
+    kind = table['kind'].to_numpy(dtype=object)
+    a, b, c, d = (table[column].to_numpy(dtype=object) for column in 'abcd')
+    # لكل مرجع: سعر الوحدة، أو الإجمالي مباشرة لبند طباعة الورق العادي (سعر الورقة × عدد الورق في المرجع)
+    unit = np.full(len(table), np.nan)
+    fixed = np.full(len(table), np.nan)
+
+    sheet = kind == 'sheet'
+    if sheet.any():
+        papers = table['e'][sheet].to_numpy(dtype=float)
+        bracket = np.where(papers > prices.quantity_threshold, 'large', 'small').astype(object)
+        sheet_price = np.where(d[sheet] == pricing.LASER_METHOD,
+                               lookup(prices.laser_paper, a[sheet], b[sheet], c[sheet]),
+                               lookup(prices.plain_paper, a[sheet], b[sheet], bracket, c[sheet]))
+        fixed[sheet] = sheet_price * papers
+    copies = kind == 'copy'
+    if copies.any():
+        copy_price = lookup(prices.printing, a[copies], b[copies])
+        single = np.full(copies.sum(), pricing.SINGLE_SIDED, dtype=object)
+        unit[copies] = np.where(np.isnan(copy_price), lookup(prices.printing, a[copies], single), copy_price)
+    for option, table_prices in [('lamination', prices.lamination), ('trimming', prices.trimming),
+                                 ('binding', prices.binding)]:
+        chosen = kind == option
+        if chosen.any():
+            unit[chosen] = lookup(table_prices, a[chosen])
+    stapled = kind == 'stapling'
+    if stapled.any():
+        papers_per_book = b[stapled].astype(float)
+        unit[stapled] = np.where(a[stapled] == 'A5', tier_values(prices.stapling['A5'], papers_per_book),
+                                 tier_values(prices.stapling['A4'], papers_per_book))
+
+    # كروت ID وتغليف المنيو: سعر الوحدة حسب كمية البند نفسه
+    line_kind = kind[codes]
+    subtotal = np.where(line_kind == 'sheet', fixed[codes], unit[codes] * quantity)
+    id_cards = line_kind == 'id_card'
+    subtotal[id_cards] = tier_values(prices.id_cards, quantity[id_cards]) * quantity[id_cards]
+    menus = line_kind == 'menu'
+    menu_size = a[codes][menus]
+    menu_price = np.full(menus.sum(), np.nan)
+    for size, tiers in prices.menu_lamination.items():
+        menu_price = np.where(menu_size == size, tier_values(tiers, quantity[menus]), menu_price)
+    subtotal[menus] = menu_price * quantity[menus]
+    # تقريب لأقرب قرش (النصف لأعلى) مثل money.to_piastres
+    return np.floor(np.round(subtotal * PIASTRES_PER_POUND, 6) + 0.5)
+
+def requote_lines(prices, items):
+    """
+    Order lines (pricing.line_item dicts) priced again with prices through their
+    price_ref, the same way reprice does, and stamped with its versions; lines
+    priced by hand keep their price. Raises KeyError with the line description
+    if prices have no price for a line's ref.
+    """
+    refs = pd.Series([tuple(item['price_ref']) if item.get('price_ref') else None for item in items], dtype=object)
+    subtotals = reprice(prices, np.array([float(item['quantity']) for item in items]), refs)
+    price_version_id, customer_price_version_id = pricing.snapshot_versions(prices)
+    requoted = []
+    for item, price_ref, subtotal in zip(items, refs, subtotals):
+        item = {**item, 'price_version_id': price_version_id, 'customer_price_version_id': customer_price_version_id}
+        if price_ref is not None:
+            if np.isnan(subtotal):
+                raise KeyError(item['description'])
+            item['subtotal'] = float(subtotal) / PIASTRES_PER_POUND
+            item['unit_price'] = item['subtotal'] / item['quantity']
+        requoted.append(item)
+    return requoted
+
+def simulate(sale_prices, candidate, lines, customer_overrides=None):
+    """
+    What-if report of lines (LINE_COLUMNS) priced again with the candidate
+    PriceTables; refs missing from lines are inferred against the prices they
+    were sold at (sale_prices and customer_overrides, from load_history). Lines
+    sold at a customer's special prices are priced again with the candidate
+    plus the same special prices. Lines that cannot be priced again (no ref,
+    or special prices that are no longer stored) keep their actual subtotal
+    and are counted as unmatched. Returns (by_product, totals): a DataFrame
+    indexed by product (line description) with the REPORT_COLUMNS in pounds,
+    largest revenue first, and the same columns summed over all lines as a dict.
+    """
+    quantity = lines['quantity'].to_numpy(dtype=float)
+    refs = price_refs(sale_prices, lines, customer_overrides)
+    customer_versions = lines['customer_version'].to_numpy(dtype=np.int64)
+    repriced = np.full(len(lines), np.nan)
+    for customer_version in np.unique(customer_versions):
+        prices = with_customer_version(candidate, customer_overrides, customer_version)
+        group = customer_versions == customer_version
+        if prices is not None:
+            repriced[group] = reprice(prices, quantity[group], refs[group])
+    matched = ~np.isnan(repriced)
+    actual = lines['subtotal'].to_numpy(dtype=float)
+    frame = pd.DataFrame({
+        'product': lines['description'].to_numpy(dtype=object),
+        'lines': 1,
+        'actual': actual / PIASTRES_PER_POUND,
+        'candidate': np.where(matched, repriced, actual) / PIASTRES_PER_POUND,
+        'unmatched': (~matched).astype(int),
+    })
+    by_product = frame.groupby('product').sum()
+    by_product['delta'] = by_product['candidate'] - by_product['actual']
+    by_product['delta_pct'] = by_product['delta'] / by_product['actual'].replace(0, np.nan) * 100
+    by_product = by_product.sort_values('actual', ascending=False)[list(REPORT_COLUMNS)]
+
+    totals = by_product[['lines', 'actual', 'candidate', 'delta', 'unmatched']].sum().to_dict()
+    totals['lines'], totals['unmatched'] = int(totals['lines']), int(totals['unmatched'])
+    totals['delta_pct'] = totals['delta'] / totals['actual'] * 100 if totals['actual'] else np.nan
+    return by_product, totals
+
+def export_simulation(by_product, totals, path):
+    """Writes the what-if report with Arabic headers and a total row."""
+    sheet = by_product.rename(columns=REPORT_COLUMNS).rename_axis('المنتج').reset_index()
+    total_row = {'المنتج': 'الإجمالي', **{REPORT_COLUMNS[column]: value for column, value in totals.items()}}
+    sheet = pd.concat([sheet, pd.DataFrame([total_row])], ignore_index=True)
+    with pd.ExcelWriter(path, engine='xlsxwriter') as writer:
+        sheet.to_excel(writer, sheet_name='محاكاة الأسعار', index=False)
+
+
+# ==============================================================================
+# المحاكاة في الخلفية
+# ==============================================================================
+class RepricingJob:
+    """
+    Runs history_lines and simulate on a daemon thread, with the history and the
+    prices it was sold at already read by load_history on the Tk thread (the
+    SQLite connections belong to it).
+    The Tk side polls `done` with after() and then reads `result`
+    ((by_product, totals)) or `error`.
+    """
+
+    def __init__(self, sale_prices, candidate_config, lines, legacy_receipts, customer_overrides=None):
+        self.result = None
+        self.error = None
+        self._thread = threading.Thread(target=self._run,
+                                        args=(sale_prices, candidate_config, lines, legacy_receipts, customer_overrides),
+                                        daemon=True)
+
+    def _run(self, sale_prices, candidate_config, lines, legacy_receipts, customer_overrides):
+        try:
+            self.result = simulate(sale_prices, pricing.PriceTables(candidate_config), history_lines(lines, legacy_receipts),
+                                   customer_overrides)
+        except Exception as e:
+            self.error = e
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    @property
+    def done(self):
+        return not self._thread.is_alive()
+
+
+if __name__ == '__main__':
+    import config_manager
+    from storage import open_store
+
+    parser = argparse.ArgumentParser(description="Show how past sales would have been priced with another price config.")
+    parser.add_argument('candidate', help="JSON file with the price sections to change (the rest stay as they are)")
+    parser.add_argument('--days', type=int, default=DEFAULT_DAYS, help="simulate the sales of this many past days")
+    parser.add_argument('--out', help="write the report to this Excel file")
+    args = parser.parse_args()
+
+    with open(args.candidate, encoding='utf-8') as candidate_file:
+        candidate_prices = pricing.PriceTables({**pricing.current_prices().config(), **json.load(candidate_file)})
+    store = open_store(config_manager.load_prices().get('DATABASE'))
+    try:
+        store.init_schema()
+        today = date.today()
+        sold, legacy, prices_sold_at, special_prices = load_history(store, pricing.PriceHistory(store),
+                                                                    today - timedelta(days=args.days - 1), today)
+    finally:
+        store.close()
+    report, report_totals = simulate(prices_sold_at, candidate_prices, history_lines(sold, legacy), special_prices)
+    print(report.to_string())
+    print(f"Total: {report_totals['actual']:.2f} -> {report_totals['candidate']:.2f} "
+          f"({report_totals['delta']:+.2f}, {report_totals['unmatched']} lines kept at their actual price)")
+    if args.out:
+        export_simulation(report, report_totals, args.out)
@@ -0,0 +1,399 @@
+# storage.py
+
+import json
+from abc import ABC, abstractmethod
+from datetime import datetime, time, timedelta
+
+import pandas as pd
+
+# أنواع قواعد البيانات المدعومة، وتُختار من قسم DATABASE في prices_config.json
+SQLITE_BACKEND = 'sqlite'
+POSTGRES_BACKEND = 'postgresql'
+
+# أعمدة الفاتورة اللازمة لإعادة بنائها وعرضها (انظر receipt_codec.receipt_render_data)
+RECEIPT_COLUMNS = """
+    r.id, r.ts_epoch, r.total_amount, r.discount, r.amount_paid, r.remaining_amount, r.notes, r.due_date,
+    r.receipt_data, c.name, c.phone
+"""
+
+# طرق ترتيب قائمة العملاء المتاحة لـ list_customers
+CUSTOMER_SORT_ORDERS = {
+    'name': "c.name",
+    'balance': "s.balance DESC, c.name",
+    'lifetime_spend': "s.lifetime_spend DESC, c.name",
+    'last_visit': "s.last_visit DESC NULLS LAST, c.name",
+}
+
+# حالة الطلب عند حفظ الفاتورة، وحالة التسليم النهائية
+NEW_JOB_STATUS = "تحت التنفيذ"
+DELIVERED_STATUS = "تم التسليم"
+
+# أنواع الدفعات في جدول payments
+PAYMENT_CHECKOUT = 'checkout'
+PAYMENT_SETTLEMENT = 'settlement'
+PAYMENT_PARTIAL = 'partial'
+
+# أنواع حركات المخزون في جدول stock_movements (الكمية موجبة للإضافة وسالبة للصرف)
+STOCK_OPENING = 'opening'
+STOCK_PURCHASE = 'purchase'
+STOCK_CONSUMPTION = 'consumption'
+STOCK_ADJUSTMENT = 'adjustment'
+
+
+class DuplicateRecordError(Exception):
+    """Raised by a backend when an insert or update hits a unique column (customer phone, inventory name)."""
+
+
+# ==============================================================================
+# دوال مساعدة للاستعلامات
+# ==============================================================================
+def day_key(day):
+    """مفتاح اليوم بالشكل YYYYMMDD، وهو نفس قيمة عمود local_day ومفتاح جداول التجميع."""
+    return day.year * 10000 + day.month * 100 + day.day
+
+def day_range(day):
+    """
+    Returns the bounds of a whole day as a half-open range [start, end) of day keys
+    that can be compared to the indexed local_day column directly.
+    """
+    return day_key(day), day_key(day + timedelta(days=1))
+
+def month_range(year, month):
+    year, month = int(year), int(month)
+    next_year, next_month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return year * 10000 + month * 100, next_year * 10000 + next_month * 100
+
+def year_range(year):
+    year = int(year)
+    return year * 10000, (year + 1) * 10000
+
+def month_start(moment):
+    """Local midnight on the first day of the moment's month, where stock snapshots are taken."""
+    return datetime(moment.year, moment.month, 1)
+
+def timestamp_columns(moment):
+    """
+    Returns (timestamp text, ts_epoch, local_day) for a local datetime. The text keeps
+    the format older rows were written in, without relying on sqlite3's deprecated
+    default datetime adapter.
+    """
+    return moment.strftime('%Y-%m-%d %H:%M:%S.%f'), int(moment.timestamp()), day_key(moment)
+
+def price_ref_text(item):
+    """The receipt_items.price_ref value of an order line: its pricing.py price reference as JSON, or None."""
+    price_ref = item.get('price_ref')
+    return json.dumps(list(price_ref), ensure_ascii=False) if price_ref else None
+
+
+# ==============================================================================
+# واجهة طبقة البيانات
+# ==============================================================================
+class StorageBackend(ABC):
+    """
+    The interface the pages use for all persistence. DataStore (SQLite, the
+    default) and PostgresStore (pg_store.py) implement it, and open_store picks
+    one from the DATABASE settings, so the UI never writes SQL or depends on a
+    particular database driver.
+
+    Money is integer piastres in and out of every method, except the report
+    DataFrames which are already in pounds. Receipt rows are RECEIPT_COLUMNS
+    tuples. Inserts that hit a unique column raise DuplicateRecordError.
+
+    The supports_* flags tell the UI which file-based SQLite features (yearly
+    archive files, backup bundles, idle-time maintenance) the backend has;
+    backends with archive files also implement ArchivingBackend.
+    """
+
+    supports_archive = False
+    supports_backup = False
+    supports_maintenance = False
+
+    @abstractmethod
+    def close(self):
+        """Closes the connections."""
+
+    @abstractmethod
+    def init_schema(self, progress=print):
+        """Creates or upgrades the schema."""
+
+    # --------------------------------------------------------------------------
+    # العملاء
+    # --------------------------------------------------------------------------
+    @abstractmethod
+    def find_customer_by_phone(self, phone):
+        """Returns (id, name) or None."""
+
+    @abstractmethod
+    def add_customer(self, name, phone, notes):
+        """Inserts a customer and returns its id. Raises DuplicateRecordError for a duplicate phone."""
+
+    @abstractmethod
+    def get_customer_name(self, customer_id):
+        """Returns the customer's name, or None."""
+
+    @abstractmethod
+    def get_customer_phone(self, customer_id):
+        """Returns the customer's phone, or None."""
+
+    @abstractmethod
+    def list_customers(self, sort_by='name'):
+        """Returns (id, name, phone, balance, lifetime_spend, order_count, last_visit) rows, ordered by one of CUSTOMER_SORT_ORDERS."""
+
+    @abstractmethod
+    def customer_history(self, customer_id):
+        """Returns the customer's receipts as RECEIPT_COLUMNS rows, newest first."""
+
+    @abstractmethod
+    def customer_debts(self):
+        """Returns (id, name, phone, balance, open_debt_count) for customers who owe money, largest balance first."""
+
+    @abstractmethod
+    def debt_aging(self):
+        """
+        Returns (id, name, phone, total, open_count, days_0_30, days_31_60, days_61_90,
+        days_over_90) from the debt_aging view, largest total first. Each bucket is the
+        remaining amount of open receipts of that age.
+        """
+
+    @abstractmethod
+    def customer_payments(self, customer_id):
+        """Returns the customer's (paid_at epoch, receipt_id, amount, kind) payments, newest first."""
+
+    @abstractmethod
+    def record_payment(self, customer_id, amount):
+        """
+        Applies a payment to the customer's open receipts, oldest first, writing one
+        PAYMENT_PARTIAL row per receipt it touches. Returns the amount applied, which
+        is less than amount if it exceeds what the customer owes.
+        """
+
+    @abstractmethod
+    def customer_price_version(self, customer_id):
+        """Id of the customer's current special prices version, or None if they pay the price list."""
+
+    @abstractmethod
+    def get_customer_price_version(self, version_id):
+        """(customer_id, overrides) of a special prices version (see pricing.overlay_prices), or None."""
+
+    @abstractmethod
+    def save_customer_prices(self, customer_id, overrides):
+        """
+        Stores the customer's price overrides as a new version and returns its id;
+        empty overrides end the special prices. Earlier versions are kept, since
+        receipts point at the version they were priced with.
+        """
+
+    # --------------------------------------------------------------------------
+    # الفواتير والطلبات
+    # --------------------------------------------------------------------------
+    @abstractmethod
+    def save_receipt(self, receipt_payload, total_amount, customer_id, due_date, notes, discount, amount_paid, remaining,
+                     items=(), consumed_materials=(), price_version_id=None, customer_price_version_id=None):
+        """
+        Saves a receipt with its line items, consumed materials and the amount paid
+        at checkout (a PAYMENT_CHECKOUT row) atomically, and returns the new receipt id.
+        price_version_id is the stored price version the order was priced with, and
+        customer_price_version_id the customer's special prices version, if any.
+        """
+
+    @abstractmethod
+    def get_receipt(self, receipt_id):
+        """Returns one receipt as a RECEIPT_COLUMNS row, or None."""
+
+    @abstractmethod
+    def receipt_line_items(self, receipt_id):
+        """Returns (description, quantity, unit_price, subtotal, product_type, paper_size) rows, priced in piastres."""
+
+    @abstractmethod
+    def open_jobs(self):
+        """Returns (id, customer name, due_date, status) for receipts that are not delivered yet."""
+
+    @abstractmethod
+    def get_receipt_remaining(self, receipt_id):
+        """Returns the receipt's remaining amount."""
+
+    @abstractmethod
+    def update_job_status(self, receipt_id, new_status, settle_debt=False):
+        """
+        Moves a job to new_status, logging the transition in job_status_events and
+        adding the time spent in the previous stage to job_stage_durations and
+        job_stage_daily. settle_debt pays off the receipt's remaining amount and
+        records it as a PAYMENT_SETTLEMENT.
+        """
+
+    @abstractmethod
+    def job_stage_durations(self, receipt_id):
+        """Returns (status, seconds, visits) for each stage the job has left, in the order first entered."""
+
+    @abstractmethod
+    def job_stage_summary(self, start_date, end_date):
+        """
+        DataFrame (status, entered, completed, avg_hours) over the dates (end date
+        inclusive): jobs that entered each stage, jobs that left it, and their
+        average time in it. Read from the job_stage_daily rollup.
+        """
+
+    @abstractmethod
+    def job_throughput(self, start_date, end_date):
+        """DataFrame (day, received, delivered) of jobs created and delivered per day, read from job_stage_daily."""
+
+    # --------------------------------------------------------------------------
+    # لوحة التحكم والمصروفات
+    # --------------------------------------------------------------------------
+    @abstractmethod
+    def daily_summary(self, day):
+        """Returns (income, expenses, total debt) for the given day."""
+
+    @abstractmethod
+    def add_expense(self, description, amount):
+        """Records an expense for today."""
+
+    # --------------------------------------------------------------------------
+    # التقارير والتحليل (DataFrames بالجنيه)
+    # --------------------------------------------------------------------------
+    @abstractmethod
+    def jobs_report(self, start_date, end_date):
+        """DataFrame of the receipts over the dates (end date inclusive) with their consumed materials."""
+
+    @abstractmethod
+    def expenses_report(self, start_date, end_date):
+        """DataFrame (date, description, amount) of the expenses over the dates (end date inclusive)."""
+
+    @abstractmethod
+    def top_customers(self, since, limit=10):
+        """DataFrame (name, total) of the customers who spent most since the given date."""
+
+    @abstractmethod
+    def available_years(self):
+        """Returns the years that have receipts or expenses as strings, newest first."""
+
+    @abstractmethod
+    def monthly_totals(self, year):
+        """DataFrame (month, income, expenses) per month ('01'..'12') of the given year."""
+
+    @abstractmethod
+    def daily_totals(self, year, month):
+        """DataFrame (day, income, expenses) per day ('01'..'31') of the given month."""
+
+    @abstractmethod
+    def product_sales(self, year, month=None):
+        """DataFrame indexed by product of how often it sold and its income, over the year or month."""
+
+    @abstractmethod
+    def sold_line_items(self, start_date, end_date):
+        """
+        DataFrame (receipt_id, ts_epoch, price_version_id, customer_price_version_id,
+        description, quantity, unit_price, subtotal, product_type, paper_size,
+        price_ref) of the line
+        items of receipts created over the dates (end date inclusive), archived
+        receipts included. Prices in piastres; price_ref is the JSON written by
+        save_receipt, or None.
+        """
+
+    @abstractmethod
+    def receipts_without_items(self, start_date, end_date):
+        """
+        (receipt_id, ts_epoch, price_version_id, receipt_data) of receipts over the
+        dates that have no receipt_items rows (old legacy text).
+        """
+
+    # --------------------------------------------------------------------------
+    # إصدارات الأسعار
+    # --------------------------------------------------------------------------
+    @abstractmethod
+    def save_price_version(self, config, effective_from):
+        """Stores a price config (pricing.PRICE_SECTIONS) as a version in force from the effective_from datetime; returns its id."""
+
+    @abstractmethod
+    def price_versions(self):
+        """(id, effective_from epoch) of every price version, ordered by effective_from."""
+
+    @abstractmethod
+    def get_price_version(self, version_id):
+        """The config dict of a price version, or None."""
+
+    # --------------------------------------------------------------------------
+    # المخزون
+    # --------------------------------------------------------------------------
+    @abstractmethod
+    def list_materials(self):
+        """Returns (id, name, unit, stock_level) for every inventory item, by name."""
+
+    @abstractmethod
+    def list_inventory(self):
+        """Returns (id, name, unit, stock_level, low_stock_threshold, purchase_price) for every item, by name."""
+
+    @abstractmethod
+    def get_inventory_item(self, inventory_id):
+        """Returns (id, name, unit, stock_level, low_stock_threshold, purchase_price) or None."""
+
+    @abstractmethod
+    def add_inventory_item(self, name, unit, stock, threshold, price):
+        """Records the initial stock as a STOCK_OPENING movement. Raises DuplicateRecordError if the name already exists."""
+
+    @abstractmethod
+    def update_inventory_item(self, inventory_id, name, unit, threshold, price):
+        """Raises DuplicateRecordError if the new name already exists."""
+
+    @abstractmethod
+    def add_stock(self, inventory_id, quantity, kind=STOCK_PURCHASE, note=None):
+        """Changes an item's stock by quantity (negative for a write-off) and records the movement."""
+
+    @abstractmethod
+    def take_stock_snapshot(self, moment=None):
+        """
+        Stores every item's stock at the start of the month of moment (default now),
+        unless that snapshot already exists. Returns the number of rows written.
+        """
+
+    @abstractmethod
+    def stock_at(self, moment):
+        """
+        Returns (id, name, unit, stock) for every item as it was at moment, read as
+        the latest snapshot before moment plus the movements after it.
+        """
+
+    @abstractmethod
+    def stock_movement_totals(self, range_start, range_end):
+        """Returns {inventory_id: (added, consumed, adjusted)} for movements in the half-open day-key range."""
+
+    def stock_movement_report(self, start_date, end_date):
+        """DataFrame per item of opening stock, purchases, consumption, adjustments and closing stock (end date inclusive)."""
+        range_start, range_end = day_key(start_date), day_range(end_date)[1]
+        opening = self.stock_at(datetime.combine(start_date, time()))
+        closing = {row[0]: row[3] for row in self.stock_at(datetime.combine(end_date, time()) + timedelta(days=1))}
+        totals = self.stock_movement_totals(range_start, range_end)
+        return pd.DataFrame([
+            (name, unit, stock, *totals.get(inventory_id, (0, 0, 0)), closing.get(inventory_id, 0))
+            for inventory_id, name, unit, stock in opening
+        ], columns=['المادة', 'الوحدة', 'رصيد أول المدة', 'مشتريات', 'استهلاك', 'تسويات', 'رصيد آخر المدة'])
+
+
+class ArchivingBackend(ABC):
+    """Mixin for backends that can move old receipts out of the live database (sets supports_archive)."""
+
+    supports_archive = True
+
+    @abstractmethod
+    def archive_old_receipts(self, months_to_keep, progress=print):
+        """Moves old delivered, fully paid receipts into the archive files. Returns how many moved."""
+
+
+def open_store(settings=None):
+    """
+    Opens the backend named by settings['BACKEND'] (the DATABASE section of
+    prices_config.json): 'sqlite' (default) uses SQLITE_FILE, 'postgresql' uses
+    POSTGRES_DSN with a pool of POOL_MIN_CONNECTIONS..POOL_MAX_CONNECTIONS.
+    The PostgreSQL driver is only imported when that backend is chosen.
+    """
+    settings = settings or {}
+    backend = settings.get('BACKEND') or SQLITE_BACKEND
+    if backend == SQLITE_BACKEND:
+        from data_store import DB_FILE, DataStore
+        return DataStore(settings.get('SQLITE_FILE') or DB_FILE)
+    if backend == POSTGRES_BACKEND:
+        from pg_store import PostgresStore
+        return PostgresStore(settings['POSTGRES_DSN'],
+                             min_connections=settings.get('POOL_MIN_CONNECTIONS', 1),
+                             max_connections=settings.get('POOL_MAX_CONNECTIONS', 5))
+    raise ValueError(f"Unknown database backend '{backend}' (expected '{SQLITE_BACKEND}' or '{POSTGRES_BACKEND}')")